@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+异步（ASGI）服务。
+/book/search在asyncio中执行（见BookManager.search_async）：搜索在线程中运行，同时等待客户端断开连接，
+断开后取消搜索，正在搜索的线程在下一个章节之前停止，不再占用线程。每个请求有时限（见book_server.search_timeout），
+超时后返回已经搜索完的书籍中的结果，truncated为true。
+其它请求在线程中交给book_server的Flask应用处理，流式响应逐块发送，客户端断开连接后关闭响应，停止搜索。
+
+只依赖标准库，用任何ASGI服务器运行，书库等参数用环境变量给出（见book_server.parse_args）：
+	BOOKMAN_BOOKS=./books.corpus uvicorn book_asgi:app --port 6060
+"""
+
+import io
+import sys
+import json
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from urllib.parse import parse_qs
+
+import book_server
+
+class BookServerASGI(object):
+	"""
+	ASGI应用，/book/search异步执行，其它请求交给Flask应用。
+	"""
+	# 运行搜索和Flask请求的线程数
+	THREAD_NUM = 32
+
+	def __init__(self, flask_app):
+		"""
+		:param flask_app: book_server的Flask应用，没有bookmanager时在lifespan.startup中按环境变量加载书库。
+		"""
+		self.flask_app = flask_app
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.THREAD_NUM, thread_name_prefix = 'a_thread')
+		self.routes = {'/book/search': self.search}
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] == 'lifespan':
+			await self.lifespan(receive, send)
+			return
+		if scope['type'] != 'http':
+			return
+		handler = self.routes.get(scope['path'])
+		if handler is not None and scope['method'] == 'GET':
+			await handler(scope, receive, send)
+		else:
+			await self.wsgi(scope, receive, send)
+
+	async def lifespan(self, receive, send):
+		"""
+		启动时加载书库，停止时关闭BookManager。
+		"""
+		while True:
+			message = await receive()
+			if message['type'] == 'lifespan.startup':
+				try:
+					if getattr(self.flask_app, 'bookmanager', None) is None:
+						args = book_server.parse_args([])
+						self.flask_app.bookmanager = await asyncio.get_running_loop().run_in_executor(self.executor, book_server.create_bookmanager, args)
+						book_server.startup_logger.info(f"search with {book_server.search_engine_info(self.flask_app.bookmanager, args.index)}.")
+				except Exception as e:
+					logging.exception(f"load books failed...")
+					await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+					return
+				await send({'type': 'lifespan.startup.complete'})
+			elif message['type'] == 'lifespan.shutdown':
+				if getattr(self.flask_app, 'bookmanager', None) is not None:
+					self.flask_app.bookmanager.close()
+				self.executor.shutdown(wait = False)
+				await send({'type': 'lifespan.shutdown.complete'})
+				return
+
+	async def search(self, scope, receive, send):
+		"""
+		/book/search，参数和响应与book_server.search_book_library相同。客户端断开连接时取消搜索，不返回响应。
+		"""
+		args = parse_qs(scope['query_string'].decode('latin-1'), encoding = 'utf-8')
+		def arg(name, type = str, default = None):
+			values = args.get(name)
+			if not values:
+				return default
+			try:
+				return type(values[0])
+			except ValueError:
+				return default
+		q = arg('q')
+		book_list = arg('book_list')
+		start = arg('start', int, 0)
+		count = arg('count', int)
+		total = arg('total', default = book_server.BookManager.COUNT_ESTIMATE)
+		surround = arg('surround', int)
+		timeout = arg('timeout', float)
+
+		logging.info(f"/book/search (async), q: {q}, book_list: {book_list}, start: {start}, count: {count}, total: {total}, surround: {surround}, timeout: {timeout}.")
+
+		if not q:
+			await self.respond(send, 400, {"error": "q parameter is missing."})
+			return
+
+		search = asyncio.ensure_future(self.flask_app.bookmanager.search_async(q, book_list, start, count, total,
+			timeout = book_server.search_timeout(timeout), executor = self.executor))
+		disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+		try:
+			done, _ = await asyncio.wait({search, disconnect}, return_when = asyncio.FIRST_COMPLETED)
+		finally:
+			# 客户端断开连接或者请求被取消时取消搜索
+			for task in (search, disconnect):
+				if not task.done():
+					task.cancel()
+		if search not in done:
+			logging.info(f"client disconnected, cancel search: {q}.")
+			return
+		query_results = search.result()
+		response = await asyncio.get_running_loop().run_in_executor(self.executor, book_server.search_response, query_results, surround)
+		await self.respond(send, 200, response)
+
+	async def wait_disconnect(self, receive):
+		"""
+		等待客户端断开连接。
+		"""
+		while True:
+			message = await receive()
+			if message['type'] == 'http.disconnect':
+				return
+
+	async def respond(self, send, status, data):
+		"""
+		返回json响应。
+		"""
+		body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+		await send({'type': 'http.response.start', 'status': status, 'headers': [
+			(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))]})
+		await send({'type': 'http.response.body', 'body': body})
+
+	async def wsgi(self, scope, receive, send):
+		"""
+		在线程中执行Flask应用，逐块发送响应内容，客户端断开连接后关闭响应。
+		"""
+		body = bytearray()
+		while True:
+			message = await receive()
+			if message['type'] == 'http.disconnect':
+				return
+			body += message.get('body', b'')
+			if not message.get('more_body'):
+				break
+
+		loop = asyncio.get_running_loop()
+		# 工作线程发来的消息：('start', status, headers)，('body', chunk)，('end', None)
+		messages = asyncio.Queue()
+		disconnected = threading.Event()
+
+		def run():
+			# Flask的流式响应在生成器中保存了请求上下文，整个响应必须在同一个线程中生成和关闭
+			def start_response(status, headers, exc_info = None):
+				loop.call_soon_threadsafe(messages.put_nowait, ('start', int(status.split(' ', 1)[0]),
+					[(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]))
+			iterable = self.flask_app(self.environ(scope, bytes(body)), start_response)
+			try:
+				for chunk in iterable:
+					if disconnected.is_set():
+						break
+					if chunk:
+						loop.call_soon_threadsafe(messages.put_nowait, ('body', chunk))
+			finally:
+				close = getattr(iterable, 'close', None)
+				if close is not None:
+					close()
+				loop.call_soon_threadsafe(messages.put_nowait, ('end', None))
+
+		worker = loop.run_in_executor(self.executor, run)
+		disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+		try:
+			while True:
+				message = asyncio.ensure_future(messages.get())
+				done, _ = await asyncio.wait({message, disconnect}, return_when = asyncio.FIRST_COMPLETED)
+				if message not in done:
+					message.cancel()
+					break
+				kind, *data = message.result()
+				if kind == 'start':
+					await send({'type': 'http.response.start', 'status': data[0], 'headers': data[1]})
+				elif kind == 'body':
+					await send({'type': 'http.response.body', 'body': data[0], 'more_body': True})
+				else:
+					await send({'type': 'http.response.body', 'body': b''})
+					break
+		finally:
+			# 客户端断开连接后，工作线程在下一块响应内容之前关闭响应
+			disconnected.set()
+			disconnect.cancel()
+		await worker
+
+	def environ(self, scope, body):
+		"""
+		由ASGI的scope生成WSGI的environ。
+		"""
+		server = scope.get('server') or ('localhost', 80)
+		client = scope.get('client') or ('', 0)
+		environ = {
+			'REQUEST_METHOD': scope['method'],
+			'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+			'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+			'QUERY_STRING': scope['query_string'].decode('latin-1'),
+			'SERVER_NAME': server[0],
+			'SERVER_PORT': str(server[1]),
+			'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+			'REMOTE_ADDR': client[0],
+			'CONTENT_LENGTH': str(len(body)),
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': scope.get('scheme', 'http'),
+			'wsgi.input': io.BytesIO(body),
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': True,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once': False,
+		}
+		for name, value in scope['headers']:
+			name = name.decode('latin-1').upper().replace('-', '_')
+			value = value.decode('latin-1')
+			if name == 'CONTENT_LENGTH':
+				continue
+			if name == 'CONTENT_TYPE':
+				environ['CONTENT_TYPE'] = value
+				continue
+			key = 'HTTP_' + name
+			environ[key] = f"{environ[key]},{value}" if key in environ else value
+		return environ
+
+app = BookServerASGI(book_server.app)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+书库的紧凑存储格式（compact corpus）。
+书库中所有段落的内容按顺序编码为一个UTF-8文本块，书籍、卷、章节、段落用偏移量数组组织，
+书籍、卷、章节的其它属性（即书籍目录，见build_book_catalogue）和段落除content以外的属性（如annotations）
+编码为json保存在数据区中，文件头只包含书籍文件名、大小、修改时间、内容摘要和数据区的布局。
+服务器用mmap只读打开文件，书籍目录、段落对象在需要时才解码，多个服务进程共享操作系统页缓存中的同一份书库。
+
+文件结构：
+	MAGIC(8字节) | 版本(uint32) | 文件头长度(uint32) | 文件头(json) | 填充到8字节对齐 | 数据区
+数据区依次为：
+	book_volumes，每本书第一卷的序号，书籍数+1个；
+	volume_chapters，每卷第一个章节的序号，卷数+1个；
+	chapter_paragraphs，每个章节第一个段落的序号，章节数+1个；
+	paragraph_offsets，每个段落在text中的字节偏移量，段落数+1个；
+	paragraph_extras，每个段落的其它属性在extras中的字节偏移量，段落数+1个，没有其它属性的段落长度为0；
+	book_catalogues，每本书的目录在catalogues中的字节偏移量，书籍数+1个；
+	text，所有段落内容的UTF-8文本块；
+	extras，段落的其它属性，每个段落一个UTF-8编码的json对象；
+	catalogues，书籍目录，每本书一个UTF-8编码的json对象。
+偏移量数组都是little-endian的uint64。
+
+生成compact corpus：
+	python book_corpus.py build <书库路径> <corpus文件路径>
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import shutil
+import logging
+import argparse
+import tempfile
+from array import array
+
+from book_manager import BookTextIndex, book_digest, build_book_catalogue, build_book_lookup, title_sort_key
+
+MAGIC = b'BMCORPUS'
+VERSION = 3
+# MAGIC, 版本, 文件头长度
+PREFIX = struct.Struct('<8sII')
+ARRAYS = ('book_volumes', 'volume_chapters', 'chapter_paragraphs', 'paragraph_offsets', 'paragraph_extras', 'book_catalogues')
+# 数据区中按偏移量数组分割的字节块，依次为段落内容、段落的其它属性、书籍目录
+BLOBS = ('text', 'extras', 'catalogues')
+
+def _aligned(size, alignment = 8):
+	return (size + alignment - 1) // alignment * alignment
+
+def _json_bytes(value):
+	return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _array_bytes(values):
+	if sys.byteorder != 'little':
+		values = array('Q', values)
+		values.byteswap()
+	return values.tobytes()
+
+def build_corpus(books_path, corpus_path, book_files = None):
+	"""
+	将书库中的书籍json文件转换为compact corpus文件。
+	逐本书解码，段落内容、段落的其它属性、书籍目录直接写入临时文件，内存中只保留一本书和偏移量数组。
+	先写入同一目录下的临时文件，完成后替换corpus_path，正在使用旧文件的进程不受影响。
+
+	:param books_path: 书库路径。
+	:param corpus_path: 生成的corpus文件路径。
+	:param book_files: 要转换的书籍文件，缺省为books_path中所有的*.json文件。
+	:return: int, 转换的书籍数。
+	"""
+	if book_files is None:
+		book_files = [os.path.join(books_path, filename) for filename in sorted(os.listdir(books_path)) if filename.endswith(".json")]
+
+	def write_blob(name, data):
+		blob_files[name].write(data)
+		blob_sizes[name] += len(data)
+		return blob_sizes[name]
+
+	begin = time.perf_counter()
+	books = []
+	offsets = {name: array('Q', [0]) for name in ARRAYS}
+	blob_sizes = {name: 0 for name in BLOBS}
+	corpus_dir = os.path.dirname(os.path.abspath(corpus_path))
+	blob_files = {name: tempfile.TemporaryFile(dir = corpus_dir) for name in BLOBS}
+	try:
+		for book_path in book_files:
+			try:
+				with open(book_path, 'rb') as file:
+					data = file.read()
+					stat = os.fstat(file.fileno())
+				book = json.loads(data)
+			except (OSError, ValueError) as e:
+				logging.error(f"load {book_path} failed: {e}")
+				continue
+
+			for volume in book["volumes"]:
+				for chapter in volume["chapters"]:
+					for paragraph in chapter.get("paragraphs") or []:
+						offsets['paragraph_offsets'].append(write_blob('text', paragraph["content"].encode('utf-8')))
+						# 段落除content以外的属性（如annotations）
+						extra = {key: value for key, value in paragraph.items() if key != "content"}
+						offsets['paragraph_extras'].append(write_blob('extras', _json_bytes(extra)) if extra else blob_sizes['extras'])
+					offsets['chapter_paragraphs'].append(len(offsets['paragraph_offsets']) - 1)
+				offsets['volume_chapters'].append(len(offsets['chapter_paragraphs']) - 1)
+			offsets['book_volumes'].append(len(offsets['volume_chapters']) - 1)
+			offsets['book_catalogues'].append(write_blob('catalogues', _json_bytes(build_book_catalogue(book))))
+
+			books.append({
+				'book_file': os.path.basename(book_path),
+				'size': stat.st_size,
+				'mtime': stat.st_mtime,
+				'digest': book_digest(data),
+			})
+			logging.debug(f"build《{book['title']}》, {len(books)}/{len(book_files)}...")
+
+		data_offset = 0
+		layout = {}
+		for name in ARRAYS:
+			layout[name] = [data_offset, len(offsets[name])]
+			data_offset += len(offsets[name]) * 8
+		for name in BLOBS:
+			layout[name] = [data_offset, blob_sizes[name]]
+			data_offset += blob_sizes[name]
+		header = json.dumps({
+			'books_path': os.path.abspath(books_path),
+			'books': books,
+			'layout': layout,
+		}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+		fd, temp_path = tempfile.mkstemp(dir = corpus_dir, prefix = '.corpus_')
+		try:
+			with os.fdopen(fd, 'wb') as file:
+				file.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+				file.write(header)
+				file.write(b'\0' * (_aligned(PREFIX.size + len(header)) - PREFIX.size - len(header)))
+				for name in ARRAYS:
+					file.write(_array_bytes(offsets[name]))
+				for name in BLOBS:
+					blob_files[name].seek(0)
+					shutil.copyfileobj(blob_files[name], file)
+			# mkstemp创建的文件只有所有者可读写，改为按照umask创建普通文件的权限
+			umask = os.umask(0)
+			os.umask(umask)
+			os.chmod(temp_path, 0o666 & ~umask)
+			os.replace(temp_path, corpus_path)
+		except BaseException:
+			os.unlink(temp_path)
+			raise
+	finally:
+		for blob_file in blob_files.values():
+			blob_file.close()
+
+	logging.info(f"build {corpus_path} suceessed, {len(books)} books, {blob_sizes['text']} bytes of text in {time.perf_counter() - begin:.1f}s...")
+	return len(books)
+
+def is_corpus(path):
+	"""
+	判断path是否是compact corpus文件。
+	"""
+	try:
+		with open(path, 'rb') as file:
+			return file.read(len(MAGIC)) == MAGIC
+	except OSError:
+		return False
+
+class BookCorpus(object):
+	"""
+	用mmap只读打开的compact corpus，可以被多个线程同时使用。
+	"""
+	def __init__(self, corpus_path):
+		"""
+		打开compact corpus文件。
+
+		:param corpus_path: corpus文件路径。
+		"""
+		self.corpus_path = corpus_path
+		with open(corpus_path, 'rb') as file:
+			self._mmap = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+			stat = os.fstat(file.fileno())
+		# 打开时corpus文件的大小和修改时间，用于检查corpus文件是否被替换
+		self.file_size = stat.st_size
+		self.file_mtime = stat.st_mtime
+		try:
+			magic, version, header_size = PREFIX.unpack_from(self._mmap, 0)
+			if magic != MAGIC or version != VERSION:
+				raise ValueError(f"{corpus_path} is not a book corpus of version {VERSION}.")
+			header = json.loads(self._mmap[PREFIX.size : PREFIX.size + header_size].decode('utf-8'))
+		except Exception:
+			self._mmap.close()
+			raise
+
+		self.books_path = header['books_path']
+		self.books = header['books']
+		data_offset = _aligned(PREFIX.size + header_size)
+		layout = header['layout']
+		for name in ARRAYS:
+			offset, count = layout[name]
+			begin = data_offset + offset
+			if sys.byteorder == 'little':
+				values = memoryview(self._mmap)[begin : begin + count * 8].cast('Q')
+			else:
+				values = array('Q', self._mmap[begin : begin + count * 8])
+				values.byteswap()
+			setattr(self, '_' + name, values)
+		for name in BLOBS:
+			setattr(self, f"_{name}_begin", data_offset + layout[name][0])
+
+	def __len__(self):
+		return len(self.books)
+
+	def close(self):
+		"""
+		关闭mmap，之后不能再读取段落内容。
+		"""
+		for name in ARRAYS:
+			values = getattr(self, '_' + name)
+			if isinstance(values, memoryview):
+				values.release()
+		self._mmap.close()
+
+	def book_path(self, book_no):
+		"""
+		获取书籍的源文件路径，用作书籍索引项的book_path。
+		"""
+		return os.path.join(self.books_path, self.books[book_no]['book_file'])
+
+	def catalogue(self, book_no):
+		"""
+		解码书籍目录，每次调用都生成新的对象。
+
+		:param book_no: 书籍在corpus中的序号。
+		:return: dict, 书籍目录，见build_book_catalogue。
+		"""
+		offsets = self._book_catalogues
+		begin = self._catalogues_begin
+		return json.loads(self._mmap[begin + offsets[book_no] : begin + offsets[book_no + 1]].decode('utf-8'))
+
+	def paragraph_extra(self, pid):
+		"""
+		解码段落除content以外的属性（如annotations）。
+
+		:param pid: 段落在整个corpus中的序号。
+		:return: dict, 段落的其它属性，没有时为None。
+		"""
+		offsets = self._paragraph_extras
+		if offsets[pid] == offsets[pid + 1]:
+			return None
+		begin = self._extras_begin
+		return json.loads(self._mmap[begin + offsets[pid] : begin + offsets[pid + 1]].decode('utf-8'))
+
+	def paragraph_content(self, pid):
+		"""
+		获取段落内容。
+
+		:param pid: 段落在整个corpus中的序号。
+		:return: string, 段落内容。
+		"""
+		offsets = self._paragraph_offsets
+		begin = self._text_begin
+		return self._mmap[begin + offsets[pid] : begin + offsets[pid + 1]].decode('utf-8')
+
+	def iter_paragraphs(self, book_no):
+		"""
+		依次输出书籍的段落内容，不生成段落对象。
+
+		:param book_no: 书籍在corpus中的序号。
+		:return: generator, 依次输出(卷序号, 章节序号, 段落内容)。
+		"""
+		text = self._mmap
+		begin = self._text_begin
+		offsets = self._paragraph_offsets
+		volume_chapters = self._volume_chapters
+		chapter_paragraphs = self._chapter_paragraphs
+		volumes_begin = self._book_volumes[book_no]
+		for vno in range(self._book_volumes[book_no + 1] - volumes_begin):
+			volume_no = volumes_begin + vno
+			chapters_begin = volume_chapters[volume_no]
+			for cno in range(volume_chapters[volume_no + 1] - chapters_begin):
+				chapter_no = chapters_begin + cno
+				for pid in range(chapter_paragraphs[chapter_no], chapter_paragraphs[chapter_no + 1]):
+					yield vno, cno, text[begin + offsets[pid] : begin + offsets[pid + 1]].decode('utf-8')
+
+	def load_paragraphs(self, book_no, vno, cno, start = 0, stop = None):
+		"""
+		生成一个章节的段落对象，只生成[start, stop)范围内的段落。
+
+		:param start: 第一个段落在章节中的序号。
+		:param stop: 最后一个段落之后的段落在章节中的序号，None表示到章节结束。
+		:return: list, 段落对象，与书籍json文件中的段落相同。
+		"""
+		volume_no = self._book_volumes[book_no] + vno
+		chapter_no = self._volume_chapters[volume_no] + cno
+		chapter_begin = self._chapter_paragraphs[chapter_no]
+		chapter_end = self._chapter_paragraphs[chapter_no + 1]
+		begin, end, _ = slice(start, stop).indices(chapter_end - chapter_begin)
+		paragraphs = []
+		for pid in range(chapter_begin + begin, chapter_begin + end):
+			paragraph = {"content": self.paragraph_content(pid)}
+			extra = self.paragraph_extra(pid)
+			if extra:
+				paragraph.update(extra)
+			paragraphs.append(paragraph)
+		return paragraphs
+
+	def load_chapter(self, book_no, vno, cno, catalogue = None):
+		"""
+		生成一个章节对象，与书籍json文件中的章节相同。
+
+		:param catalogue: 书籍目录，None时从corpus中解码。
+		"""
+		if catalogue is None:
+			catalogue = self.catalogue(book_no)
+		chapter = dict(catalogue["volumes"][vno]["chapters"][cno])
+		chapter.pop("paragraphs_count", None)
+		chapter["paragraphs"] = self.load_paragraphs(book_no, vno, cno)
+		return chapter
+
+	def load_book(self, book_no, catalogue = None):
+		"""
+		生成书籍对象，与书籍json文件解码后的对象相同。
+
+		:param catalogue: 书籍目录，None时从corpus中解码。
+		"""
+		if catalogue is None:
+			catalogue = self.catalogue(book_no)
+		book = dict(catalogue)
+		volumes = []
+		for vno, volume in enumerate(book["volumes"]):
+			volume = dict(volume)
+			volume["chapters"] = [self.load_chapter(book_no, vno, cno, catalogue) for cno in range(len(volume["chapters"]))]
+			volumes.append(volume)
+		book["volumes"] = volumes
+		return book
+
+def load_corpus_book_index(corpus, book_no, load = True, index = False):
+	"""
+	生成compact corpus中一本书的索引项，见book_manager.load_book_index。
+	书籍目录直接从corpus中解码，查找表由书籍目录生成，只有load或者index为True时才生成书籍对象。
+
+	:param corpus: BookCorpus对象。
+	:param book_no: 书籍在corpus中的序号。
+	:param load: 是否在索引项的content中保存书籍内容。
+	:param index: 是否为书籍建立BookTextIndex。
+	:return: dict, 书籍的索引项，另外包含corpus和corpus_no。
+	"""
+	begin = time.perf_counter()
+	catalogue = corpus.catalogue(book_no)
+	book = corpus.load_book(book_no, catalogue) if load or index else None
+	return {
+		'title': catalogue["title"],
+		'book_path': corpus.book_path(book_no),
+		'size': corpus.books[book_no]['size'],
+		'mtime': corpus.books[book_no]['mtime'],
+		'digest': corpus.books[book_no]['digest'],
+		'content': book if load == True else None,
+		'lookup': build_book_lookup(catalogue),
+		'sort_key': title_sort_key(catalogue["title"]),
+		'catalogue': catalogue,
+		'text_index': BookTextIndex(book) if index else None,
+		'corpus': corpus,
+		'corpus_no': book_no,
+		'load_time': time.perf_counter() - begin,
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description = "book corpus tools.")
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	build_parser = subparsers.add_parser('build', help = "convert the *.json books to a compact corpus file.")
+	build_parser.add_argument('books_path', help = "the directory of the *.json books.")
+	build_parser.add_argument('corpus_path', help = "the corpus file to write.")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
+	if args.command == 'build':
+		build_corpus(args.books_path, args.corpus_path)
+
+if __name__ == "__main__":
+	main()
@@ -4,10 +4,21 @@
 
 import os
 import re
+import sys
 import json
+import time
+import bisect
+import asyncio
+import hashlib
+import functools
 import concurrent.futures
 import logging
-import copy
+import threading
+from array import array
+from collections import OrderedDict
+
+from book_snapshot import read_snapshot, write_snapshot, snapshot_book_index
+from book_metadata import BookMetaIndex
 
 #logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
 #logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
@@ -21,51 +32,392 @@ class BookManager(object):
 	"""
 	QUERY_THREAD_NUM = 10
 	QUERY_MAX_RESULT_NUM = 10
-
-	def __init__(self, books_path, load = True):
+	# get_book_paragraphs缺省返回的段落数
+	PARAGRAPH_PAGE_SIZE = 50
+	# search_page没有搜索完所有书籍时结果总数的计算方式：精确统计；估算
+	COUNT_EXACT = 'exact'
+	COUNT_ESTIMATE = 'estimate'
+	# 搜索方式：逐段扫描；有索引时使用索引，否则逐段扫描；同时使用两种方式并比较结果
+	SEARCH_SCAN = 'scan'
+	SEARCH_INDEX = 'index'
+	SEARCH_VERIFY = 'verify'
+	# 加载书库时解码书籍文件的缺省进程数
+	LOAD_PROCESS_NUM = os.cpu_count() or 1
+	# 缺省的搜索进程数，0表示在当前进程中用多线程搜索
+	SEARCH_PROCESS_NUM = 0
+	# load=False时，已解码书籍缓存的缺省容量，按书籍json文件字节数计算
+	BOOK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+	# load=False时，已解码书籍缓存的缺省容量，按书籍数量计算，None表示不限制
+	BOOK_CACHE_MAX_NUM = None
+	# 查询结果缓存的缺省容量，按估算的结果字节数计算，0表示不缓存查询结果
+	RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+	# json编码的章节、目录、内容缓存的缺省容量，按编码后的字节数计算，0表示不缓存
+	JSON_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+	def __init__(self, books_path, load = True, cache_bytes = None, cache_books = None, load_workers = None, search_index = False, search_processes = None, book_files = None, result_cache_bytes = None, snapshot_path = None, watch_interval = None, json_cache_bytes = None):
 		"""
 		The function initializes an object and loads books from a specified path.
 		
-		:param books_path: The path to the directory where the books are stored
+		:param books_path: The path to the directory where the books are stored, or the path of a compact
+		corpus file built by `book_corpus.py`
 		:param load: The `load` parameter is a boolean value that determines whether or not to load the
 		books from the specified `books_path`. If `load` is set to `True`, the books will be loaded to memory. If
 		`load` is set to `False`, the books will not be loaded to memory, defaults to True (optional)
+		:param cache_bytes: Only used when `load` is `False`. The budget of the parsed book cache, measured
+		in bytes of the book json files, defaults to `BOOK_CACHE_MAX_BYTES` (optional)
+		:param cache_books: Only used when `load` is `False`. The budget of the parsed book cache, measured
+		in number of books, defaults to `BOOK_CACHE_MAX_NUM` (optional)
+		:param load_workers: The number of processes used to decode the book files, defaults to
+		`LOAD_PROCESS_NUM` (optional)
+		:param search_index: Whether to build a `BookTextIndex` for every book at load time. `search_all`
+		uses the indexes when they are present, defaults to False (optional)
+		:param search_processes: The number of long-lived processes that `search_all` uses, each one loads
+		and searches a shard of the library. With search processes the books are searched out of this
+		process, so `load` can be `False` and `search_index` is built by the search processes only. 0 means
+		searching with threads in this process, defaults to `SEARCH_PROCESS_NUM` (optional)
+		:param book_files: The book files to load instead of all `*.json` files in `books_path` (optional)
+		:param result_cache_bytes: The budget of the query result cache used by `search_all` and
+		`search_page`, measured in estimated bytes of the results. 0 disables the cache, defaults to
+		`RESULT_CACHE_MAX_BYTES` (optional)
+		:param snapshot_path: The snapshot file used to warm start `load_books`. Every search process keeps
+		its own snapshot named after it with the search process number as suffix (optional)
+		:param watch_interval: The interval in seconds to check the book files for changes. The changed
+		books are reloaded by `reload_books` in a background thread. None disables the check (optional)
+		:param json_cache_bytes: The budget of the cache of UTF-8 json encoded chapters, catalogues and
+		contents returned by the `*_json` methods, measured in encoded bytes. 0 disables the cache,
+		defaults to `JSON_CACHE_MAX_BYTES` (optional)
 		"""
-		self.load_books(books_path, load = load)
-
-	def load_books(self, books_path, load = True):
+		self.book_cache = LRUCache(
+			max_bytes = cache_bytes if cache_bytes is not None else self.BOOK_CACHE_MAX_BYTES,
+			max_items = cache_books if cache_books is not None else self.BOOK_CACHE_MAX_NUM)
+		result_cache_bytes = result_cache_bytes if result_cache_bytes is not None else self.RESULT_CACHE_MAX_BYTES
+		self.result_cache = LRUCache(max_bytes = result_cache_bytes) if result_cache_bytes > 0 else None
+		json_cache_bytes = json_cache_bytes if json_cache_bytes is not None else self.JSON_CACHE_MAX_BYTES
+		self.json_cache = LRUCache(max_bytes = json_cache_bytes) if json_cache_bytes > 0 else None
+		# 每次替换书籍索引项时加一，替换前开始的搜索不会把结果放入result_cache
+		self.books_version = 0
+		self.books_index = []
+		self.books_title_map = {}
+		self.books_meta = BookMetaIndex(self.books_index)
+		self.corpus = None
+		self._reload_lock = threading.RLock()
+		self.search_processes = search_processes if search_processes is not None else self.SEARCH_PROCESS_NUM
+		self.search_engine = None
+		self.load_books(books_path, load = load, workers = load_workers, index = search_index and not self.search_processes, book_files = book_files, snapshot_path = snapshot_path)
+		if self.search_processes:
+			from book_search_process import ProcessSearchEngine
+			self.search_engine = ProcessSearchEngine(books_path, self.books_index, self.search_processes, index = search_index, snapshot_path = snapshot_path)
+		self.watcher = None
+		if watch_interval:
+			from book_watcher import BookWatcher
+			self.watcher = BookWatcher(self, watch_interval)
+			self.watcher.start()
+
+	def close(self):
+		"""
+		The function `close` stops the book watcher and the search processes, if any.
+		"""
+		if self.watcher is not None:
+			self.watcher.stop()
+			self.watcher = None
+		if self.search_engine is not None:
+			self.search_engine.close()
+			self.search_engine = None
+
+	def load_books(self, books_path, load = True, workers = None, index = False, book_files = None, snapshot_path = None):
 		"""
 		The function `load_books` loads books from a specified path, creates an index of the books, and
 		optionally loads the content of the books.
 		
 		:param books_path: The `books_path` parameter is the path to the directory where the books are
-		stored
+		stored. If it is a compact corpus file (see `book_corpus.py`), the books are served from the memory
+		mapped corpus and the paragraphs of the books that are not loaded are read on demand
 		:param load: The `load` parameter is a boolean flag that determines whether the book content should
 		be loaded or not. If `load` is set to `True`, the book content will be loaded and stored in the
 		`content` field of the `books_index` list. If `load` is set to, defaults to True (optional)
+		:param workers: The number of processes used to decode the book files. The order of `books_index`
+		does not depend on it. If it is 1, the books are decoded in the current process, defaults to
+		`LOAD_PROCESS_NUM` (optional)
+		:param index: Whether to build a `BookTextIndex` for every book, defaults to False (optional)
+		:param book_files: The book files to load instead of all `*.json` files in `books_path`. For a corpus,
+		the `book_path` of the books to load (optional)
+		:param snapshot_path: The snapshot file of the derived structures in `books_index` (see
+		`book_snapshot.py`). The books whose files have the same size and mtime as in the snapshot reuse
+		the snapshot, the others are rebuilt, and the snapshot is rewritten if anything was rebuilt (optional)
 		:return: The function does not explicitly return anything.
 		"""
-		self.books_path = books_path
-		self.books_index = []
+		with self._reload_lock:
+			self.books_path = books_path
+			self.load = load
+			self.index = index
+			self.book_files = list(book_files) if book_files is not None else None
+			self.snapshot_path = snapshot_path
+			self._failed_books = {}
+
+			if os.path.isfile(books_path):
+				corpus, books_index = self.__load_corpus(books_path, load, index, book_files, snapshot_path)
+			else:
+				corpus, books_index = None, self.__load_files(books_path, load, workers, index, book_files, snapshot_path)
+			self.book_cache.clear()
+			if self.json_cache is not None:
+				self.json_cache.clear()
+			self.__swap_books(books_index, corpus)
+
+	def __swap_books(self, books_index, corpus=None):
+		"""
+		用新的书籍索引项替换books_index、books_title_map和books_meta，并使查询结果缓存失效。
+		书籍索引项生成以后不再修改，正在执行的请求继续使用替换前的书籍索引项，旧corpus的mmap在这些请求结束后随对象释放。
+		"""
+		books_title_map = {}
+		for book_index in books_index:
+			books_title_map.setdefault(book_index['title'], book_index)
+			_title_sort_keys.setdefault(book_index['title'], book_index['sort_key'])
+		books_meta = BookMetaIndex(books_index)
+		self.books_index, self.books_title_map, self.books_meta, self.corpus = books_index, books_title_map, books_meta, corpus
+		self.books_version += 1
+		if self.result_cache is not None:
+			self.result_cache.clear()
+
+	def __list_book_files(self, books_path):
+		"""
+		列出书库中所有的*.json书籍文件，按文件名排序。
 
-		filenames = []
+		:return: list, 书籍文件路径，书库不存在时返回None。
+		"""
 		try:
 			filenames = os.listdir(books_path)
 		except FileNotFoundError:
 			logging.error(f"load failed, please check {books_path}...")
-			return
-
+			return None
 		filenames.sort()
-		book_paths = [os.path.join(books_path, filename) for filename in filenames if filename.endswith(".json")]
+		return [os.path.join(books_path, filename) for filename in filenames if filename.endswith(".json")]
+
+	def __load_files(self, books_path, load, workers, index, book_files, snapshot_path):
+		"""
+		从书籍json文件加载书库，参数见load_books。
+
+		:return: list, 按照book_paths的顺序排列的书籍索引项。
+		"""
+		books_index = []
+		if book_files is not None:
+			book_paths = list(book_files)
+		else:
+			book_paths = self.__list_book_files(books_path)
+			if book_paths is None:
+				return books_index
+
+		load_begin = time.perf_counter()
+		snapshot = read_snapshot(snapshot_path) if snapshot_path else {}
+		# 快照中仍然有效的书籍索引项，load为False时这些书籍不需要读取书籍文件
+		reused = {}
+		if snapshot:
+			for book_path in book_paths:
+				try:
+					stat = os.stat(book_path)
+				except OSError:
+					continue
+				book_index = snapshot_book_index(snapshot, book_path, stat.st_size, stat.st_mtime, index)
+				if book_index is not None:
+					reused[book_path] = book_index
+		tasks = [book_path for book_path in book_paths if load or book_path not in reused]
+		derives = [book_path not in reused for book_path in tasks]
+		rebuilt = 0
+
+		workers = self.LOAD_PROCESS_NUM if workers is None else workers
+		workers = max(1, min(workers, len(tasks)))
+
+		def _add_book_index(order, book_index):
+			if book_index is None:
+				return
+			books_index.append(book_index)
+			logging.debug(f"load《{book_index['title']}》in {book_index['load_time']:.3f}s, {order}/{len(book_paths)}...")
+			if order % 100 == 0:
+				logging.info(f"load {order}/{len(book_paths)} books, {time.perf_counter() - load_begin:.1f}s...")
+
+		def _add_books_index(results):
+			nonlocal rebuilt
+			for order, book_path in enumerate(book_paths, 1):
+				book_index = reused.get(book_path)
+				if book_index is None:
+					book_index = next(results)
+					rebuilt += 1
+				elif load:
+					loaded = next(results)
+					if loaded is not None and loaded['size'] == book_index['size'] and loaded['mtime'] == book_index['mtime']:
+						book_index['content'] = loaded['content']
+						book_index['digest'] = loaded['digest']
+						book_index['load_time'] = loaded['load_time']
+					else:
+						# 书籍文件在检查快照之后又变化了
+						book_index = load_book_index(book_path, load, index)
+						rebuilt += 1
+				_add_book_index(order, book_index)
+
+		if workers > 1:
+			# 多进程方式，map保证结果按照tasks的顺序返回
+			with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+				chunksize = max(1, len(tasks) // (workers * 4))
+				# 子进程返回书籍文件的原始bytes，由主进程解码，见load_book_index
+				results = executor.map(load_book_index, tasks, [load] * len(tasks), [index] * len(tasks), derives, [True] * len(tasks), chunksize = chunksize)
+				_add_books_index(decode_book_content(book_index) for book_index in results)
+		else:
+			_add_books_index(load_book_index(book_path, load, index, derive) for book_path, derive in zip(tasks, derives))
+		logging.info(f"load suceessed, {len(books_index)} books from {books_path} in {time.perf_counter() - load_begin:.1f}s with {workers} processes, {len(reused)} books from snapshot...")
+
+		if snapshot_path and (rebuilt or len(reused) != len(snapshot)):
+			write_snapshot(snapshot_path, books_index, snapshot)
+		return books_index
+
+	def __load_corpus(self, corpus_path, load, index, book_files, snapshot_path):
+		"""
+		从compact corpus加载书库，参数见load_books。
+		书籍目录从corpus中解码（或者来自快照），查找表由书籍目录生成，不需要解码书籍，因此在当前进程中顺序加载。
+		书籍的大小和修改时间是生成corpus时书籍文件的大小和修改时间。
 
+		:return: tuple, (BookCorpus对象, 书籍索引项)，corpus打开失败时为(None, [])。
+		"""
+		from book_corpus import BookCorpus, load_corpus_book_index
+
+		load_begin = time.perf_counter()
+		try:
+			corpus = BookCorpus(corpus_path)
+		except (OSError, ValueError) as e:
+			logging.error(f"load failed, please check {corpus_path}: {e}")
+			return None, []
+
+		book_nos = range(len(corpus))
+		if book_files is not None:
+			book_files = set(book_files)
+			book_nos = [book_no for book_no in book_nos if corpus.book_path(book_no) in book_files]
+		snapshot = read_snapshot(snapshot_path) if snapshot_path else {}
+		books_index = []
+		reused = 0
+		for book_no in book_nos:
+			book = corpus.books[book_no]
+			book_index = snapshot_book_index(snapshot, corpus.book_path(book_no), book['size'], book['mtime'], index)
+			if book_index is not None:
+				book_index['corpus'] = corpus
+				book_index['corpus_no'] = book_no
+				if load:
+					book_index['content'] = corpus.load_book(book_no, book_index['catalogue'])
+				reused += 1
+			else:
+				book_index = load_corpus_book_index(corpus, book_no, load, index)
+			books_index.append(book_index)
+		logging.info(f"load suceessed, {len(books_index)} books from {corpus_path} in {time.perf_counter() - load_begin:.1f}s, {reused} books from snapshot...")
+
+		if snapshot_path and (reused != len(books_index) or reused != len(snapshot)):
+			write_snapshot(snapshot_path, books_index, snapshot)
+		return corpus, books_index
+
+	def reload_books(self, book_paths=None):
+		"""
+		检查书籍文件的变化，只重新加载新增和修改了的书籍，去掉已经删除了的书籍，其它书籍的索引项和缓存保持不变。
+		新的书籍索引项全部生成以后再一次替换，正在执行的请求继续使用替换前的书籍索引项。
+		书库是corpus时检查corpus文件的变化，变化后重新打开corpus，没有变化的书籍使用快照中的索引项。
+
+		:param book_paths: 要检查的书籍文件，缺省为整个书库（加载时指定了book_files时为这些书籍文件），
+			不在书库中的书籍文件加入书库。
+		:return: tuple, (新增或修改了的book_path列表, 删除了的book_path列表)。
+		"""
+		with self._reload_lock:
+			current = {book_index['book_path']: book_index for book_index in self.books_index}
+			if os.path.isfile(self.books_path):
+				changed, removed, books_index, corpus = self.__reload_corpus(current, book_paths)
+			else:
+				changed, removed, books_index = self.__reload_files(current, book_paths)
+				corpus = None
+			if books_index is None:
+				return [], []
+
+			for book_path in changed + removed:
+				self.book_cache.pop(book_path)
+			self.__swap_books(books_index, corpus)
+			if corpus is None and self.snapshot_path:
+				write_snapshot(self.snapshot_path, books_index)
+			if self.search_engine is not None:
+				changed_paths = set(changed)
+				self.search_engine.reload([book_index for book_index in books_index if book_index['book_path'] in changed_paths], removed)
+			logging.info(f"reload {len(changed)} books, remove {len(removed)} books from {self.books_path}...")
+			return changed, removed
+
+	def __reload_files(self, current, book_paths):
+		"""
+		重新加载变化了的书籍json文件，参数见reload_books。
+
+		:param current: book_path -> 当前的书籍索引项。
+		:return: tuple, (新增或修改了的book_path列表, 删除了的book_path列表, 新的书籍索引项)，没有变化时新的书籍索引项为None。
+		"""
+		if book_paths is None:
+			book_paths = self.book_files if self.book_files is not None else self.__list_book_files(self.books_path)
+			if book_paths is None:
+				return [], [], None
+		else:
+			book_paths = list(current) + [book_path for book_path in book_paths if book_path not in current]
+
+		changed = []
+		books = {}
 		for book_path in book_paths:
-			book = self.load_book_bypath(book_path)
-			if book is not None:
-				if load == True:
-					self.books_index.append({'title': book["title"], 'book_path': book_path, 'content': book})
-				else:
-					self.books_index.append({'title': book["title"], 'book_path': book_path, 'content': None})
-		logging.info(f"load suceessed, {len(self.books_index)} books from {books_path}...")
+			try:
+				stat = os.stat(book_path)
+			except OSError:
+				continue
+			book_index = current.get(book_path)
+			if book_index is None or book_index['size'] != stat.st_size or book_index['mtime'] != stat.st_mtime:
+				# 解码失败的书籍文件（比如正在写入），文件再次变化之前不再加载，继续使用旧的索引项
+				if self._failed_books.get(book_path) != (stat.st_size, stat.st_mtime):
+					loaded = load_book_index(book_path, self.load, self.index)
+					if loaded is not None:
+						book_index = loaded
+						changed.append(book_path)
+						self._failed_books.pop(book_path, None)
+					else:
+						self._failed_books[book_path] = (stat.st_size, stat.st_mtime)
+			if book_index is not None:
+				books[book_path] = book_index
+		removed = [book_path for book_path in current if book_path not in books]
+		if not changed and not removed:
+			return [], [], None
+
+		if self.book_files is None:
+			books_index = [books[book_path] for book_path in sorted(books)]
+		else:
+			self.book_files = [book_path for book_path in book_paths if book_path in books]
+			books_index = [books[book_path] for book_path in self.book_files]
+		return changed, removed, books_index
+
+	def __reload_corpus(self, current, book_paths):
+		"""
+		corpus文件变化了，或者要加入新的书籍时，重新打开corpus，参数见reload_books。
+
+		:param current: book_path -> 当前的书籍索引项。
+		:return: tuple, (新增或修改了的book_path列表, 删除了的book_path列表, 新的书籍索引项, 新的BookCorpus对象)，
+			不需要重新打开时新的书籍索引项和BookCorpus对象为None。
+		"""
+		try:
+			stat = os.stat(self.books_path)
+		except OSError:
+			return [], [], None, None
+		if book_paths is None and self.corpus is not None and (stat.st_size, stat.st_mtime) == (self.corpus.file_size, self.corpus.file_mtime):
+			return [], [], None, None
+
+		book_files = None
+		if self.book_files is not None:
+			book_files = list(current) + [book_path for book_path in book_paths or [] if book_path not in current]
+		corpus, books_index = self.__load_corpus(self.books_path, self.load, self.index, book_files, self.snapshot_path)
+		if corpus is None:
+			return [], [], None, None
+		if book_files is not None:
+			self.book_files = [book_index['book_path'] for book_index in books_index]
+
+		changed = []
+		for book_index in books_index:
+			old = current.get(book_index['book_path'])
+			if old is None or old['size'] != book_index['size'] or old['mtime'] != book_index['mtime']:
+				changed.append(book_index['book_path'])
+		new_paths = {book_index['book_path'] for book_index in books_index}
+		removed = [book_path for book_path in current if book_path not in new_paths]
+		return changed, removed, books_index, corpus
 
 	def load_book_bypath(self, book_path):
 		"""
@@ -90,11 +442,23 @@ class BookManager(object):
 		:param book_title: The parameter `book_title` is a string that represents the title of a book
 		:return: the book index that matches the given book title. If no match is found, it returns None.
 		"""
-		books_index = self.books_index
-		for book_index in books_index:
-			if book_title == book_index['title']:
-				return book_index
-		return None
+		return self.books_title_map.get(book_title)
+
+	def get_book_version(self, book_title):
+		"""
+		The function `get_book_version` returns a string that changes whenever the book is reloaded with
+		different content: the digest of the book file's bytes (see `book_digest`), computed when the
+		book is loaded. Touching or copying the file without changing its content keeps the version.
+		The responses derived from the book, such as its chapters and catalogue, do not change while
+		the version is the same.
+
+		:param book_title: The parameter `book_title` is a string that represents the title of a book
+		:return: the version string of the book, or None if the title is not found.
+		"""
+		book_index = self.get_index_bytitle(book_title)
+		if book_index is None:
+			return None
+		return book_index['digest']
 
 	def load_book_bytitle(self, book_title):
 		"""
@@ -108,10 +472,7 @@ class BookManager(object):
 		"""
 		book_index = self.get_index_bytitle(book_title)
 		if book_index is not None:
-			if book_index['content'] is not None:
-				return book_index['content']
-			else:
-				return self.load_book_bypath(book_index['book_path'])
+			return self.load_book_byindex(book_index)
 		return None
 	
 	def load_book_byindex(self, book_index):
@@ -120,15 +481,37 @@ class BookManager(object):
 		
 		:param book_index: The parameter `book_index` is a dictionary that contains information about a
 		book. It has two keys:
-		:return: the content of the book if it is not None. If the content is None, it is returning the
-		result of calling the `load_book_bypath` method with the book path from the `book_index` parameter.
+		:return: the content of the book if it is not None. If the content is None, the book is taken from
+		`book_cache`, or loaded by the `load_book_bypath` method (or from the corpus) and put into `book_cache`.
 		"""
 		if book_index['content'] is not None:
 			return book_index['content']
-		else:
-			return self.load_book_bypath(book_index['book_path'])
 
-	def search_all(self, query_string, search_book_string=None, limit=QUERY_MAX_RESULT_NUM):
+		book_path = book_index['book_path']
+		book = self.book_cache.get(book_path)
+		if book is None:
+			if book_index.get('corpus_no') is not None:
+				book = book_index['corpus'].load_book(book_index['corpus_no'], book_index['catalogue'])
+			else:
+				book = self.load_book_bypath(book_path)
+			if book is not None:
+				self.book_cache.put(book_path, book, size = book_index['size'])
+		return book
+
+	def get_cache_stats(self):
+		"""
+		获取各个缓存的命中、未命中及淘汰计数。
+
+		:return: dict, key为缓存名称，value为对应缓存的统计信息。
+		"""
+		stats = {'books': self.book_cache.stats()}
+		if self.json_cache is not None:
+			stats['json'] = self.json_cache.stats()
+		if self.result_cache is not None:
+			stats['results'] = self.result_cache.stats()
+		return stats
+
+	def search_all(self, query_string, search_book_string=None, limit=QUERY_MAX_RESULT_NUM, engine=None, count_only=False, control=None):
 		"""
 		The `search_all` function searches for a query string in book library and returns the
 		results.
@@ -136,94 +519,697 @@ class BookManager(object):
 		:param query_string: The query string is the string that you want to search for in the books. It
 		can be any text or keyword that you want to find in the books
 		:param search_book_string: The `search_book_string` parameter is used to filter the books to be
-		searched. It is a string that specifies the books to include or exclude from the search
+		searched. It is a string that specifies the books to include (`+title1,title2`) or exclude
+		(`-title1,title2`) from the search, or the metadata of the books to search, such as
+		`@date:先秦;category:经部` (see `book_metadata.py`)
 		:param limit: The `limit` parameter is used to specify the maximum number of search results to
 		return. By default, it is set to `QUERY_MAX_RESULT_NUM`, which is a constant value defined
 		elsewhere in the code. You can change the value of `limit` to control the number of search results
 		returned
-		:return: a QueryResults object.
+		:param engine: How to search every book, one of `SEARCH_SCAN`, `SEARCH_INDEX` and `SEARCH_VERIFY`.
+		`SEARCH_INDEX` uses the book's `BookTextIndex` if it is present and the query can be answered by it,
+		otherwise scans the book. `SEARCH_VERIFY` does both, logs the books whose hits differ and returns
+		the hits of scan, defaults to `SEARCH_INDEX` (optional)
+		:param count_only: Only count the hits per book, volume and chapter, without building the hit
+		strings. `limit` is ignored, see `search_facets`, defaults to False (optional)
+		:param control: A `SearchControl` to cancel the search or to stop it at a deadline. The books
+		searched before it stops are returned with `truncated` set, and are not cached. Ignored if
+		`count_only` is True (optional)
+		:return: a QueryResults object, or the dict returned by `search_facets` if `count_only` is True.
 		"""
+		if count_only:
+			return self.search_facets(query_string, search_book_string, engine)
 
-		def _search_byindex(book_index, query_object):
-			book = self.load_book_byindex(book_index)
-			logging.info(f"search in《{book['title']}》...")
-
-			pieces = None
-			pieces_count = 0
-			for volume in book["volumes"]:
-				_volume = None 
-				for chapter in volume["chapters"]:
-					_chapter = None
-					if (chapter.get("paragraphs")):
-						for paragraph in chapter["paragraphs"]:
-							content = paragraph["content"]
-							result = query_object.excute_query(content)
-							if result == True:
-								if pieces is None:
-									pieces = {'title': book["title"], 'description': book["description"], 'volumes': []}
-								if _volume is None:
-									_volume = {'title': volume["title"], 'chapters': []}
-									pieces['volumes'].append(_volume)
-								if _chapter is None:
-									_chapter = {'title': chapter["title"], '_hits': []}
-									_volume['chapters'].append(_chapter)
-								_chapter['_hits'].append(content)
-								pieces_count += 1
-
-			logging.debug(pieces)
-			return pieces, pieces_count
-		
 		query_object = QueryObject(query_string)
 		
-		# 通过search_book_string筛选出要搜索的search_books_index
-		search_books_index = []
-		if search_book_string is not None and len(search_book_string) > 0:
-			book_title_list = search_book_string[1:].split(",")
-			if search_book_string[0] == '+':
-				for book_title in book_title_list:
-					book_index = self.get_index_bytitle(book_title)
-					if book_index is not None:
-						search_books_index.append(book_index)
-			elif search_book_string[0] == '-':
-				for book_index in self.books_index:
-					if book_title in book_title_list:
-						logging.info(f"pass《{book_title}》...")
-						continue
-					else:
-						search_books_index.append(book_index)
-		else:
-			search_books_index = self.books_index
+		if self.result_cache is not None:
+			query_results = self._search_cached(query_object, search_book_string, engine, control)
+			return self._page_results(query_object, query_results, 0, limit)
+
+		query_results = self._search_all(query_object, search_book_string, engine, control)
+		if limit is not None:
+			query_results.limit(limit)
+		return query_results
+
+	def _search_all(self, query_object, search_book_string=None, engine=None, control=None):
+		"""
+		在所有要搜索的书籍中搜索，返回全部结果。
+
+		:param query_object: QueryObject对象。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param engine: 搜索方式，见search_all。
+		:param control: SearchControl对象，见search_all。
+		:return: a QueryResults object.
+		"""
+		search_books_index = self._select_books(search_book_string)
 
 		query_results = QueryResults(query_object)
 		query_results.query_target_count = len(search_books_index)
 
-    # 多线程方式
-		# 使用 ThreadPoolExecutor 对每个book的搜索启动一个线程进行处理
 		search_book_count = 0
 		total_pieces_count = 0
+		for _, pieces, pieces_count in self._iter_search_books(query_object, search_books_index, engine, control = control):
+			if pieces is not None:
+				query_results.add_result_pieces([pieces])
+				total_pieces_count += pieces_count
+				search_book_count = search_book_count + 1 if pieces_count > 0 else search_book_count
+		query_results.result_pieces_count = total_pieces_count
+		query_results.truncated = control is not None and control.truncated
+		return query_results
+
+	def _result_cache_key(self, query_object, search_book_string):
+		"""
+		查询结果缓存的key，由规范化的查询语句和要搜索的书籍组成。
+		"""
+		return query_object.normalize_query(), search_book_string or ''
+
+	def _search_cached(self, query_object, search_book_string=None, engine=None, control=None):
+		"""
+		从result_cache获取全部结果，未命中时搜索并放入result_cache，被取消或者超时的部分结果不放入。
+		返回的QueryResults是缓存中的对象，调用者不能修改，需要用_page_results复制。
+
+		:return: a QueryResults object.
+		"""
+		key = self._result_cache_key(query_object, search_book_string)
+		query_results = self.result_cache.get(key)
+		if query_results is None:
+			books_version = self.books_version
+			query_results = self._search_all(query_object, search_book_string, engine, control)
+			if not query_results.truncated:
+				self._put_cached(key, query_results, books_version)
+		return query_results
+
+	def _put_cached(self, key, query_results, books_version):
+		"""
+		将全部结果放入result_cache，搜索期间重新加载了书库时不放入。
+		"""
+		if books_version != self.books_version:
+			return
+		# 结果中的段落可能和书籍共用同一个字符串，按照不共用估算，每条结果另加结构的开销
+		size = 0
+		for book in query_results.result_pieces:
+			for volume in book['volumes']:
+				for chapter in volume['chapters']:
+					size += sum(sys.getsizeof(hit) for hit in chapter['_hits']) + 44 * len(chapter['_hits']) + 256
+		self.result_cache.put(key, query_results, size = size)
+
+	def _page_results(self, query_object, query_results, start=0, end=None):
+		"""
+		复制全部结果中从第start条到第end条的部分，调用者可以修改返回的结果（比如高亮）。
+
+		:param query_object: 本次搜索的QueryObject对象。
+		:param query_results: 全部结果。
+		:param start: 从第start条开始，包含第start条。
+		:param end: 到第end条结束，不包含第end条，None表示直到最后一条。
+		:return: a QueryResults object.
+		"""
+		page_results = QueryResults(query_object)
+		page_results.query_target_count = query_results.query_target_count
+		page_results.result_pieces_count = query_results.result_pieces_count
+		page_results.truncated = query_results.truncated
+		page = query_results.sub(start, end)
+		if page is not None:
+			page_results.add_result_pieces(page.result_pieces)
+		return page_results
+
+	def _select_books(self, search_book_string):
+		"""
+		通过search_book_string筛选出要搜索的书籍索引项。
+
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:return: list, 书籍索引项。
+		"""
+		books_meta = self.books_meta
+		return books_meta.books(books_meta.select(search_book_string))
+
+	def _search_book(self, book_index, query_object, engine=None, control=None):
+		"""
+		在一本书中搜索，返回按照书籍、卷、章节组织的搜索结果。
+		control被取消或者超时时抛出SearchStopped，逐段扫描时每个章节之前检查一次。
+
+		:param book_index: 书籍索引项。
+		:param query_object: QueryObject对象。
+		:param engine: 搜索方式，见search_all。
+		:param control: SearchControl对象，见search_all。
+		:return:
+			tuple: 包含两个元素的元组。
+			第一个元素，搜索结果，没有结果时为None；
+			第二个元素，搜索结果的段落数。
+		"""
+		logging.info(f"search in《{book_index['title']}》...")
+
+		if control is not None:
+			control.check()
+		hits = None
+		if engine != self.SEARCH_SCAN and book_index.get('text_index') is not None:
+			book = self.load_book_byindex(book_index)
+			hits = book_index['text_index'].search(book, book_index['lookup'], query_object)
+		if hits is None or engine == self.SEARCH_VERIFY:
+			scan_hits = self._scan_paragraphs(self._iter_book_paragraphs(book_index, control), query_object)
+			if hits is not None and hits != scan_hits:
+				logging.error(f"index search differs from scan in《{book_index['title']}》, query: {query_object.query_string}, index: {len(hits)}, scan: {len(scan_hits)}.")
+			hits = scan_hits
+
+		pieces = self._make_book_pieces(book_index['catalogue'], hits)
+		logging.debug(pieces)
+		return pieces, len(hits)
+
+	def _count_book(self, book_index, query_object, engine=None, control=None):
+		"""
+		统计一本书中符合查询条件的段落数，不生成搜索结果。
+		有索引时只需要计算段落编号集合。
+
+		:param book_index: 书籍索引项。
+		:param query_object: QueryObject对象。
+		:param engine: 搜索方式，见search_all。
+		:param control: SearchControl对象，见_search_book。
+		:return: int, 符合查询条件的段落数。
+		"""
+		if control is not None:
+			control.check()
+		if engine != self.SEARCH_SCAN and engine != self.SEARCH_VERIFY and book_index.get('text_index') is not None:
+			pids = book_index['text_index'].search_pids(self.load_book_byindex(book_index), book_index['lookup'], query_object)
+			if pids is not None:
+				return len(pids)
+
+		count = 0
+		for _, _, content in self._iter_book_paragraphs(book_index, control):
+			if query_object.excute_query(content) == True:
+				count += 1
+		return count
+
+	def _facet_book(self, book_index, query_object, engine=None):
+		"""
+		按卷、章节统计一本书中符合查询条件的段落数，不生成搜索结果。
+		有索引时只需要计算段落编号集合，由段落编号得到所在的章节。
+
+		:param book_index: 书籍索引项。
+		:param query_object: QueryObject对象。
+		:param engine: 搜索方式，见search_all。
+		:return:
+			tuple: 包含两个元素的元组。
+			第一个元素，按卷、章节组织的段落数，见_make_book_facets，没有结果时为None；
+			第二个元素，符合查询条件的段落数。
+		"""
+		chapter_counts = {}
+		pids = None
+		if engine != self.SEARCH_SCAN and engine != self.SEARCH_VERIFY and book_index.get('text_index') is not None:
+			text_index = book_index['text_index']
+			pids = text_index.search_pids(self.load_book_byindex(book_index), book_index['lookup'], query_object)
+			if pids is not None:
+				chapters_order = book_index['lookup']['chapters_order']
+				for pid in pids:
+					position = chapters_order[text_index.paragraph_position(pid)[0]]
+					chapter_counts[position] = chapter_counts.get(position, 0) + 1
+		if pids is None:
+			for vno, cno, content in self._iter_book_paragraphs(book_index):
+				if query_object.excute_query(content) == True:
+					chapter_counts[(vno, cno)] = chapter_counts.get((vno, cno), 0) + 1
+
+		facets = self._make_book_facets(book_index['catalogue'], chapter_counts)
+		return facets, facets['count'] if facets is not None else 0
+
+	def _make_book_facets(self, book, chapter_counts):
+		"""
+		将每个章节的段落数组织成书籍、卷、章节的结构。
+
+		:param book: 书籍对象或书籍目录。
+		:param chapter_counts: dict, (卷序号, 章节序号) -> 段落数。
+		:return: dict, {title, count, volumes: [{vno, title, count, chapters: [{cno, title, count}]}]}，
+			只包含有结果的卷和章节，chapter_counts为空时返回None。
+		"""
+		if not chapter_counts:
+			return None
+		facets = {'title': book["title"], 'count': 0, 'volumes': []}
+		_volume = None
+		for vno, cno in sorted(chapter_counts):
+			count = chapter_counts[(vno, cno)]
+			if _volume is None or _volume['vno'] != vno:
+				_volume = {'vno': vno, 'title': book["volumes"][vno]["title"], 'count': 0, 'chapters': []}
+				facets['volumes'].append(_volume)
+			_volume['chapters'].append({'cno': cno, 'title': book["volumes"][vno]["chapters"][cno]["title"], 'count': count})
+			_volume['count'] += count
+			facets['count'] += count
+		return facets
+
+	def _search_book_many(self, book_index, query_batch, engine=None, count_only=False):
+		"""
+		在一本书中同时执行多个查询，所有需要逐段扫描的查询共用一次扫描。
+		有索引时能用索引执行的查询使用索引，其余的查询逐段扫描。
+
+		:param book_index: 书籍索引项。
+		:param query_batch: QueryBatch对象。
+		:param engine: 搜索方式，见search_all。
+		:param count_only: 是否只按卷、章节统计段落数。
+		:return: list, 每个查询的(pieces, pieces_count)，pieces见_search_book，count_only为True时见_facet_book。
+		"""
+		logging.info(f"search {len(query_batch)} queries in《{book_index['title']}》...")
+
+		# 每个查询的(卷序号, 章节序号, 段落内容, 段落编号)列表
+		hits = [None] * len(query_batch)
+		if engine != self.SEARCH_SCAN and engine != self.SEARCH_VERIFY and book_index.get('text_index') is not None:
+			book = self.load_book_byindex(book_index)
+			text_index = book_index['text_index']
+			chapters_order = book_index['lookup']['chapters_order']
+			for index, query_object in enumerate(query_batch.query_objects):
+				if count_only:
+					pids = text_index.search_pids(book, book_index['lookup'], query_object)
+					if pids is not None:
+						hits[index] = [chapters_order[text_index.paragraph_position(pid)[0]] + (None, pid) for pid in pids]
+				else:
+					hits[index] = text_index.search(book, book_index['lookup'], query_object)
+
+		scans = {index for index, _hits in enumerate(hits) if _hits is None}
+		if scans:
+			for index in scans:
+				hits[index] = []
+			indexes = scans if len(scans) < len(query_batch) else None
+			for pid, (vno, cno, content) in enumerate(self._iter_book_paragraphs(book_index)):
+				for index in query_batch.match(content, indexes):
+					hits[index].append((vno, cno, content, pid))
+
+		results = []
+		for _hits in hits:
+			if count_only:
+				chapter_counts = {}
+				for vno, cno, _, _ in _hits:
+					chapter_counts[(vno, cno)] = chapter_counts.get((vno, cno), 0) + 1
+				results.append((self._make_book_facets(book_index['catalogue'], chapter_counts), len(_hits)))
+			else:
+				results.append((self._make_book_pieces(book_index['catalogue'], _hits), len(_hits)))
+		return results
+
+	def _iter_book_paragraphs(self, book_index, control=None):
+		"""
+		依次输出书籍的段落内容。
+		书籍来自corpus并且没有加载时，直接从corpus读取段落内容，不生成书籍对象。
+
+		:param book_index: 书籍索引项。
+		:param control: SearchControl对象，每个章节之前检查一次，被取消或者超时时抛出SearchStopped。
+		:return: iterator, 依次输出(卷序号, 章节序号, 段落内容)。
+		"""
+		if book_index['content'] is None and book_index.get('corpus_no') is not None:
+			book = self.book_cache.get(book_index['book_path'])
+			if book is None:
+				paragraphs = book_index['corpus'].iter_paragraphs(book_index['corpus_no'])
+				return paragraphs if control is None else control.iter_checked(paragraphs)
+		else:
+			book = self.load_book_byindex(book_index)
+		return iter_book_paragraphs(book) if control is None else control.iter_checked(iter_book_paragraphs(book))
+
+	def _iter_search_books(self, query_object, books_index, engine=None, count_only=False, facets=False, control=None):
+		"""
+		在给定的书籍中搜索，按照完成的顺序依次输出每本书的搜索结果。
+		有搜索进程时由搜索进程搜索，否则使用 ThreadPoolExecutor 对每个book的搜索启动一个线程进行处理。
+
+		:param query_object: QueryObject对象。
+		:param books_index: 要搜索的书籍索引项。
+		:param engine: 搜索方式，见search_all。
+		:param count_only: 是否只统计段落数，为True时pieces为None。
+		:param facets: 是否只按卷、章节统计段落数，为True时pieces为_facet_book的统计结果。
+		:param control: SearchControl对象，被取消或者超时后没有搜索完的书籍不再输出，facets为True时不使用。
+		:return: generator, 依次输出(书籍索引项, pieces, pieces_count)。
+		"""
+		if self.search_engine is not None:
+			# 多进程方式
+			yield from self.search_engine.search(query_object.query_string, books_index, engine, count_only = count_only, facets = facets, control = control)
+			return
+
+		def _search_byindex(book_index):
+			try:
+				if count_only:
+					return book_index, None, self._count_book(book_index, query_object, engine, control)
+				if facets:
+					return (book_index, ) + self._facet_book(book_index, query_object, engine)
+				return (book_index, ) + self._search_book(book_index, query_object, engine, control)
+			except SearchStopped:
+				return None
+
+    # 多线程方式
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self.QUERY_THREAD_NUM, thread_name_prefix='s_thread') as executor:
+			futures = [executor.submit(_search_byindex, book_index) for book_index in books_index]
+			try:
+				# 等待每个线程执行完毕
+				for future in concurrent.futures.as_completed(futures):
+					result = future.result()
+					if result is not None:
+						yield result
+			finally:
+				for future in futures:
+					future.cancel()
+
+	def _iter_search_many(self, query_batch, books_index, engine=None, count_only=False):
+		"""
+		在给定的书籍中同时执行多个查询，按照完成的顺序依次输出每本书的搜索结果，见_search_book_many。
+
+		:return: generator, 依次输出(书籍索引项, 每个查询的(pieces, pieces_count)列表)。
+		"""
+		if self.search_engine is not None:
+			# 多进程方式
+			queries = [query_object.query_string for query_object in query_batch.query_objects]
+			for book_index, results, _ in self.search_engine.search(queries, books_index, engine, count_only = count_only, batch = True):
+				yield book_index, results
+			return
+
+    # 多线程方式
 		with concurrent.futures.ThreadPoolExecutor(max_workers = self.QUERY_THREAD_NUM, thread_name_prefix='s_thread') as executor:
-			futures = [executor.submit(lambda p: _search_byindex(*p), (book_index, query_object)) for book_index in search_books_index]
-			# 等待每个线程执行完毕
-			for future in concurrent.futures.as_completed(futures):
-				pieces, pieces_count = future.result()
+			futures = {executor.submit(self._search_book_many, book_index, query_batch, engine, count_only): book_index for book_index in books_index}
+			try:
+				for future in concurrent.futures.as_completed(futures):
+					yield futures[future], future.result()
+			finally:
+				for future in futures:
+					future.cancel()
+
+	def _iter_search_ordered(self, query_object, books_index, engine=None, control=None):
+		"""
+		按照books_index的顺序依次输出每本书的搜索结果。
+		最多同时搜索QUERY_THREAD_NUM（有搜索进程时为搜索进程数的两倍）本书，调用者停止读取后不再搜索后面的书籍。
+		control被取消或者超时后，只输出到第一本没有搜索完的书籍之前。
+
+		:return: generator, 依次输出(书籍索引项, pieces, pieces_count)。
+		"""
+		window = self.search_processes * 2 if self.search_engine is not None else self.QUERY_THREAD_NUM
+		for begin in range(0, len(books_index), window):
+			batch = books_index[begin : begin + window]
+			results = {}
+			for book_index, pieces, pieces_count in self._iter_search_books(query_object, batch, engine, control = control):
+				results[id(book_index)] = (pieces, pieces_count)
+			for book_index in batch:
+				if id(book_index) not in results:
+					return
+				yield (book_index, ) + results[id(book_index)]
+
+	def iter_search(self, query_string, search_book_string=None, engine=None, ordered=True, control=None):
+		"""
+		逐本书搜索并输出每本书的搜索结果，调用者停止读取后不再搜索后面的书籍。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param engine: 搜索方式，见search_all。
+		:param ordered: 
+			True，按照最终结果的顺序（书名的中文拼音顺序）输出；
+			False，按照搜索完成的顺序输出，每本书搜索完成后立即输出。
+		:param control: SearchControl对象，被取消或者超时后不再输出，调用者可以由control.truncated判断是否输出了所有书籍。
+		:return: generator, 依次输出(order, 书籍索引项, pieces, pieces_count)，order为该书在最终结果中的顺序，
+			pieces为None时该书没有结果。
+		"""
+		query_object = QueryObject(query_string)
+		books_index = sorted(self._select_books(search_book_string), key=lambda book_index: book_index['sort_key'])
+		orders = {id(book_index): order for order, book_index in enumerate(books_index)}
+		if ordered:
+			search = self._iter_search_ordered(query_object, books_index, engine, control)
+		else:
+			search = self._iter_search_books(query_object, books_index, engine, control = control)
+		try:
+			for book_index, pieces, pieces_count in search:
+				yield orders[id(book_index)], book_index, pieces, pieces_count
+		finally:
+			search.close()
+
+	def count_all(self, query_string, search_book_string=None, engine=None):
+		"""
+		统计符合查询条件的段落总数，不生成搜索结果。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param engine: 搜索方式，见search_all。
+		:return: int, 符合查询条件的段落总数。
+		"""
+		query_object = QueryObject(query_string)
+		books_index = self._select_books(search_book_string)
+		return sum(pieces_count for _, _, pieces_count in self._iter_search_books(query_object, books_index, engine, count_only = True))
+
+	def search_facets(self, query_string, search_book_string=None, engine=None):
+		"""
+		按书籍、卷、章节统计符合查询条件的段落数，不生成搜索结果中的段落，也不高亮和排序段落。
+		有索引时直接由索引的段落编号统计，不需要读取段落内容。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param engine: 搜索方式，见search_all。
+		:return:
+			dict, 包含query_target_count（搜索的书籍数），result_pieces_count（段落总数），
+			result_facets（有结果的书籍按书名的中文拼音顺序排列的统计结果，见_make_book_facets）。
+		"""
+		query_object = QueryObject(query_string)
+		key = None
+		if self.result_cache is not None:
+			key = self._result_cache_key(query_object, search_book_string) + ('facets', )
+			results = self.result_cache.get(key)
+			if results is not None:
+				return results
+
+		books_version = self.books_version
+		books_index = self._select_books(search_book_string)
+		books_facets = []
+		total_pieces_count = 0
+		for book_index, facets, pieces_count in self._iter_search_books(query_object, books_index, engine, facets = True):
+			if facets is not None:
+				books_facets.append((book_index['sort_key'], facets))
+				total_pieces_count += pieces_count
+		books_facets.sort(key=lambda item: item[0])
+		results = {
+			'query_target_count': len(books_index),
+			'result_pieces_count': total_pieces_count,
+			'result_facets': [facets for _, facets in books_facets],
+		}
+		if key is not None and books_version == self.books_version:
+			size = sum(256 + 128 * sum(len(volume['chapters']) for volume in facets['volumes']) for facets in results['result_facets'])
+			self.result_cache.put(key, results, size = size)
+		return results
+
+	def search_many(self, query_strings, search_book_string=None, limit=QUERY_MAX_RESULT_NUM, engine=None, count_only=False):
+		"""
+		在同一批书籍中同时执行多个查询，每本书只扫描一次，所有查询的查询词用一个KeywordMatcher匹配，见QueryBatch。
+		总的时间接近一次扫描，而不是每个查询扫描一次。
+
+		:param query_strings: 查询语句列表。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param limit: 每个查询返回的结果数，None表示返回所有结果，count_only为True时忽略。
+		:param engine: 搜索方式，见search_all。
+		:param count_only: 是否只按书籍、卷、章节统计段落数，见search_facets。
+		:return: list, 按query_strings的顺序排列的每个查询的结果，QueryResults对象，count_only为True时为search_facets返回的dict。
+		"""
+		query_objects = [QueryObject(query_string) for query_string in query_strings]
+		query_batch = QueryBatch(query_objects)
+		books_index = self._select_books(search_book_string)
+
+		# 每个查询的(sort_key, pieces)列表和段落总数
+		books_pieces = [[] for _ in query_objects]
+		pieces_counts = [0] * len(query_objects)
+		for book_index, results in self._iter_search_many(query_batch, books_index, engine, count_only):
+			for index, (pieces, pieces_count) in enumerate(results):
 				if pieces is not None:
-					query_results.add_result_pieces([pieces]) # 非线程安全
-					total_pieces_count += pieces_count
-					search_book_count = search_book_count + 1 if pieces_count > 0 else search_book_count
-			
-		if limit is not None:
-			query_results.limit(limit)
+					books_pieces[index].append((book_index['sort_key'], pieces))
+					pieces_counts[index] += pieces_count
+
+		results = []
+		for query_object, _books_pieces, pieces_count in zip(query_objects, books_pieces, pieces_counts):
+			_books_pieces.sort(key=lambda item: item[0])
+			if count_only:
+				results.append({
+					'query_target_count': len(books_index),
+					'result_pieces_count': pieces_count,
+					'result_facets': [pieces for _, pieces in _books_pieces],
+				})
+				continue
+			query_results = QueryResults(query_object)
+			query_results.query_target_count = len(books_index)
+			query_results.add_result_pieces([pieces for _, pieces in _books_pieces])
+			query_results.result_pieces_count = pieces_count
+			if limit is not None:
+				query_results.limit(limit)
+			results.append(query_results)
+		return results
+
+	def search_page(self, query_string, search_book_string=None, start=0, count=QUERY_MAX_RESULT_NUM, total=COUNT_ESTIMATE, engine=None, control=None):
+		"""
+		搜索并返回第start条开始的count条结果。
+		按照最终结果的顺序逐本书搜索，得到start+count条结果后就停止搜索，第一页的响应时间只和页大小有关。
+		启用了result_cache时，同一查询的各页从缓存的全部结果中提取。只有调用者要求COUNT_EXACT（或者count为None）时
+		才需要搜索所有书籍，未命中时直接搜索全部结果并缓存；缺省的COUNT_ESTIMATE未命中时和不启用缓存一样得到start+count条结果后就停止，
+		只在搜索完所有书籍时缓存。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param start: 从第start条开始，包含第start条。
+		:param count: 返回的条数，None表示直到最后一条。
+		:param total: 
+			没有搜索完所有书籍时，结果总数的计算方式。
+			COUNT_ESTIMATE，缺省，按已搜索书籍的结果数和文件大小估算，result_pieces_count_estimated为True；
+			COUNT_EXACT，对剩下的书籍只统计段落数，启用了result_cache时搜索全部结果并缓存。
+		:param engine: 搜索方式，见search_all。
+		:param control: SearchControl对象，被取消或者超时时返回已经按顺序搜索完的书籍中的结果，
+			result_pieces_count为这些结果的条数，truncated为True。
+		:return: a QueryResults object.
+		"""
+		query_object = QueryObject(query_string)
+		start = start or 0
+		end = None if count is None else start + count
+
+		if self.result_cache is not None:
+			if total == self.COUNT_EXACT or end is None:
+				query_results = self._search_cached(query_object, search_book_string, engine, control)
+			else:
+				query_results = self.result_cache.get(self._result_cache_key(query_object, search_book_string))
+			if query_results is not None:
+				return self._page_results(query_object, query_results, start, end)
+
+		books_version = self.books_version
+		books_index = sorted(self._select_books(search_book_string), key=lambda book_index: book_index['sort_key'])
+
+		pieces_list = []
+		collected = 0
+		searched = 0
+		searched_size = 0
+		search = self._iter_search_ordered(query_object, books_index, engine, control)
+		try:
+			for book_index, pieces, pieces_count in search:
+				searched += 1
+				searched_size += book_index['size']
+				if pieces is not None:
+					pieces_list.append(pieces)
+					collected += pieces_count
+				if end is not None and collected >= end:
+					break
+		finally:
+			search.close()
+
+		query_results = QueryResults(query_object)
+		query_results.query_target_count = len(books_index)
+		if control is not None and control.truncated:
+			query_results.result_pieces_count = collected
+			query_results.truncated = True
+		elif searched == len(books_index):
+			query_results.result_pieces_count = collected
+			if self.result_cache is not None:
+				full_results = QueryResults(query_object)
+				full_results.query_target_count = len(books_index)
+				full_results.add_result_pieces(pieces_list)
+				full_results.result_pieces_count = collected
+				self._put_cached(self._result_cache_key(query_object, search_book_string), full_results, books_version)
+		elif total == self.COUNT_ESTIMATE:
+			total_size = sum(book_index['size'] for book_index in books_index)
+			query_results.result_pieces_count = round(collected * total_size / searched_size) if searched_size else collected
+			query_results.result_pieces_count_estimated = True
+		else:
+			rest = books_index[searched:]
+			query_results.result_pieces_count = collected + sum(pieces_count for _, _, pieces_count in self._iter_search_books(query_object, rest, engine, count_only = True, control = control))
+			if control is not None and control.truncated:
+				query_results.result_pieces_count = collected
+				query_results.truncated = True
+
+		collected_results = QueryResults(query_object)
+		collected_results.add_result_pieces(pieces_list)
+		page = collected_results.sub(start, end)
+		if page is not None:
+			query_results.add_result_pieces(page.result_pieces)
 		return query_results
 
+	async def search_async(self, query_string, search_book_string=None, start=0, count=QUERY_MAX_RESULT_NUM, total=COUNT_ESTIMATE, engine=None, timeout=None, executor=None):
+		"""
+		在asyncio中执行search_page。搜索在executor的线程中运行，不阻塞事件循环；
+		调用者的task被取消时（比如客户端断开连接）取消搜索，正在搜索的书籍在下一个章节之前停止。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:param start: 见search_page。
+		:param count: 见search_page。
+		:param total: 见search_page。
+		:param engine: 搜索方式，见search_all。
+		:param timeout: 搜索的时限，秒，超时后返回已经搜索完的部分结果，truncated为True，None表示不限制。
+		:param executor: 运行搜索的concurrent.futures.Executor，None表示使用事件循环缺省的executor。
+		:return: a QueryResults object.
+		"""
+		control = SearchControl(timeout)
+		future = asyncio.get_running_loop().run_in_executor(executor, functools.partial(
+			self.search_page, query_string, search_book_string, start, count, total, engine, control))
+		try:
+			# shield使取消只停止等待，搜索线程由control停止
+			return await asyncio.shield(future)
+		except asyncio.CancelledError:
+			control.cancel()
+			raise
+
+	def _scan_book(self, book, query_object):
+		"""
+		逐个段落执行查询，返回符合查询条件的段落。
+
+		:return: list, 按顺序排列的(卷序号, 章节序号, 段落内容, 段落编号)。
+		"""
+		return self._scan_paragraphs(iter_book_paragraphs(book), query_object)
+
+	def _scan_paragraphs(self, paragraphs, query_object):
+		"""
+		对依次输出的一本书的(卷序号, 章节序号, 段落内容)逐个执行查询，返回符合查询条件的段落。
+
+		:return: list, 按顺序排列的(卷序号, 章节序号, 段落内容, 段落编号)，段落编号见BookTextIndex。
+		"""
+		hits = []
+		for pid, (vno, cno, content) in enumerate(paragraphs):
+			result = query_object.excute_query(content)
+			if result == True:
+				hits.append((vno, cno, content, pid))
+		return hits
+
+	def _make_book_pieces(self, book, hits):
+		"""
+		将符合查询条件的段落组织成书籍、卷、章节的结构。
+
+		:param book: 书籍对象或书籍目录。
+		:param hits: 按顺序排列的(卷序号, 章节序号, 段落内容, 段落编号)。
+		:return: dict, 书籍的搜索结果，hits为空时返回None。章节的_pids是_hits中每个段落的段落编号，
+			可以用get_book_paragraphs获取段落前后的内容。
+		"""
+		pieces = None
+		_volume = None
+		_chapter = None
+		last_vno = None
+		last_cno = None
+		for vno, cno, content, pid in hits:
+			if pieces is None:
+				pieces = {'title': book["title"], 'description': book["description"], 'volumes': []}
+			if vno != last_vno:
+				_volume = {'title': book["volumes"][vno]["title"], 'chapters': []}
+				pieces['volumes'].append(_volume)
+				last_vno, last_cno = vno, None
+			if cno != last_cno:
+				_chapter = {'title': book["volumes"][vno]["chapters"][cno]["title"], '_hits': [], '_pids': []}
+				_volume['chapters'].append(_chapter)
+				last_cno = cno
+			_chapter['_hits'].append(content)
+			_chapter['_pids'].append(pid)
+		return pieces
+
+	def verify_search_index(self, query_string, search_book_string=None):
+		"""
+		对比使用索引搜索和逐段扫描搜索的结果。
+
+		:param query_string: 查询语句。
+		:param search_book_string: 要搜索的书籍，见search_all。
+		:return: list, 两种方式的搜索结果不一致的书名。
+		"""
+		query_object = QueryObject(query_string)
+		mismatches = []
+		for book_index in self._select_books(search_book_string):
+			if book_index.get('text_index') is None:
+				continue
+			book = self.load_book_byindex(book_index)
+			hits = book_index['text_index'].search(book, book_index['lookup'], query_object)
+			if hits is not None and hits != self._scan_book(book, query_object):
+				mismatches.append(book_index['title'])
+		return mismatches
+
 	def get_book_list(self, query_string):
 		query_object = QueryObject(query_string)
 		book_results = BookResults(query_object)
-		book_results.query_target_count = len(self.books_index) if(self.books_index) else 0
+		books_index = self.books_index
+		book_results.query_target_count = len(books_index) if(books_index) else 0
 
-		for book_index in self.books_index:
-			book = self.load_book_byindex(book_index)
-			if book is None:
-				continue
+		for book_index in books_index:
+			# 只需要书籍、卷、章节的名称，书籍目录中都有
+			book = book_index['catalogue']
 			
 			piece = None
 			if query_string is not None and len(query_string):
@@ -253,19 +1239,75 @@ class BookManager(object):
 		return book_results
 	
 	def get_book_catalogue(self, q):
+		"""
+		The function `get_book_catalogue` returns the catalogue of a book: the book with every chapter's
+		`paragraphs` set to None and `paragraphs_count` set to the number of its paragraphs.
+		The returned object is shared between calls and must not be modified.
+		
+		:param q: The title of the book
+		:return: the catalogue of the book, or None if the book is not found.
+		"""
 		book_index = self.get_index_bytitle(q)
 		if book_index is None:
 			logging.debug(f"can't find book: {q}.")
 			return None
 		
-		book = self.load_book_byindex(book_index)
-		_book = copy.deepcopy(book)
+		return book_index['catalogue']
 
-		for v in _book["volumes"]:
-			for c in v["chapters"]:
-				c["paragraphs"] = None
+	def _get_json(self, book_index, key, make):
+		"""
+		获取json编码的书籍内容，第一次请求时编码并放入json_cache。
+		json_cache的key包含书籍的版本，书籍重新加载以后旧版本的条目不会再命中，由LRU淘汰。
 
-		return _book
+		:param book_index: 书籍索引项。
+		:param key: 内容在书籍中的key，如('chapter', vno, cno)。
+		:param make: 生成内容对象的函数，找不到内容时返回None。
+		:return: bytes, UTF-8编码的json，找不到内容时返回None。
+		"""
+		if self.json_cache is not None:
+			key = (book_index['book_path'], book_index['size'], book_index['mtime']) + key
+			data = self.json_cache.get(key)
+			if data is not None:
+				return data
+		obj = make()
+		if obj is None:
+			return None
+		data = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+		if self.json_cache is not None:
+			self.json_cache.put(key, data, size = len(data))
+		return data
+
+	def get_book_catalogue_json(self, q):
+		"""
+		The function `get_book_catalogue_json` returns the catalogue of a book encoded as UTF-8 json. The
+		encoded catalogue is built on the first request and cached in `json_cache`.
+		
+		:param q: The title of the book
+		:return: bytes of the json encoded catalogue, or None if the book is not found.
+		"""
+		book_index = self.get_index_bytitle(q)
+		if book_index is None:
+			logging.debug(f"can't find book: {q}.")
+			return None
+		return self._get_json(book_index, ('catalogue', ), lambda: book_index['catalogue'])
+
+	def _chapter_position(self, book_index, vno, cno):
+		"""
+		检查章节序号，vno为None时cno为总章节序号。
+
+		:return: tuple, (卷序号, 章节序号)，章节不存在时返回None。
+		"""
+		lookup = book_index['lookup']
+		# 按照总章节排序返回章节内容
+		if vno is None:
+			if 0 <= cno < len(lookup['chapters_order']):
+				return lookup['chapters_order'][cno]
+			return None
+		# volume_chapters按章节名称去重，章节序号要在chapters_order中查找
+		order = bisect.bisect_left(lookup['chapters_order'], (vno, cno))
+		if order < len(lookup['chapters_order']) and lookup['chapters_order'][order] == (vno, cno):
+			return vno, cno
+		return None
 
 	def get_book_chapter(self, q, vno, cno):
 		book_index = self.get_index_bytitle(q)
@@ -275,28 +1317,132 @@ class BookManager(object):
 		if cno is None:
 			logging.debug(f"cno can't be None: {q}.")
 			return None
-		
+
+		position = self._chapter_position(book_index, vno, cno)
+		if position is None:
+			logging.debug(f"can't find chapter: {cno}.")
+			return None
+		return self._load_chapter(book_index, *position)
+
+	def _load_chapter(self, book_index, vno, cno):
+		"""
+		获取章节对象。书籍来自corpus并且没有加载时，只生成这一个章节。
+		"""
+		if book_index['content'] is None and book_index.get('corpus_no') is not None and book_index['book_path'] not in self.book_cache:
+			return book_index['corpus'].load_chapter(book_index['corpus_no'], vno, cno)
 		book = self.load_book_byindex(book_index)
-		order = 0
-		# 按照总章节排序返回章节内容
-		if vno is None:
-			for volume in book["volumes"]:
-				for chapter in volume["chapters"]:
-					if(order == cno):
-						return chapter
-					else:
-						order += 1
+		return book["volumes"][vno]["chapters"][cno]
+
+	def get_book_chapter_json(self, q, vno, cno):
+		"""
+		The function `get_book_chapter_json` returns the chapter returned by `get_book_chapter` encoded
+		as UTF-8 json. The encoded chapter is built on the first request and cached in `json_cache`, so
+		that a chapter can be served without walking and encoding the chapter again.
+
+		:param q: The title of the book
+		:param vno: The volume number, or None if `cno` is the chapter number in the whole book
+		:param cno: The chapter number
+		:return: bytes of the json encoded chapter, or None if the chapter is not found.
+		"""
+		book_index = self.get_index_bytitle(q)
+		if book_index is None:
+			logging.debug(f"can't find book: {q}.")
+			return None
+		if cno is None:
+			logging.debug(f"cno can't be None: {q}.")
+			return None
+
+		position = self._chapter_position(book_index, vno, cno)
+		if position is None:
 			logging.debug(f"can't find chapter: {cno}.")
+			return None
+		return self._get_json(book_index, ('chapter', ) + tuple(position), lambda: self._load_chapter(book_index, *position))
 
-		for indexv, volume in enumerate(book["volumes"]):
-			if(indexv == vno):
-				for indexc, chapter in enumerate(volume["chapters"]):
-					if(indexc == cno):
-						return chapter
-				break
-		logging.debug(f"can't find chapter: {cno}.")
+	def get_book_paragraphs(self, q, vno = None, cno = None, offset = 0, limit = PARAGRAPH_PAGE_SIZE, pid = None):
+		"""
+		The function `get_book_paragraphs` returns a range of paragraphs in a chapter, so that a long
+		chapter can be read page by page. The range is given by `offset` and `limit` within the chapter,
+		or by `pid`, the paragraph number in the whole book as returned in the `_pids` of the search
+		results, in which case the page containing the paragraph is returned and `vno`, `cno` and
+		`offset` are ignored. Only the paragraphs in the range are built when the book comes from a
+		corpus and is not loaded.
+
+		:param q: The title of the book
+		:param vno: The volume number, or None if `cno` is the chapter number in the whole book
+		:param cno: The chapter number
+		:param offset: The number of the first paragraph in the chapter
+		:param limit: The max number of paragraphs to return, None for all the remaining paragraphs
+		:param pid: The paragraph number in the whole book (optional)
+		:return: dict of the chapter position, the chapter title, the range and the paragraphs, or None
+		if the book, the chapter or the paragraph is not found.
+		"""
+		book_index = self.get_index_bytitle(q)
+		if book_index is None:
+			logging.debug(f"can't find book: {q}.")
+			return None
+		if limit is not None and limit < 0:
+			logging.debug(f"invalid limit: {limit}.")
+			return None
 
-		return None
+		lookup = book_index['lookup']
+		chapter_offsets = lookup['chapter_offsets']
+		if pid is not None:
+			if not 0 <= pid < chapter_offsets[-1]:
+				logging.debug(f"can't find paragraph: {pid}.")
+				return None
+			order = bisect.bisect_right(chapter_offsets, pid) - 1
+			vno, cno = lookup['chapters_order'][order]
+			offset = pid - chapter_offsets[order]
+			# 返回段落所在的一页
+			if limit:
+				offset -= offset % limit
+		else:
+			if cno is None:
+				logging.debug(f"cno can't be None: {q}.")
+				return None
+			position = self._chapter_position(book_index, vno, cno)
+			if position is None:
+				logging.debug(f"can't find chapter: {cno}.")
+				return None
+			vno, cno = position
+			# chapters_order按(卷序号, 章节序号)排序
+			order = bisect.bisect_left(lookup['chapters_order'], (vno, cno))
+			if offset is None or offset < 0:
+				offset = 0
+
+		count = chapter_offsets[order + 1] - chapter_offsets[order]
+		offset = min(offset, count)
+		stop = count if limit is None else min(offset + limit, count)
+		if book_index['content'] is None and book_index.get('corpus_no') is not None and book_index['book_path'] not in self.book_cache:
+			paragraphs = book_index['corpus'].load_paragraphs(book_index['corpus_no'], vno, cno, offset, stop)
+		else:
+			paragraphs = self.load_book_byindex(book_index)["volumes"][vno]["chapters"][cno]["paragraphs"][offset:stop]
+		return {
+			'vno': vno,
+			'cno': cno,
+			'title': book_index['catalogue']["volumes"][vno]["chapters"][cno]["title"],
+			'offset': offset,
+			'pid': chapter_offsets[order] + offset,
+			'paragraphs_count': count,
+			'paragraphs': paragraphs,
+		}
+
+	def get_book_content_json(self, q, v, c):
+		"""
+		The function `get_book_content_json` returns the content returned by `get_book_content` encoded
+		as UTF-8 json. The encoded content is built on the first request and cached in `json_cache`, the
+		content larger than the budget of `json_cache` is encoded on every request.
+
+		:param q: The title of the book
+		:param v: The title of the volume (optional)
+		:param c: The title of the chapter (optional)
+		:return: bytes of the json encoded content, or None if the content is not found.
+		"""
+		book_index = self.get_index_bytitle(q)
+		if book_index is None:
+			logging.debug(f"can't find book: {q}.")
+			return None
+		return self._get_json(book_index, ('content', v, c), lambda: self.get_book_content(q, v, c))
 
 	def get_book_content(self, q, v, c):
 		book_index = self.get_index_bytitle(q)
@@ -304,6 +1450,7 @@ class BookManager(object):
 			logging.debug(f"can't find book: {q}.")
 			return None
 		
+		lookup = book_index['lookup']
 		book = self.load_book_byindex(book_index)
 		# 只有书籍名称，返回同名书籍
 		if v is None and c is None:
@@ -311,46 +1458,487 @@ class BookManager(object):
 
 		# 找同名书籍的同名卷
 		if v is not None and c is None:
-			for volume in book["volumes"]:
-				# 找同名卷
-				if volume["title"] == v:
-					_book = {'title': book["title"], 'description': book["description"]}
-					_book["volumes"] = [volume]
-					return _book
+			vno = lookup['volumes'].get(v)
+			if vno is not None:
+				_book = {'title': book["title"], 'description': book["description"]}
+				_book["volumes"] = [book["volumes"][vno]]
+				return _book
 			# 找不到同名书籍中的同名卷，返回空
 			logging.debug(f"can't find volume: {v}.")
 			return None
 		
 		# 找同名书籍的同名章节
 		if v is None and c is not None:
-			for volume in book["volumes"]:
-				for chapter in volume["chapters"]:
-					if chapter["title"] == c:
-						_volume = {'title': volume["title"]}
-						_volume["chapters"] = [chapter]
-						_book = {'title': book["title"], 'description': book["description"]}
-						_book["volumes"] = [_volume]
-						return _book
-			logging.debug(f"can't find chapter: {c}.")								
-			return None
-		
+			position = lookup['chapters'].get(c)
+			if position is None:
+				logging.debug(f"can't find chapter: {c}.")
+				return None
+			vno, cno = position
 		# 找同名书籍的同名卷的同名章节
-		if v is not None and c is not None:
-			for volume in book["volumes"]:
-				if volume["title"] == v:
-					for chapter in volume["chapters"]:
-						if chapter["title"] == c:
-							_volume = {'title': volume["title"]}
-							_volume["chapters"] = [chapter]
-							_book = {'title': book["title"], 'description': book["description"]}
-							_book["volumes"] = [_volume]
-							return _book
-					else:
-						logging.debug(f"can't find chapter: {c}.")								
-						return None
-			logging.debug(f"can't find volume: {v}.")
-			return None
+		else:
+			vno = lookup['volumes'].get(v)
+			if vno is None:
+				logging.debug(f"can't find volume: {v}.")
+				return None
+			cno = lookup['volume_chapters'][vno].get(c)
+			if cno is None:
+				logging.debug(f"can't find chapter: {c}.")
+				return None
+
+		volume = book["volumes"][vno]
+		_volume = {'title': volume["title"]}
+		_volume["chapters"] = [volume["chapters"][cno]]
+		_book = {'title': book["title"], 'description': book["description"]}
+		_book["volumes"] = [_volume]
+		return _book
+
+def load_book_index(book_path, load = True, index = False, derive = True, encoded = False):
+	"""
+	加载并解码书籍文件，生成书籍的索引项。
+	本函数可以在子进程中执行，因此只依赖于参数，不访问BookManager对象。
+	在子进程中执行时encoded为True，content为书籍文件的原始bytes：传回主进程的只是一个bytes对象，
+	主进程用decode_book_content解码，json解码比反序列化pickle的嵌套dict快得多。
+
+	:param book_path: 书籍文件路径。
+	:param load: 是否在索引项的content中保存书籍内容。
+	:param index: 是否为书籍建立BookTextIndex。
+	:param derive: 是否生成lookup、catalogue等派生结构，为False时索引项只包含title, book_path, size, mtime, digest, content, load_time，
+		用于派生结构来自快照的书籍。
+	:param encoded: 是否在content中保存书籍文件的原始bytes而不是书籍对象，见decode_book_content。
+	:return:
+		dict, 书籍的索引项，包含title, book_path, size, mtime, digest, content, sort_key, lookup, catalogue, text_index, load_time，
+		digest为书籍文件内容的摘要，见book_digest；
+		书籍文件读取或解码失败时返回None。
+	"""
+	begin = time.perf_counter()
+	try:
+		with open(book_path, 'rb') as file:
+			data = file.read()
+			stat = os.fstat(file.fileno())
+		book = json.loads(data)
+	except (OSError, ValueError) as e:
+		logging.error(f"load {book_path} failed: {e}")
 		return None
+	content = (data if encoded else book) if load == True else None
+
+	if not derive:
+		return {
+			'title': book["title"],
+			'book_path': book_path,
+			'size': stat.st_size,
+			'mtime': stat.st_mtime,
+			'digest': book_digest(data),
+			'content': content,
+			'load_time': time.perf_counter() - begin,
+		}
+	return {
+		'title': book["title"],
+		'book_path': book_path,
+		'size': stat.st_size,
+		'mtime': stat.st_mtime,
+		'digest': book_digest(data),
+		'content': content,
+		'lookup': build_book_lookup(book),
+		'sort_key': title_sort_key(book["title"]),
+		'catalogue': build_book_catalogue(book),
+		'text_index': BookTextIndex(book) if index else None,
+		'load_time': time.perf_counter() - begin,
+	}
+
+def book_digest(data):
+	"""
+	计算书籍文件内容的摘要，作为书籍的版本（见BookManager.get_book_version）。
+
+	:param data: bytes, 书籍文件的内容。
+	:return: string, 十六进制的摘要。
+	"""
+	return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def decode_book_content(book_index):
+	"""
+	解码load_book_index(encoded=True)返回的书籍内容，在主进程中调用。
+
+	:param book_index: 书籍索引项，content为bytes时替换为书籍对象。
+	:return: 书籍索引项。
+	"""
+	if book_index is not None and isinstance(book_index['content'], bytes):
+		book_index['content'] = json.loads(book_index['content'])
+	return book_index
+
+def iter_book_paragraphs(book):
+	"""
+	依次输出书籍的段落内容。
+
+	:param book: 书籍对象。
+	:return: generator, 依次输出(卷序号, 章节序号, 段落内容)。
+	"""
+	for vno, volume in enumerate(book["volumes"]):
+		for cno, chapter in enumerate(volume["chapters"]):
+			for paragraph in chapter.get("paragraphs") or []:
+				yield vno, cno, paragraph["content"]
+
+def build_book_lookup(book):
+	"""
+	为书籍建立卷、章节的查找表，同名的卷或章节以第一个出现的为准。
+
+	:param book: 书籍对象。
+	:return:
+		dict, 包含以下查找表：
+		volumes，卷名 -> 卷序号；
+		chapters，章节名 -> (卷序号, 章节序号)；
+		volume_chapters，按卷序号排列的 章节名 -> 章节序号；
+		chapters_order，按总章节排序的 (卷序号, 章节序号)；
+		chapter_offsets，按总章节排序的每个章节第一个段落的段落编号（见BookTextIndex），最后一个为书籍的段落数。
+	"""
+	volumes = {}
+	chapters = {}
+	volume_chapters = []
+	chapters_order = []
+	chapter_offsets = array('I', [0])
+	for vno, volume in enumerate(book["volumes"]):
+		volumes.setdefault(volume["title"], vno)
+		_chapters = {}
+		for cno, chapter in enumerate(volume["chapters"]):
+			_chapters.setdefault(chapter["title"], cno)
+			chapters.setdefault(chapter["title"], (vno, cno))
+			chapters_order.append((vno, cno))
+			# 书籍目录中章节的paragraphs为None，段落数为paragraphs_count
+			paragraphs = chapter.get("paragraphs")
+			chapter_offsets.append(chapter_offsets[-1] + (len(paragraphs) if paragraphs is not None else chapter.get("paragraphs_count", 0)))
+		volume_chapters.append(_chapters)
+	return {'volumes': volumes, 'chapters': chapters, 'volume_chapters': volume_chapters, 'chapters_order': chapters_order, 'chapter_offsets': chapter_offsets}
+
+def build_book_catalogue(book):
+	"""
+	生成书籍的目录：复制书籍、卷、章节的除段落以外的属性，章节的paragraphs置为None，
+	并用paragraphs_count记录章节的段落数。
+
+	:param book: 书籍对象。
+	:return: dict, 书籍目录。
+	"""
+	_book = dict(book)
+	_book["volumes"] = []
+	for volume in book["volumes"]:
+		_volume = dict(volume)
+		_volume["chapters"] = []
+		for chapter in volume["chapters"]:
+			_chapter = dict(chapter)
+			_chapter["paragraphs"] = None
+			_chapter["paragraphs_count"] = len(chapter.get("paragraphs") or [])
+			_volume["chapters"].append(_chapter)
+		_book["volumes"].append(_volume)
+	return _book
+
+class BookTextIndex(object):
+	"""
+	书籍正文的字符n-gram倒排索引。
+	书籍中的段落按总章节顺序编号（pid），对每个段落中出现的单字和相邻二字记录包含它的段落编号。
+	查询时，每个查询词先用其单字或二字的posting list求交集得到候选段落，再在候选段落中确认，
+	查询语句中的AND, OR, NOT对应段落集合的交集、并集和差集，结果与逐段扫描完全一致。
+	查询词包含正则表达式特殊字符时无法使用索引。
+	所有posting list按gram的编号首尾相连保存在一个array中，索引只由一个dict和两个array组成，
+	加载时在进程之间传递、保存到快照都只需要序列化这三个对象，不需要为每个gram生成一个对象。
+	"""
+	def __init__(self, book):
+		"""
+		为书籍建立索引。
+
+		:param book: 书籍对象。
+		"""
+		# 按总章节排序的每个章节第一个段落的编号
+		self.chapter_offsets = []
+		postings = {}
+		pid = 0
+		for volume in book["volumes"]:
+			for chapter in volume["chapters"]:
+				self.chapter_offsets.append(pid)
+				for paragraph in chapter.get("paragraphs") or []:
+					content = paragraph["content"]
+					grams = set(content)
+					grams.update(content[i:i + 2] for i in range(len(content) - 1))
+					for gram in grams:
+						postings.setdefault(gram, []).append(pid)
+					pid += 1
+		self.paragraphs_count = pid
+		# gram -> gram的编号，第n个gram的posting list为posting_pids[posting_offsets[n]:posting_offsets[n + 1]]
+		self.grams = {}
+		self.posting_offsets = array('I', [0])
+		self.posting_pids = array('I')
+		for gram, pids in postings.items():
+			self.grams[gram] = len(self.grams)
+			self.posting_pids.extend(pids)
+			self.posting_offsets.append(len(self.posting_pids))
+
+	def posting(self, gram):
+		"""
+		获取包含gram的段落编号。
+
+		:return: array, 按顺序排列的段落编号，没有时为空的array。
+		"""
+		n = self.grams.get(gram)
+		if n is None:
+			return array('I')
+		return self.posting_pids[self.posting_offsets[n] : self.posting_offsets[n + 1]]
+
+	def paragraph_position(self, pid):
+		"""
+		获取段落编号对应的总章节序号和章节内段落序号。
+
+		:param pid: 段落编号。
+		:return: tuple, (总章节序号, 段落序号)。
+		"""
+		order = bisect.bisect_right(self.chapter_offsets, pid) - 1
+		return order, pid - self.chapter_offsets[order]
+
+	def search_pids(self, book, lookup, query_object):
+		"""
+		使用索引执行查询，只返回符合查询条件的段落编号。
+
+		:param book: 建立索引的书籍对象，用于确认候选段落。
+		:param lookup: 书籍的查找表，见build_book_lookup。
+		:param query_object: QueryObject对象。
+		:return: list, 按顺序排列的段落编号；查询不能使用索引时返回None。
+		"""
+		if not all(term.literal for term in query_object.query_plan.terms):
+			return None
+
+		evaluator = BookTextIndexEvaluator(self, book, lookup)
+		result = query_object.excute_query_with(evaluator)
+		if not isinstance(result, set):
+			return []
+		return sorted(result)
+
+	def search(self, book, lookup, query_object):
+		"""
+		使用索引执行查询。
+
+		:param book: 建立索引的书籍对象，用于确认候选段落。
+		:param lookup: 书籍的查找表，见build_book_lookup。
+		:param query_object: QueryObject对象。
+		:return: list, 按顺序排列的(卷序号, 章节序号, 段落内容, 段落编号)；查询不能使用索引时返回None。
+		"""
+		pids = self.search_pids(book, lookup, query_object)
+		if pids is None:
+			return None
+
+		hits = []
+		chapters_order = lookup['chapters_order']
+		for pid in pids:
+			order, pno = self.paragraph_position(pid)
+			vno, cno = chapters_order[order]
+			hits.append((vno, cno, book["volumes"][vno]["chapters"][cno]["paragraphs"][pno]["content"], pid))
+		return hits
+
+class BookTextIndexEvaluator(object):
+	"""
+	用BookTextIndex计算查询条件，条件为符合条件的段落编号集合。
+	"""
+	def __init__(self, text_index, book, lookup):
+		self.text_index = text_index
+		self.book = book
+		self.lookup = lookup
+		self._universe = None
+		self._matches = {}
+
+	def _content(self, pid):
+		order, pno = self.text_index.paragraph_position(pid)
+		vno, cno = self.lookup['chapters_order'][order]
+		return self.book["volumes"][vno]["chapters"][cno]["paragraphs"][pno]["content"]
+
+	def match(self, word):
+		matches = self._matches.get(word)
+		if matches is not None:
+			return matches
+
+		text_index = self.text_index
+		if len(word) <= 2:
+			matches = set(text_index.posting(word))
+		else:
+			grams = {word[i:i + 2] for i in range(len(word) - 1)}
+			posting_lists = sorted((text_index.posting(gram) for gram in grams), key=len)
+			candidates = set(posting_lists[0])
+			for posting_list in posting_lists[1:]:
+				if not candidates:
+					break
+				candidates.intersection_update(posting_list)
+			matches = {pid for pid in candidates if word in self._content(pid)}
+		self._matches[word] = matches
+		return matches
+
+	def negate(self, condition):
+		if self._universe is None:
+			self._universe = set(range(self.text_index.paragraphs_count))
+		if condition is None:
+			return set(self._universe)
+		return self._universe - condition
+
+	def conjunction(self, conditiona, conditionb):
+		return conditiona & conditionb
+
+	def disjunction(self, conditiona, conditionb):
+		return conditiona | conditionb
+
+class LRUCache(object):
+	"""
+	最近最少使用（LRU）淘汰的有界缓存，线程安全。
+	容量可以按字节数（max_bytes）或条目数（max_items）限制，二者同时指定时都要满足，都为None时不限制。
+	"""
+	def __init__(self, max_bytes=None, max_items=None):
+		"""
+		初始化LRUCache对象。
+
+		:param max_bytes: 缓存条目大小之和的上限，None表示不限制。
+		:param max_items: 缓存条目数的上限，None表示不限制。
+		"""
+		self.max_bytes = max_bytes
+		self.max_items = max_items
+		self._items = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def get(self, key, default=None):
+		"""
+		获取缓存条目，命中后将其移到最近使用的位置。
+
+		:param key: 缓存条目的key。
+		:param default: 未命中时返回的值。
+		:return: 缓存的值，未命中时返回default。
+		"""
+		with self._lock:
+			item = self._items.get(key)
+			if item is None:
+				self.misses += 1
+				return default
+			self._items.move_to_end(key)
+			self.hits += 1
+			return item[0]
+
+	def put(self, key, value, size=0):
+		"""
+		加入缓存条目，并按容量上限淘汰最近最少使用的条目。
+		单个条目大小超过max_bytes时不加入缓存。
+
+		:param key: 缓存条目的key。
+		:param value: 缓存的值。
+		:param size: 缓存条目的大小，用于按字节数限制容量。
+		:return: boolean，True加入了缓存；False，没有加入缓存。
+		"""
+		if self.max_bytes is not None and size > self.max_bytes:
+			return False
+		if self.max_items is not None and self.max_items <= 0:
+			return False
+		with self._lock:
+			old = self._items.pop(key, None)
+			if old is not None:
+				self._bytes -= old[1]
+			self._items[key] = (value, size)
+			self._bytes += size
+			while (self.max_items is not None and len(self._items) > self.max_items) or \
+				(self.max_bytes is not None and self._bytes > self.max_bytes):
+				_, (_, evicted_size) = self._items.popitem(last=False)
+				self._bytes -= evicted_size
+				self.evictions += 1
+		return True
+
+	def pop(self, key, default=None):
+		with self._lock:
+			item = self._items.pop(key, None)
+			if item is None:
+				return default
+			self._bytes -= item[1]
+			return item[0]
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+			self._bytes = 0
+
+	def stats(self):
+		"""
+		获取缓存的统计信息。
+
+		:return: dict, 包含条目数、字节数、容量上限以及命中、未命中、淘汰计数。
+		"""
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'items': len(self._items),
+				'bytes': self._bytes,
+				'max_items': self.max_items,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'hit_rate': self.hits / lookups if lookups else None,
+			}
+
+class SearchStopped(Exception):
+	"""
+	搜索被取消或者超时，见SearchControl。
+	"""
+	pass
+
+class SearchControl(object):
+	"""
+	控制一次搜索的取消和时限。
+	搜索在每本书之前、逐段扫描时在每个章节之前调用check，被取消或者超时后不再继续，
+	已经搜索完的书籍作为部分结果返回，truncated为True。可以被多个线程同时使用。
+	"""
+	def __init__(self, timeout=None):
+		"""
+		:param timeout: 搜索的时限，秒，None表示不限制。
+		"""
+		# time.monotonic()的截止时间，None表示不限制
+		self.deadline = time.monotonic() + timeout if timeout is not None else None
+		# 搜索是否因为取消或者超时而停止过
+		self.truncated = False
+		self._cancelled = threading.Event()
+
+	def cancel(self):
+		"""
+		取消搜索，正在搜索的线程在下一次check时停止。
+		"""
+		self._cancelled.set()
+
+	def cancelled(self):
+		"""
+		是否已经取消。
+		"""
+		return self._cancelled.is_set()
+
+	def stopped(self):
+		"""
+		是否已经取消或者超时。
+		"""
+		return self.cancelled() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+	def check(self):
+		"""
+		已经取消或者超时时抛出SearchStopped。
+		"""
+		if self.stopped():
+			self.truncated = True
+			raise SearchStopped()
+
+	def iter_checked(self, paragraphs):
+		"""
+		依次输出(卷序号, 章节序号, 段落内容)，每个章节之前调用check。
+		"""
+		last = None
+		for paragraph in paragraphs:
+			if paragraph[:2] != last:
+				last = paragraph[:2]
+				self.check()
+			yield paragraph
 
 class QueryObject(object):
 	"""
@@ -368,6 +1956,16 @@ class QueryObject(object):
 		else:
 			self.query_string = None
 			self.query_list = None
+		self._query_plan = None
+
+	@property
+	def query_plan(self):
+		"""
+		查询语句编译后的QueryPlan，第一次使用时编译。
+		"""
+		if self._query_plan is None:
+			self._query_plan = self.compile_query()
+		return self._query_plan
 
 	def __parse_nestedbrackets_to_list(self, s, i = 0, level = 0):
 		"""
@@ -425,13 +2023,14 @@ class QueryObject(object):
 			content = ''
 		return i, result, level
 
-	def __judge_condition(self, conditiona, conditionb, operator):
+	def __judge_condition(self, conditiona, conditionb, operator, evaluator):
 		"""
     输出对两个条件进行操作符指定操作后的结果。
 
 		:param conditiona: 条件A
 		:param conditiona: 条件B
 		:param operator: 条件操作符号，AND, OR
+		:param evaluator: 条件计算对象，见QueryContentEvaluator。
 		:return: 输出条件执行后的结果。
     """
 		assert conditiona is not None or conditionb is not None
@@ -442,16 +2041,16 @@ class QueryObject(object):
 		
 		#assert operator == 'AND' or operator == 'OR'
 		if operator == 'AND':
-			return conditiona and conditionb
+			return evaluator.conjunction(conditiona, conditionb)
 		elif operator == 'OR':
-			return conditiona or conditionb
+			return evaluator.disjunction(conditiona, conditionb)
 		else:
-			return conditiona and conditionb
+			return evaluator.conjunction(conditiona, conditionb)
 			#logging.error(f"Error in A: {conditiona}, B: {conditionb}, operator: {operator}.")
 	
-	def __excute_single_query(self, query, content, last_condition=None, operator=None, not_operator=False, level=0):
+	def __excute_single_query(self, query, evaluator, last_condition=None, operator=None, not_operator=False, level=0):
 		"""
-    对给定的content，执行query查询，并和last_condition进行条件操作。
+    用evaluator执行query查询，并和last_condition进行条件操作。
 
 		:param query: 非嵌套的查询语句，有三种形式，如：
     	1. query type1 = condition + operator + [query type1]
@@ -459,6 +2058,7 @@ class QueryObject(object):
     	3. query type3 = operator + condition + [query type2 | query type3]
     	其中, 
 			query中的operator = AND | OR | NOT | AND + NOT | OR + NOT
+		:param evaluator: 条件计算对象，见QueryContentEvaluator。
     :param last_condition: 上一个查询条件结果。
 		:param operator: 上一个查询条件和本次查询条件的条件操作符。
 		:param not_operator: 本次条件是否是包含not前缀操作符。
@@ -483,14 +2083,13 @@ class QueryObject(object):
 			elif upper_word == 'NOT':
 				not_operator = True
 			else:
-				match = [m.start() for m in re.finditer(word, content)]
-				condition = True if len(match) else False
+				condition = evaluator.match(word)
 
 				if not_operator:
-					condition = not condition
+					condition = evaluator.negate(condition)
 					not_operator = False
 				if last_condition is not None:
-					result = self.__judge_condition(last_condition, condition, operator)
+					result = self.__judge_condition(last_condition, condition, operator, evaluator)
 					operator = None
 					last_condition = result
 				else:
@@ -499,11 +2098,12 @@ class QueryObject(object):
 			logging.debug(f"{'': <{level*2}}{index}: {word}, A: {last_condition}, B: {condition}, operator: {operator}, not: {not_operator}.")
 		return last_condition, operator, not_operator
 
-	def __excute_query(self, querylist, content, last_condition=None, operator=None, not_operator=False, level=0):
+	def __excute_query(self, querylist, evaluator, last_condition=None, operator=None, not_operator=False, level=0):
 		"""
-    对给定的content，执行querylist嵌套查询，并和last_condition进行条件操作。
+    用evaluator执行querylist嵌套查询，并和last_condition进行条件操作。
 
 		:param querylist: 嵌套查询对象。
+		:param evaluator: 条件计算对象，见QueryContentEvaluator。
     :param last_condition: 上一个查询条件结果。
 		:param operator: 上一个查询条件和本次查询条件的条件操作符。
 		:param not_operator: 本次条件是否是包含not前缀操作符。
@@ -521,13 +2121,13 @@ class QueryObject(object):
 		for q in querylist:
 			if isinstance(q, list):
 				logging.debug(f"{'': <{level*2}}L{level}, sub-query begin: {q}")
-				sub_last_condition, sub_operator, sub_not_operator, _ = self.__excute_query(q, content, last_condition=None, operator=None, not_operator=False, level=level+1)
+				sub_last_condition, sub_operator, sub_not_operator, _ = self.__excute_query(q, evaluator, last_condition=None, operator=None, not_operator=False, level=level+1)
 
 				if not_operator:
-					sub_last_condition = not sub_last_condition
+					sub_last_condition = evaluator.negate(sub_last_condition)
 				not_operator = sub_not_operator
 				if last_condition is not None:
-					result = self.__judge_condition(last_condition, sub_last_condition, operator)
+					result = self.__judge_condition(last_condition, sub_last_condition, operator, evaluator)
 					operator = sub_operator
 					last_condition = result
 				else:
@@ -536,7 +2136,7 @@ class QueryObject(object):
 			else:
 				result = q.split(" ")  # 以空格为分隔符分割字符串 "apple banana cherry"
 				logging.debug(f"{'': <{level*2}}L{level}, query begin: " + "/".join(result)) # 输出结果为 ['apple', 'banana', 'cherry']
-				last_condition, operator, not_operator = self.__excute_single_query(result, content, last_condition=last_condition, operator=operator, not_operator=not_operator, level=level)
+				last_condition, operator, not_operator = self.__excute_single_query(result, evaluator, last_condition=last_condition, operator=operator, not_operator=not_operator, level=level)
 				logging.debug(f"{'': <{level*2}}L{level}, query end: L: {last_condition}, operator: {operator}, not: {not_operator}.")
 		return last_condition, operator, not_operator, level
 
@@ -569,6 +2169,34 @@ class QueryObject(object):
 		keys = [key for key in keys if len(key)]
 		return keys
 
+	def normalize_query(self, query_list=None):
+		"""
+		将解码后的查询语句还原为规范的查询语句：去掉多余的空格，操作符统一为大写。
+		执行结果相同的查询语句规范化后相同，可以作为查询结果缓存的key。
+
+		:param query_list: 嵌套查询对象，缺省为QueryObject对象初始化时的查询语句。
+		:return: string, 规范的查询语句。
+
+		示例:
+			>>> QueryObject("大人  and (小人 Or 君子 )").normalize_query()
+			'大人 AND (小人 OR 君子)'
+		"""
+		query_list = query_list if query_list is not None else self.query_list
+		if query_list is None:
+			return ''
+
+		parts = []
+		for q in query_list:
+			if isinstance(q, list):
+				parts.append(f"({self.normalize_query(q)})")
+			else:
+				for word in q.split(" "):
+					if len(word) == 0:
+						continue
+					upper_word = word.upper()
+					parts.append(upper_word if upper_word in ('AND', 'OR', 'NOT') else word)
+		return ' '.join(parts)
+
 	def parse_query(self, query_string):
 		"""
 		将查询语句解码成包含嵌套关系的list。
@@ -605,19 +2233,444 @@ class QueryObject(object):
 			>>> qo = QueryObject('君子 and 小人')
 			>>> qo.excute_query('初六：童观，小人无咎，君子吝。')
 			True	
+
+		没有指定query_list时，使用编译好的query_plan执行查询。
+		"""
+		if query_list is None and self.query_list is not None:
+			return self.query_plan.evaluate(content)
+		return self.excute_query_with(QueryContentEvaluator(content), query_list)
+
+	def excute_query_with(self, evaluator, query_list=None):
+		"""
+		用给定的条件计算对象执行查询。
+		查询条件的组合方式由查询语句决定，条件的计算方式由evaluator决定，
+		比如QueryContentEvaluator对单个内容计算boolean条件，BookTextIndex对段落集合计算条件。
+
+		:param evaluator: 条件计算对象，需要实现match, negate, conjunction, disjunction方法。
+		:param query_list: 
+			查询语句列表。
+			缺省为空，默认为QueryObject对象初始化时的查询语句解码后的查询语句列表。
+		:return: 查询条件的计算结果，查询语句为空时返回False。
 		"""
+		if query_list is None and self.query_list is not None:
+			return self.query_plan.evaluate_with(evaluator)
 		if query_list is not None:
-			result, _, _, _ = self.__excute_query(query_list, content)
+			result, _, _, _ = self.__excute_query(query_list, evaluator)
 			return result
 		elif self.query_list is not None:
-			result, _, _, _ = self.__excute_query(self.query_list, content)
+			result, _, _, _ = self.__excute_query(self.query_list, evaluator)
 			return result
 		else:
 			logging.warning(f"no query string...")
 			return False
 
+	def compile_query(self, query_list=None):
+		"""
+		将查询语句编译成QueryPlan。
+		编译时按照执行查询的方式遍历一次查询语句，得到由QueryTerm, QueryNot, QueryAnd, QueryOr组成的语法树，
+		执行查询时不再需要拆分查询语句和判断操作符，AND/OR可以短路求值，查询结果和逐个遍历查询语句一致。
+
+		:param query_list: 
+			查询语句列表。
+			缺省为空，默认为QueryObject对象初始化时的查询语句解码后的查询语句列表。
+		:return: QueryPlan对象。
+		"""
+		builder = QueryPlanBuilder()
+		if query_list is None:
+			query_list = self.query_list
+		root = None
+		if query_list is not None:
+			root, _, _, _ = self.__excute_query(query_list, builder)
+		return QueryPlan(root, list(builder.terms.values()))
+
+class QueryPlan(object):
+	"""
+	编译后的查询语句，见QueryObject.compile_query。
+	"""
+	def __init__(self, root, terms):
+		"""
+		初始化QueryPlan对象。
+		查询词都不包含正则表达式特殊字符时，用一个KeywordMatcher一次找出内容中出现的所有查询词。
+
+		:param root: 语法树的根节点，查询语句为空时为None。
+		:param terms: 参与条件计算的QueryTerm，查询词不重复。
+		"""
+		self.root = root
+		self.terms = terms
+		self.matcher = None
+		if terms and all(term.literal for term in terms):
+			self.matcher = KeywordMatcher([term.word for term in terms])
+
+	def evaluate(self, content):
+		"""
+		对给定的内容，判断是否符合查询条件。
+
+		:param content: 给定的内容字符串。
+		:return: boolean，True符合查询条件；False，不符合查询条件；查询语句为空时返回None。
+		"""
+		if self.root is None:
+			return None
+		if self.matcher is not None and self.matcher.automaton:
+			return self.root.evaluate_present(self.matcher.present(content))
+		return self.root.evaluate(content)
+
+	def evaluate_present(self, present):
+		"""
+		根据内容中出现的查询词，判断是否符合查询条件。
+
+		:param present: 内容中出现的查询词集合，比如KeywordMatcher.present的结果。
+		:return: boolean，True符合查询条件；False，不符合查询条件；查询语句为空时返回None。
+		"""
+		if self.root is None:
+			return None
+		return self.root.evaluate_present(present)
+
+	def evaluate_with(self, evaluator):
+		"""
+		用给定的条件计算对象执行查询，见QueryObject.excute_query_with。
+		"""
+		if self.root is None:
+			return None
+		return self.root.evaluate_with(evaluator)
+
+class QueryTerm(object):
+	"""
+	查询词。不包含正则表达式特殊字符的查询词用子串判断，否则用编译好的正则表达式判断。
+	"""
+	def __init__(self, word):
+		self.word = word
+		self.literal = re.escape(word) == word
+		self._pattern = None if self.literal else re.compile(word)
+
+	def evaluate(self, content):
+		if self.literal:
+			return self.word in content
+		return self._pattern.search(content) is not None
+
+	def evaluate_present(self, present):
+		return self.word in present
+
+	def evaluate_with(self, evaluator):
+		return evaluator.match(self.word)
+
+class QueryAll(object):
+	"""
+	对空的子查询取反得到的条件，对任意内容都成立。
+	"""
+	def evaluate(self, content):
+		return True
+
+	def evaluate_present(self, present):
+		return True
+
+	def evaluate_with(self, evaluator):
+		return evaluator.negate(None)
+
+class QueryNot(object):
+	def __init__(self, child):
+		self.child = child
+
+	def evaluate(self, content):
+		return not self.child.evaluate(content)
+
+	def evaluate_present(self, present):
+		return not self.child.evaluate_present(present)
+
+	def evaluate_with(self, evaluator):
+		return evaluator.negate(self.child.evaluate_with(evaluator))
+
+class QueryAnd(object):
+	def __init__(self, children):
+		self.children = children
+
+	def evaluate(self, content):
+		for child in self.children:
+			if not child.evaluate(content):
+				return False
+		return True
+
+	def evaluate_present(self, present):
+		for child in self.children:
+			if not child.evaluate_present(present):
+				return False
+		return True
+
+	def evaluate_with(self, evaluator):
+		result = self.children[0].evaluate_with(evaluator)
+		for child in self.children[1:]:
+			result = evaluator.conjunction(result, child.evaluate_with(evaluator))
+		return result
+
+class QueryOr(object):
+	def __init__(self, children):
+		self.children = children
+
+	def evaluate(self, content):
+		for child in self.children:
+			if child.evaluate(content):
+				return True
+		return False
+
+	def evaluate_present(self, present):
+		for child in self.children:
+			if child.evaluate_present(present):
+				return True
+		return False
+
+	def evaluate_with(self, evaluator):
+		result = self.children[0].evaluate_with(evaluator)
+		for child in self.children[1:]:
+			result = evaluator.disjunction(result, child.evaluate_with(evaluator))
+		return result
+
+class QueryPlanBuilder(object):
+	"""
+	条件计算对象，计算得到的条件为语法树节点，用于QueryObject.compile_query。
+	"""
+	def __init__(self):
+		# 查询词 -> QueryTerm，同一查询词共用一个节点
+		self.terms = {}
+
+	def match(self, word):
+		term = self.terms.get(word)
+		if term is None:
+			term = QueryTerm(word)
+			self.terms[word] = term
+		return term
+
+	def negate(self, condition):
+		if condition is None:
+			return QueryAll()
+		if isinstance(condition, QueryNot):
+			return condition.child
+		return QueryNot(condition)
+
+	def conjunction(self, conditiona, conditionb):
+		return QueryAnd(self.__children(conditiona, QueryAnd) + self.__children(conditionb, QueryAnd))
+
+	def disjunction(self, conditiona, conditionb):
+		return QueryOr(self.__children(conditiona, QueryOr) + self.__children(conditionb, QueryOr))
+
+	def __children(self, condition, node_type):
+		if isinstance(condition, node_type):
+			return condition.children
+		return [condition]
+
+class QueryBatch(object):
+	"""
+	一起执行的多个查询。
+	所有查询中不包含正则表达式特殊字符的查询词合并到一个KeywordMatcher，每个段落只需要匹配一次，
+	再根据段落中出现的查询词计算各个查询的条件；查询词都没有出现的段落，结果在初始化时已经算好。
+	包含正则表达式特殊字符的查询仍然逐个执行。
+	"""
+	def __init__(self, query_objects):
+		"""
+		初始化QueryBatch对象。
+
+		:param query_objects: QueryObject对象列表。
+		"""
+		self.query_objects = query_objects
+		self.plans = [query_object.query_plan for query_object in query_objects]
+		# 查询词 -> 包含它的查询的序号
+		self._term_queries = {}
+		# 查询词都没有出现时也成立的查询的序号，比如“not 君子”
+		self._empty_queries = []
+		# 包含正则表达式特殊字符的查询的序号
+		self._pattern_queries = []
+		for index, plan in enumerate(self.plans):
+			if plan.root is None:
+				continue
+			if plan.matcher is None:
+				self._pattern_queries.append(index)
+				continue
+			for term in plan.terms:
+				self._term_queries.setdefault(term.word, []).append(index)
+			if plan.root.evaluate_present(set()) == True:
+				self._empty_queries.append(index)
+		self.matcher = KeywordMatcher(list(self._term_queries))
+
+	def __len__(self):
+		return len(self.query_objects)
+
+	def match(self, content, indexes=None):
+		"""
+		对给定的内容，找出符合查询条件的查询。
+
+		:param content: 给定的内容字符串。
+		:param indexes: 只计算这些序号的查询，缺省为所有查询。
+		:return: list, 符合查询条件的查询的序号。
+		"""
+		present = self.matcher.present(content) if self.matcher.keys else ()
+		candidates = set(self._empty_queries)
+		for word in present:
+			candidates.update(self._term_queries[word])
+		plans = self.plans
+		matched = [index for index in candidates if plans[index].evaluate_present(present) == True]
+		matched.extend(index for index in self._pattern_queries if plans[index].evaluate(content) == True)
+		if indexes is not None:
+			matched = [index for index in matched if index in indexes]
+		return matched
+
+class KeywordMatcher(object):
+	"""
+	多关键字匹配，一次遍历内容找出所有关键字出现的位置。
+	关键字数量不少于AUTOMATON_MIN_KEYS时使用Aho–Corasick自动机，遍历一次内容的代价和关键字数量无关；
+	关键字较少时逐个关键字用str的子串查找更快，结果相同。
+	"""
+	AUTOMATON_MIN_KEYS = 128
+
+	def __init__(self, keys):
+		"""
+		初始化KeywordMatcher对象。
+
+		:param keys: 关键字列表，忽略空字符串，重复的关键字只保留第一个。
+		"""
+		self.keys = list(dict.fromkeys(key for key in keys if len(key)))
+		self.automaton = len(self.keys) >= self.AUTOMATON_MIN_KEYS
+		if self.automaton:
+			self.__build()
+
+	def __build(self):
+		# 状态0为根，_goto[state][char] -> state，_fail[state]为失败转移，_output[state]为在该状态结束的关键字序号
+		self._goto = [{}]
+		self._output = [()]
+		for index, key in enumerate(self.keys):
+			state = 0
+			for char in key:
+				next_state = self._goto[state].get(char)
+				if next_state is None:
+					next_state = len(self._goto)
+					self._goto[state][char] = next_state
+					self._goto.append({})
+					self._output.append(())
+				state = next_state
+			self._output[state] = self._output[state] + (index,)
+
+		self._fail = [0] * len(self._goto)
+		queue = list(self._goto[0].values())
+		while queue:
+			next_queue = []
+			for state in queue:
+				for char, next_state in self._goto[state].items():
+					fail = self._fail[state]
+					while fail and char not in self._goto[fail]:
+						fail = self._fail[fail]
+					fail = self._goto[fail].get(char, 0)
+					self._fail[next_state] = fail if fail != next_state else 0
+					self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+					next_queue.append(next_state)
+			queue = next_queue
+
+	def __walk(self, text):
+		"""
+		用自动机遍历内容，依次输出(结束位置, 关键字序号元组)。
+		"""
+		goto = self._goto
+		fail = self._fail
+		output = self._output
+		state = 0
+		for position, char in enumerate(text):
+			while True:
+				next_state = goto[state].get(char)
+				if next_state is not None:
+					state = next_state
+					break
+				if state == 0:
+					break
+				state = fail[state]
+			if output[state]:
+				yield position, output[state]
+
+	def present(self, text):
+		"""
+		获取内容中出现的关键字。
+
+		:param text: 内容字符串。
+		:return: set, 出现的关键字。
+		"""
+		if not self.automaton:
+			return {key for key in self.keys if key in text}
+		keys = self.keys
+		present = set()
+		for _, indexes in self.__walk(text):
+			present.update(keys[index] for index in indexes)
+		return present
+
+	def find_all(self, text):
+		"""
+		获取所有关键字在内容中出现的位置，包括互相重叠的位置。
+
+		:param text: 内容字符串。
+		:return: list, 按(开始位置, 关键字序号)排序的(开始位置, 关键字序号)。
+		"""
+		occurrences = []
+		if self.automaton:
+			keys = self.keys
+			for end, indexes in self.__walk(text):
+				occurrences.extend((end - len(keys[index]) + 1, index) for index in indexes)
+		else:
+			for index, key in enumerate(self.keys):
+				start = text.find(key)
+				while start >= 0:
+					occurrences.append((start, index))
+					start = text.find(key, start + 1)
+		occurrences.sort()
+		return occurrences
+
+	def matches(self, text):
+		"""
+		从左到右获取内容中互不重叠的关键字，同一位置有多个关键字时取keys中靠前的，
+		与re.finditer('|'.join(re.escape(key) for key in keys), text)的结果一致。
+
+		:param text: 内容字符串。
+		:return: list, 按顺序排列的(开始位置, 结束位置, 关键字)。
+		"""
+		spans = []
+		position = 0
+		for start, index in self.find_all(text):
+			if start >= position:
+				key = self.keys[index]
+				position = start + len(key)
+				spans.append((start, position, key))
+		return spans
+
+class QueryContentEvaluator(object):
+	"""
+	对给定的内容计算查询条件，条件为boolean，查询词按正则表达式匹配。
+	"""
+	def __init__(self, content):
+		self.content = content
+
+	def match(self, word):
+		return re.search(word, self.content) is not None
+
+	def negate(self, condition):
+		return not condition
+
+	def conjunction(self, conditiona, conditionb):
+		return conditiona and conditionb
+
+	def disjunction(self, conditiona, conditionb):
+		return conditiona or conditionb
+
 from pypinyin import pinyin, Style
 
+# 书名 -> 按照中文拼音排序的key
+_title_sort_keys = {}
+
+def title_sort_key(title):
+	"""
+	获取书名按照中文拼音排序的key，每个书名只计算一次。
+
+	:param title: 书名。
+	:return: list, pypinyin.pinyin(title, style=Style.TONE3)的结果。
+	"""
+	key = _title_sort_keys.get(title)
+	if key is None:
+		key = pinyin(title, style=Style.TONE3)
+		_title_sort_keys[title] = key
+	return key
+
 class QueryResults():
 	
 	# 在被检索到的文字之前和之后显示更多上下文
@@ -639,14 +2692,28 @@ class QueryResults():
 		self._query_object = query_object
 		self._query_target_count = None
 		self._result_pieces_count = None
+		# result_pieces_count是否是估算的
+		self.result_pieces_count_estimated = False
+		# 搜索是否被取消或者超时，为True时只包含搜索完的书籍中的结果
+		self.truncated = False
 		self._result_pieces = []
+		# _result_pieces是否已经按照书名排序
+		self._sorted = True
+		# 高亮参数 -> Highlighter，用于highlights
+		self._highlighters = {}
 
 	def add_result_pieces(self, result_pieces):
 		if result_pieces is not None:
-			self._result_pieces = self._result_pieces + result_pieces
+			# 先收集，读取结果时再排序一次
+			self._result_pieces.extend(result_pieces)
+			self._sorted = False
+
+	def _sort_result_pieces(self):
+		if not self._sorted:
 			#self._result_pieces.sort(key=lambda rp: rp['title'])
-			# 按照中文拼音排序
-			self._result_pieces.sort(key=lambda rp: pinyin(rp['title'], style=Style.TONE3))
+			# 按照中文拼音排序，排序是稳定的，书名相同时保持加入的顺序
+			self._result_pieces.sort(key=lambda rp: title_sort_key(rp['title']))
+			self._sorted = True
 
 	@property
 	def query_object(self):
@@ -661,7 +2728,7 @@ class QueryResults():
 		self._query_target_count = count
 
 	def __sub(self, start=None, to=None):
-		pieces = self._result_pieces
+		pieces = self.result_pieces
 		# 参数检验和调整
 		if pieces is None:
 			return []
@@ -693,6 +2760,8 @@ class QueryResults():
 						end_idx = min(to - current_count, chapter_len)
 					_chapter = {'title': chapter['title'], '_hits': []}
 					_chapter['_hits'] = chapter['_hits'][start_idx:end_idx]
+					if '_pids' in chapter:
+						_chapter['_pids'] = chapter['_pids'][start_idx:end_idx]
 					_volume['chapters'].append(_chapter)
 
 					current_count += chapter_len
@@ -740,7 +2809,7 @@ class QueryResults():
 	
 	def __count(self, pieces=None):
 		if pieces is None:
-			pieces = self._result_pieces
+			pieces = self.result_pieces
 		# 参数检验和调整
 		if pieces is None:
 			return None
@@ -766,75 +2835,42 @@ class QueryResults():
 
 	@property
 	def result_pieces(self):
+		self._sort_result_pieces()
 		return self._result_pieces
 	
-	def highlights(self, text, format=PLAIN_TEXT, keys = None, strong = False, color_map = None, surround = None):		
-		if format != self.HTML_TEXT and format != self.MARKDOWN_TEXT and format != self.MARK_TEXT:
-			format = self.PLAIN_TEXT	 
-		if format == self.PLAIN_TEXT and surround is None :
-			return text
-		
-		if color_map is None:
-			color_map = self.COLOR_MAP
+	def highlighter(self, format=PLAIN_TEXT, keys = None, strong = False, color_map = None, surround = None):
+		"""
+		获取高亮器，相同参数的高亮器只编译一次。
+
+		:param format: PLAIN_TEXT, HTML_TEXT, MARKDOWN_TEXT或MARK_TEXT。
+		:param keys: 要高亮的关键字，缺省为查询语句中的关键字。
+		:param strong: 关键字是否加粗，用于HTML_TEXT和MARKDOWN_TEXT。
+		:param color_map: 关键字的色谱，缺省为COLOR_MAP。
+		:param surround: 关键字前后显示的字数，None表示显示全部内容。
+		:return: a Highlighter object.
+		"""
 		if keys is None:
 			keys = self._query_object.get_query_keys()
+		color_map = color_map if color_map is not None else self.COLOR_MAP
+		key = (format, tuple(keys), strong, tuple(color_map), surround)
+		highlighter = self._highlighters.get(key)
+		if highlighter is None:
+			highlighter = Highlighter(keys, format = format, strong = strong, color_map = color_map, surround = surround)
+			self._highlighters[key] = highlighter
+		return highlighter
 
-		pattern = '|'.join(re.escape(key) for key in keys)
-		pattern = f'({pattern})'
-		matches = re.finditer(pattern, text)
-		
-		last_match = None
-		highlighted_text = ''
-		for match in matches:
-			keyword = match.group(0)
-			index = keys.index(keyword)
-			color = color_map[index % len(color_map)]
-
-			if format == self.HTML_TEXT or format == self.MARKDOWN_TEXT:
-				if strong:
-					keyword = f'<span style="color: {color}; font-weight: bold;">{keyword}</span>'
-				else:
-					keyword = f'<span style="color: {color};">{keyword}</span>'
-			elif format == self.MARK_TEXT:
-					keyword = f'<mark>{keyword}</mark>'
-
-			if last_match is None:
-				start = max(0, match.start() - surround) if surround else 0
-				before_text = text[start : match.start()]
-				if start > 0:
-					before_text = '...' + before_text
-				highlighted_text = highlighted_text + before_text + keyword
-			else:
-				between = (match.start() - last_match.end())
-				if surround is None or between < 2 * surround + 3:
-					highlighted_text = highlighted_text + text[last_match.end() : match.start()] + keyword
-				else:
-					after_text = text[last_match.end() : last_match.end() + surround]
-					after_text = after_text + '...'
-					before_text = text[match.start() - surround : match.start()]
-					highlighted_text = highlighted_text + after_text + before_text + keyword
-			last_match = match
-
-		end = min(len(text), last_match.end() + surround) if surround else len(text)
-		after_text = text[last_match.end() : end]
-		if end < len(text):
-				after_text = after_text + '...'
-		
-		if format == self.HTML_TEXT or format == self.MARKDOWN_TEXT:
-			highlighted_text = f'<p>{highlighted_text + after_text}</p>'
-		else:
-			highlighted_text = highlighted_text + after_text
-		
-		return highlighted_text
+	def highlights(self, text, format=PLAIN_TEXT, keys = None, strong = False, color_map = None, surround = None):		
+		return self.highlighter(format = format, keys = keys, strong = strong, color_map = color_map, surround = surround).highlight(text)
 		
 	def output(self, format=PLAIN_TEXT, keys = None, strong = False, color_map = None, surround = None):
+		highlighter = self.highlighter(format = format, keys = keys, strong = strong, color_map = color_map, surround = surround)
 		output_string = ''
 		if format == self.HTML_TEXT:
 			output_string += "<table border='1'>\n"
 			output_string += f"<tr><th>NO</th><th>书籍</th><th>章节·段落</th><th>内容</th></tr>"
 			
 			index = 0
-			for book in self._result_pieces:
+			for book in self.result_pieces:
 				for volume in book['volumes']:
 					for chapter in volume['chapters']:
 						for hit in chapter['_hits']:
@@ -844,7 +2880,7 @@ class QueryResults():
 								output_string += f"<td>{index}</td><td>{book['title']}</td><td>{volume['title']}·{chapter['title']}</td>"
 							else:
 								output_string += f"<td>{index}</td><td>{book['title']}</td><td>{chapter['title']}</td>"
-							output_string += f"<td>{self.highlights(hit, format=format, keys = keys, strong = strong, color_map = color_map, surround = surround)}</td>"
+							output_string += f"<td>{highlighter.highlight(hit)}</td>"
 							output_string += "</tr>"
 			output_string += "</table>"
 		elif format == self.MARKDOWN_TEXT:
@@ -852,7 +2888,7 @@ class QueryResults():
 			output_string += "|--|--|--|--|\n"
 			
 			index = 0
-			for book in self._result_pieces:
+			for book in self.result_pieces:
 				for volume in book['volumes']:
 					for chapter in volume['chapters']:
 						for hit in chapter['_hits']:
@@ -861,10 +2897,10 @@ class QueryResults():
 								output_string += f"|{index}|{book['title']}|{volume['title']}·{chapter['title']}|"
 							else:
 								output_string += f"|{index}|{book['title']}|{chapter['title']}|"
-							output_string += f"{self.highlights(hit, format=format, keys = keys, strong = strong, color_map = color_map, surround = surround)}|\n"
+							output_string += f"{highlighter.highlight(hit)}|\n"
 		else:
 			index = 0
-			for book in self._result_pieces:
+			for book in self.result_pieces:
 				for volume in book['volumes']:
 					for chapter in volume['chapters']:
 						for hit in chapter['_hits']:
@@ -873,22 +2909,106 @@ class QueryResults():
 									output_string += f"{index}. {book['title']} {volume['title']}·{chapter['title']}\n"
 							else:
 									output_string += f"{index}. {book['title']} {chapter['title']}\n"
-							output_string += f"{self.highlights(hit, format=format, keys = keys, strong = strong, color_map = color_map, surround = surround)}\n"
+							output_string += f"{highlighter.highlight(hit)}\n"
 
 		return output_string
 
+class Highlighter(object):
+	"""
+	高亮器，每个查询只编译一次：关键字的KeywordMatcher，以及每个关键字高亮后的文本。
+	之后每个段落只需要匹配一次关键字，高亮后的文本用join拼接。
+	"""
+	def __init__(self, keys, format=QueryResults.PLAIN_TEXT, strong=False, color_map=None, surround=None):
+		"""
+		初始化Highlighter对象，参数见QueryResults.highlighter。
+		"""
+		if format != QueryResults.HTML_TEXT and format != QueryResults.MARKDOWN_TEXT and format != QueryResults.MARK_TEXT:
+			format = QueryResults.PLAIN_TEXT
+		color_map = color_map if color_map is not None else QueryResults.COLOR_MAP
+		self.format = format
+		self.surround = surround
+		self.matcher = KeywordMatcher(keys)
+		# 普通文本并且不截取上下文时，不需要高亮
+		self._passthrough = format == QueryResults.PLAIN_TEXT and surround is None
+		self._paragraph = format == QueryResults.HTML_TEXT or format == QueryResults.MARKDOWN_TEXT
+
+		# 关键字 -> 高亮后的文本，颜色按照关键字在keys中第一次出现的位置选择
+		self._marks = {}
+		for key in self.matcher.keys:
+			color = color_map[keys.index(key) % len(color_map)]
+			if self._paragraph:
+				if strong:
+					self._marks[key] = f'<span style="color: {color}; font-weight: bold;">{key}</span>'
+				else:
+					self._marks[key] = f'<span style="color: {color};">{key}</span>'
+			elif format == QueryResults.MARK_TEXT:
+				self._marks[key] = f'<mark>{key}</mark>'
+			else:
+				self._marks[key] = key
+
+	def highlight(self, text, matches=None):
+		"""
+		高亮内容中的关键字，surround不为None时只保留关键字前后surround个字，省略的部分用'...'表示。
+		内容中没有关键字时，按照surround截取内容的开头。
+
+		:param text: 内容字符串。
+		:param matches: 已经找到的关键字位置，见KeywordMatcher.matches，缺省时匹配一次。
+		:return: string, 高亮后的内容。
+		"""
+		if self._passthrough:
+			return text
+		if matches is None:
+			matches = self.matcher.matches(text)
+
+		surround = self.surround
+		marks = self._marks
+		parts = ['<p>'] if self._paragraph else []
+		last_end = None
+		for match_start, match_end, keyword in matches:
+			if last_end is None:
+				start = max(0, match_start - surround) if surround else 0
+				if start > 0:
+					parts.append('...')
+				parts.append(text[start : match_start])
+			elif surround is None or match_start - last_end < 2 * surround + 3:
+				parts.append(text[last_end : match_start])
+			else:
+				parts.append(text[last_end : last_end + surround])
+				parts.append('...')
+				parts.append(text[match_start - surround : match_start])
+			parts.append(marks[keyword])
+			last_end = match_end
+
+		if last_end is None:
+			last_end = 0
+		end = min(len(text), last_end + surround) if surround else len(text)
+		parts.append(text[last_end : end])
+		if end < len(text):
+			parts.append('...')
+		if self._paragraph:
+			parts.append('</p>')
+		return ''.join(parts)
+
 class BookResults():
 
 	def __init__(self, query_object=None):
 		self._query_object = query_object
 		self._query_target_count = None
 		self._result_pieces = []
+		# _result_pieces是否已经按照书名排序
+		self._sorted = True
 
 	def add_result_pieces(self, result_pieces):
 		if result_pieces is not None:
-			self._result_pieces = self._result_pieces + result_pieces
+			# 先收集，读取结果时再排序一次
+			self._result_pieces.extend(result_pieces)
+			self._sorted = False
+
+	def _sort_result_pieces(self):
+		if not self._sorted:
 			#self._result_pieces.sort(key=lambda rp: rp['title'])
-			self._result_pieces.sort(key=lambda rp: pinyin(rp['title'], style=Style.TONE3))
+			self._result_pieces.sort(key=lambda rp: title_sort_key(rp['title']))
+			self._sorted = True
 
 	@property
 	def query_object(self):
@@ -908,6 +3028,7 @@ class BookResults():
 
 	@property
 	def result_pieces(self):
+		self._sort_result_pieces()
 		return self._result_pieces
 	
 # for test
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+"""
+书籍标记语言（BMD，见Books/BookDefine.bmd）编译器。
+逐行解析.bmd文件，生成BookManager加载的书籍json文件，不需要在浏览器中转换。
+一个.bmd文件可以包含多本书（每个“# 书名”开始一本书），解析完一本书就输出一本书，内存中只保留当前的书。
+
+生成的json结构（见BookDefine.ts）：
+	书：{uuid, title, authors, source, description, date, category, subCategory, volumes}
+	卷：{uuid, title, chapters}
+	章节：{uuid, order, title, type, source, description, paragraphs}，“####”节名生成type为'section'的章节
+	段落：{content, annotations}
+	注释：{annotator, type, start, end, content, annotations}
+段落注释（没有缩进的注释）的start、end是0和段落内容的长度；文内注释（有缩进的注释）的start、end都是
+注释在段落内容或上一级注释内容（content连接起来）中的位置。
+
+编译书库：
+	python book_markdown.py <*.bmd文件或目录> <输出目录> [--corpus <corpus文件路径>] [--workers <进程数>]
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import argparse
+import tempfile
+import concurrent.futures
+
+# 注释的一级缩进
+INDENT = "    "
+
+def _split_title(content):
+	"""
+	拆分标题：“名”、“前缀|名”、“前缀|名|副标题”。
+
+	:return: (标题, 副标题)，标题中的前缀和名用“·”连接，没有副标题时为None。
+	"""
+	attributes = content.strip().split('|')
+	if len(attributes) == 2:
+		return f"{attributes[0]}·{attributes[1]}", None
+	elif len(attributes) == 3:
+		return f"{attributes[0]}·{attributes[1]}", attributes[2]
+	return content.strip(), None
+
+def _parse_author(content):
+	"""
+	解析著作者：“著作者”、“著作者,著作类型”、“朝代,著作者,著作类型”、“朝代,官职,著作者,著作类型”。
+	"""
+	attributes = [attribute.strip() for attribute in content.split(',')]
+	author = {}
+	if len(attributes) == 1:
+		author['name'] = attributes[0]
+	elif len(attributes) == 2:
+		author['name'], author['type'] = attributes
+	elif len(attributes) == 3:
+		author['dynasty'], author['name'], author['type'] = attributes
+	elif len(attributes) == 4:
+		author['dynasty'], author['position'], author['name'], author['type'] = attributes
+	else:
+		author['name'] = content.strip()
+	return author
+
+def _parse_annotator(content):
+	"""
+	解析注释头：“注释方式”、“注释者,注释方式”。
+	"""
+	attributes = [attribute.strip() for attribute in content.split(',', 1)]
+	annotation = {'annotator': '' if len(attributes) == 1 else attributes[0]}
+	if attributes[-1]:
+		annotation['type'] = attributes[-1]
+	return annotation
+
+def _annotation_text(annotation):
+	return ''.join(annotation['content'])
+
+class BookMarkdownParser(object):
+	"""
+	BMD流式解析器。用feed逐行输入，每完成一本书，feed或close返回这本书的dict。
+	"""
+	def __init__(self, source_name = ''):
+		"""
+		:param source_name: 来源名称，用于生成稳定的uuid和日志。
+		"""
+		self.source_name = source_name
+		self.line_no = 0
+		self.book = None
+		self.__reset_book()
+
+	def __reset_book(self):
+		self.volume = None
+		self.chapter = None
+		# 当前可以继续输入正文的段落
+		self.paragraph = None
+		# 当前章节的最后一个段落，没有缩进的注释属于这个段落
+		self.last_paragraph = None
+		# 上一行是不是段落中的文内注释，是则下一行正文接在这个段落后面
+		self.inline = False
+		# 缩进级别 -> 当前打开的注释
+		self.annotations = {}
+		# [description]和[source]属于最近的书、卷或者章节
+		self.attributes_target = self.book
+		self.chapter_order = 0
+
+	def __uuid(self, *names):
+		return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(name) for name in (self.source_name, *names))))
+
+	def __new_book(self, content):
+		title, subtitle = _split_title(content)
+		book = {
+			'uuid': self.__uuid(title),
+			'title': title,
+			'authors': [],
+			'description': '',
+			'volumes': [],
+		}
+		if subtitle:
+			book['subtitle'] = subtitle
+		self.book = book
+		self.__reset_book()
+
+	def __ensure_book(self):
+		if self.book is None:
+			self.__new_book(os.path.splitext(os.path.basename(self.source_name))[0])
+
+	def __new_volume(self, content):
+		self.__ensure_book()
+		title, subtitle = _split_title(content)
+		volume = {'uuid': self.__uuid(self.book['title'], len(self.book['volumes'])), 'title': title, 'chapters': []}
+		if subtitle:
+			volume['subtitle'] = subtitle
+		self.book['volumes'].append(volume)
+		self.volume = volume
+		self.chapter = None
+		self.attributes_target = volume
+		self.__close_paragraph()
+
+	def __new_chapter(self, content, chapter_type = None):
+		if self.volume is None:
+			self.__new_volume('')
+		title, subtitle = _split_title(content)
+		chapter = {
+			'uuid': self.__uuid(self.book['title'], len(self.book['volumes']) - 1, len(self.volume['chapters'])),
+			'order': self.chapter_order,
+			'title': title,
+			'paragraphs': [],
+		}
+		if chapter_type:
+			chapter['type'] = chapter_type
+		if subtitle:
+			chapter['subtitle'] = subtitle
+		self.chapter_order += 1
+		self.volume['chapters'].append(chapter)
+		self.chapter = chapter
+		self.attributes_target = chapter
+		self.__close_paragraph()
+		self.last_paragraph = None
+
+	def __ensure_chapter(self):
+		if self.chapter is None:
+			self.__new_chapter('')
+
+	def __close_paragraph(self):
+		self.paragraph = None
+		self.inline = False
+		self.annotations = {}
+
+	def __new_paragraph(self, content):
+		self.__ensure_chapter()
+		paragraph = {'content': content}
+		self.chapter['paragraphs'].append(paragraph)
+		self.paragraph = paragraph
+		self.last_paragraph = paragraph
+		return paragraph
+
+	def __add_text(self, content):
+		if self.paragraph is not None and self.inline:
+			self.paragraph['content'] += content
+		else:
+			self.__new_paragraph(content)
+		self.inline = False
+		self.annotations = {}
+
+	def __add_annotation_header(self, content, level):
+		"""
+		添加注释头。没有缩进的是段落注释；有缩进的是上一级注释中的文内注释，没有上一级注释时是段落中的文内注释。
+		"""
+		annotation = _parse_annotator(content)
+		self.annotations = {key: value for key, value in self.annotations.items() if key < level}
+		parent = self.annotations[max(self.annotations)] if self.annotations else None
+		if level == 0 or parent is None:
+			paragraph = self.paragraph if self.paragraph is not None else self.last_paragraph
+			if paragraph is None:
+				paragraph = self.__new_paragraph('')
+			if level == 0:
+				annotation['start'], annotation['end'] = 0, len(paragraph['content'])
+				self.paragraph = None
+				self.inline = False
+			else:
+				annotation['start'] = annotation['end'] = len(paragraph['content'])
+				self.paragraph = paragraph
+				self.inline = True
+			paragraph.setdefault('annotations', []).append(annotation)
+		else:
+			annotation['start'] = annotation['end'] = len(_annotation_text(parent))
+			parent.setdefault('annotations', []).append(annotation)
+		annotation['content'] = []
+		self.annotations[level] = annotation
+
+	def __add_annotation_content(self, content, level):
+		"""
+		添加注释内容。同一级没有打开的注释时（只有注释内容的注释），先添加一个缺省的注释头。
+		"""
+		self.annotations = {key: value for key, value in self.annotations.items() if key <= level}
+		if level not in self.annotations:
+			self.__add_annotation_header('', level)
+		self.annotations[level]['content'].append(content)
+
+	def __add_description(self, content):
+		self.__ensure_book()
+		target = self.attributes_target
+		if target is self.book and '|' in content:
+			name, description = content.split('|', 1)
+			for author in self.book['authors']:
+				if author['name'] == name.strip():
+					author['description'] = f"{author['description']}\n{description}" if author.get('description') else description
+					return
+		target['description'] = f"{target['description']}\n{content}" if target.get('description') else content
+
+	def __add_source(self, content):
+		self.__ensure_book()
+		content = content.strip()
+		if content.startswith('(') and content.endswith(')'):
+			content = content[1:-1]
+		target = self.attributes_target
+		target['source'] = f"{target['source']}\n{content}" if target.get('source') else content
+
+	def feed(self, line):
+		"""
+		输入一行。
+
+		:param line: 一行文本，可以带换行符。
+		:return: dict, 这一行开始了一本新书时返回之前完成的书，否则返回None。
+		"""
+		self.line_no += 1
+		line = line.rstrip('\r\n')
+		stripped = line.strip()
+		if not stripped:
+			self.__close_paragraph()
+			return None
+		if stripped.startswith('//'):
+			return None
+
+		if line.startswith('# '):
+			book = self.book
+			self.__new_book(line[2:])
+			return book
+		self.__ensure_book()
+		if line.startswith('## '):
+			self.__new_volume(line[3:])
+		elif line.startswith('### '):
+			self.__new_chapter(line[4:])
+		elif line.startswith('#### '):
+			title = line[5:].strip()
+			self.__new_chapter(title, 'section')
+		elif line.startswith('[author] '):
+			self.__close_paragraph()
+			self.book['authors'].append(_parse_author(line[9:]))
+		elif line.startswith('[date] '):
+			self.__close_paragraph()
+			self.book['date'] = line[7:].strip()
+		elif line.startswith('[category] '):
+			self.__close_paragraph()
+			attributes = [attribute.strip() for attribute in line[11:].split(',', 1)]
+			self.book['category'] = attributes[0]
+			if len(attributes) == 2:
+				self.book['subCategory'] = attributes[1]
+		elif line.startswith('[source]'):
+			self.__close_paragraph()
+			self.__add_source(line[8:])
+		elif line.startswith('[description] '):
+			self.__close_paragraph()
+			self.__add_description(line[14:].strip())
+		elif stripped in ('---', '***'):
+			self.__close_paragraph()
+		else:
+			level = 0
+			content = line
+			while content.startswith(INDENT):
+				content = content[len(INDENT):]
+				level += 1
+			if content.startswith('!!!') and content[3:4] in ('', ' '):
+				self.__ensure_chapter()
+				self.__add_annotation_header(content[4:], level)
+			elif content.startswith(':::') and content[3:4] in ('', ' '):
+				self.__ensure_chapter()
+				self.__add_annotation_content(content[4:], level)
+			else:
+				self.__add_text(stripped)
+		return None
+
+	def close(self):
+		"""
+		结束输入。
+
+		:return: dict, 最后一本书，没有书时返回None。
+		"""
+		book, self.book = self.book, None
+		self.__reset_book()
+		return book
+
+def parse_books(lines, source_name = ''):
+	"""
+	逐行解析BMD文本。
+
+	:param lines: 可迭代的文本行，如打开的文件。
+	:param source_name: 来源名称，用于生成稳定的uuid。
+	:return: generator, 依次输出每本书的dict。
+	"""
+	parser = BookMarkdownParser(source_name)
+	for line in lines:
+		book = parser.feed(line)
+		if book is not None:
+			yield book
+	book = parser.close()
+	if book is not None:
+		yield book
+
+def _write_json(path, book):
+	"""
+	写入书籍json文件。先写入同一目录下的临时文件，完成后替换path，正在读取旧文件的进程不受影响。
+	"""
+	fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), prefix = '.book_', suffix = '.json')
+	try:
+		with os.fdopen(fd, 'w', encoding = 'utf-8') as file:
+			json.dump(book, file, ensure_ascii = False)
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(temp_path, 0o666 & ~umask)
+		os.replace(temp_path, path)
+	except BaseException:
+		os.unlink(temp_path)
+		raise
+
+def compile_book(bmd_path, output_path):
+	"""
+	编译一个.bmd文件。只有一本书时生成<文件名>.json，有多本书时依次生成<文件名>_1.json，<文件名>_2.json...
+
+	:param bmd_path: .bmd文件路径。
+	:param output_path: 输出目录。
+	:return: list, 生成的书籍json文件路径。
+	"""
+	begin = time.perf_counter()
+	name = os.path.splitext(os.path.basename(bmd_path))[0]
+	book_files = []
+	with open(bmd_path, 'r', encoding = 'utf-8-sig') as file:
+		books = parse_books(file, name)
+		book = next(books, None)
+		next_book = next(books, None)
+		book_no = 1
+		while book is not None:
+			filename = f"{name}.json" if book_no == 1 and next_book is None else f"{name}_{book_no}.json"
+			book_file = os.path.join(output_path, filename)
+			_write_json(book_file, book)
+			book_files.append(book_file)
+			book, next_book = next_book, next(books, None)
+			book_no += 1
+	logging.info(f"compile {bmd_path} to {len(book_files)} books in {time.perf_counter() - begin:.1f}s...")
+	return book_files
+
+def compile_books(bmd_paths, output_path, workers = None, corpus_path = None):
+	"""
+	用多个进程编译.bmd文件，每个进程编译一个文件。
+
+	:param bmd_paths: .bmd文件路径，或者包含.bmd文件的目录。
+	:param output_path: 输出目录。
+	:param workers: 编译进程数，缺省为CPU核数，1表示在当前进程中编译。
+	:param corpus_path: 不为None时，编译完成后把生成的书籍转换为compact corpus文件，见book_corpus.build_corpus。
+	:return: list, 生成的书籍json文件路径，按.bmd文件的顺序排列。
+	"""
+	bmd_files = []
+	for bmd_path in ([bmd_paths] if isinstance(bmd_paths, str) else bmd_paths):
+		if os.path.isdir(bmd_path):
+			bmd_files.extend(os.path.join(bmd_path, filename) for filename in sorted(os.listdir(bmd_path)) if filename.endswith(".bmd"))
+		else:
+			bmd_files.append(bmd_path)
+	os.makedirs(output_path, exist_ok = True)
+
+	begin = time.perf_counter()
+	book_files = []
+	workers = min(workers or os.cpu_count() or 1, max(1, len(bmd_files)))
+	if workers == 1:
+		for bmd_file in bmd_files:
+			book_files.extend(compile_book(bmd_file, output_path))
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+			for files in executor.map(compile_book, bmd_files, [output_path] * len(bmd_files)):
+				book_files.extend(files)
+	logging.info(f"compile {len(bmd_files)} files to {len(book_files)} books with {workers} processes in {time.perf_counter() - begin:.1f}s...")
+
+	if corpus_path is not None:
+		from book_corpus import build_corpus
+		build_corpus(output_path, corpus_path, book_files)
+	return book_files
+
+def main():
+	parser = argparse.ArgumentParser(description = "compile *.bmd books to *.json books.")
+	parser.add_argument('bmd_paths', nargs = '+', help = "the *.bmd files, or the directories of the *.bmd files.")
+	parser.add_argument('output_path', help = "the directory to write the *.json books.")
+	parser.add_argument('--corpus', dest = 'corpus_path', help = "also build a compact corpus file from the compiled books.")
+	parser.add_argument('--workers', type = int, help = "the number of compile processes, default is the number of CPUs.")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
+	compile_books(args.bmd_paths, args.output_path, args.workers, args.corpus_path)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+书籍元数据索引。
+加载书库时按书名、分类（[category]）、时代（[date]）、著作者（[author]）等元数据为书籍建立位图，
+位图是Python的int，第n位表示books_index中的第n本书。搜索时要搜索的书籍由位图运算得到，不需要逐本书比较。
+
+要搜索的书籍（search_book_string）的格式：
+	+书名1,书名2,...    只搜索这些书；
+	-书名1,书名2,...    不搜索这些书；
+	@字段:值1,值2;字段:值3    按元数据筛选，同一字段的多个值之间是“或”，不同字段之间是“且”，
+		如“@date:先秦;category:经部”为所有先秦的经部书籍。
+字段见META_FIELDS。
+"""
+
+import logging
+
+# 元数据字段 -> 说明
+META_FIELDS = {
+	'title': "书名",
+	'category': "分类",
+	'subcategory': "子类",
+	'date': "时代",
+	'author': "著作者",
+	'dynasty': "著作者的朝代",
+}
+
+def book_metadata(catalogue):
+	"""
+	获取书籍的元数据。
+
+	:param catalogue: 书籍目录，见build_book_catalogue。
+	:return: generator, 依次输出(字段, 值)。
+	"""
+	yield 'title', catalogue["title"]
+	if catalogue.get("category"):
+		yield 'category', str(catalogue["category"])
+	if catalogue.get("subCategory"):
+		yield 'subcategory', str(catalogue["subCategory"])
+	if catalogue.get("date"):
+		yield 'date', str(catalogue["date"])
+	for author in catalogue.get("authors") or []:
+		if author.get("name"):
+			yield 'author', author["name"]
+		if author.get("dynasty"):
+			yield 'dynasty', author["dynasty"]
+
+def _bitset(book_nos):
+	"""
+	由书籍序号生成位图。
+	"""
+	if not book_nos:
+		return 0
+	bits = bytearray(max(book_nos) // 8 + 1)
+	for book_no in book_nos:
+		bits[book_no >> 3] |= 1 << (book_no & 7)
+	return int.from_bytes(bits, 'little')
+
+class BookMetaIndex(object):
+	"""
+	书籍元数据的位图索引。生成以后不再修改，重新加载书库时和书籍索引项一起替换。
+	"""
+	def __init__(self, books_index):
+		"""
+		:param books_index: 书籍索引项，位图中的第n位对应其中的第n本书。
+		"""
+		self.books_index = books_index
+		self.all = (1 << len(books_index)) - 1
+		book_nos = {field: {} for field in META_FIELDS}
+		for book_no, book_index in enumerate(books_index):
+			for field, value in book_metadata(book_index['catalogue']):
+				field_book_nos = book_nos[field].setdefault(value, [])
+				# 同一本书的多个著作者可能是同一朝代
+				if not field_book_nos or field_book_nos[-1] != book_no:
+					field_book_nos.append(book_no)
+		# 字段 -> 值 -> 位图
+		self.bitsets = {field: {value: _bitset(nos) for value, nos in values.items()} for field, values in book_nos.items()}
+
+	def bitset(self, field, values):
+		"""
+		获取字段为任意一个值的书籍的位图。
+
+		:param field: 字段，见META_FIELDS。
+		:param values: 值的列表。
+		:return: int, 位图，字段不存在时返回0。
+		"""
+		field_bitsets = self.bitsets.get(field)
+		if field_bitsets is None:
+			logging.warning(f"unknown book metadata field {field}...")
+			return 0
+		bitset = 0
+		for value in values:
+			bitset |= field_bitsets.get(value, 0)
+		return bitset
+
+	def select(self, search_book_string):
+		"""
+		由search_book_string得到要搜索的书籍的位图。
+
+		:param search_book_string: 要搜索的书籍，格式见本模块的说明，为空时搜索所有书籍。
+		:return: int, 位图。
+		"""
+		if not search_book_string:
+			return self.all
+		mark, condition = search_book_string[0], search_book_string[1:]
+		if mark == '+':
+			return self.bitset('title', condition.split(","))
+		elif mark == '-':
+			return self.all & ~self.bitset('title', condition.split(","))
+		elif mark == '@':
+			bitset = self.all
+			for term in condition.split(";"):
+				if not term.strip():
+					continue
+				field, _, values = term.partition(":")
+				bitset &= self.bitset(field.strip(), [value.strip() for value in values.split(",")])
+			return bitset
+		logging.warning(f"unknown search book string {search_book_string}...")
+		return 0
+
+	def books(self, bitset):
+		"""
+		获取位图中的书籍索引项，按books_index的顺序排列。
+
+		:param bitset: 位图。
+		:return: list, 书籍索引项。
+		"""
+		if bitset == self.all:
+			return self.books_index
+		bits = bin(bitset)[:1:-1]
+		books_index = []
+		book_no = bits.find('1')
+		while book_no >= 0:
+			books_index.append(self.books_index[book_no])
+			book_no = bits.find('1', book_no + 1)
+		return books_index
+
+	def values(self, field):
+		"""
+		获取字段所有的值及每个值的书籍数。
+
+		:param field: 字段，见META_FIELDS。
+		:return: dict, 值 -> 书籍数。
+		"""
+		return {value: bitset.bit_count() if hasattr(bitset, 'bit_count') else bin(bitset).count('1') for value, bitset in self.bitsets.get(field, {}).items()}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+生产环境的多进程服务。
+主进程监听端口并加载书库，之后fork出多个工作进程，工作进程共用主进程监听的端口，各自用多线程处理请求。
+书籍在fork之前加载，工作进程和主进程通过写时复制共享同一份书籍对象，增加工作进程基本不增加内存。
+fork之前调用gc.freeze把所有对象移到GC的永久代，工作进程的GC不再遍历这些对象、不会写它们的GC头，
+共享的内存页不会因为GC而被复制。但是搜索时读取书籍对象仍然会修改它们的引用计数，被搜索过的书籍所在的页还是会被复制；
+书库是compact corpus并且不加载书籍（load=False）时，搜索直接读取mmap的corpus文件，corpus在页缓存中共享，
+工作进程的私有内存最少。
+
+后台线程不能跨fork，工作进程需要的线程（比如BookWatcher）在after_fork中启动；
+BookManager的多进程搜索（search_processes）同样不能跨fork，多进程服务时不使用。
+
+两种服务器：
+	run_gunicorn，用gunicorn的gthread工作进程处理请求，gunicorn负责HTTP协议、超时和工作进程管理，生产环境优先使用，
+		需要安装gunicorn（可选依赖）；
+	PreforkServer，只依赖werkzeug，每个工作进程运行werkzeug的多线程服务器。werkzeug的服务器是开发用的服务器，
+		每个请求一个线程、没有请求超时和连接数限制，只适合在可信的网络中或者反向代理（如nginx）之后使用。
+		PreforkServer支持工作进程之间通知重新加载书库（见notify_reload），gunicorn不支持。
+"""
+
+import os
+import gc
+import time
+import signal
+import socket
+import logging
+import threading
+
+# run_gunicorn中每个工作进程缺省的线程数
+GUNICORN_THREADS = 16
+
+class PreforkServer(object):
+	"""
+	预先fork工作进程的WSGI服务器。主进程只负责启动工作进程，工作进程异常退出后重新启动。
+	"""
+	# 工作进程异常退出后，重新启动之前等待的秒数，避免工作进程启动即退出时不停地fork
+	RESTART_INTERVAL = 1.0
+
+	def __init__(self, app, host, port, workers, after_fork = None, on_reload = None):
+		"""
+		:param app: WSGI应用，已经加载好书库。
+		:param host: 监听的地址。
+		:param port: 监听的端口。
+		:param workers: 工作进程数。
+		:param after_fork: 工作进程启动后、处理请求之前在工作进程中调用的函数，参数为工作进程序号。
+		:param on_reload: 主进程收到SIGHUP后（见notify_reload），在每个工作进程的后台线程中调用的函数，
+			None时工作进程忽略SIGHUP。
+		"""
+		self.app = app
+		self.host = host
+		self.port = port
+		self.workers = max(1, workers)
+		self.after_fork = after_fork
+		self.on_reload = on_reload
+		# pid -> 工作进程序号
+		self._workers = {}
+		self._stopping = False
+		self._socket = None
+
+	def serve_forever(self):
+		"""
+		监听端口，启动工作进程，直到收到SIGTERM或者SIGINT。
+		"""
+		self._socket = socket.create_server((self.host, self.port), family = socket.AF_INET6 if ':' in self.host else socket.AF_INET, backlog = 128)
+		self._socket.set_inheritable(True)
+		signal.signal(signal.SIGTERM, self.__stop)
+		signal.signal(signal.SIGINT, self.__stop)
+		signal.signal(signal.SIGHUP, self.__relay_reload)
+
+		# fork之前回收垃圾并冻结所有对象，之后的GC只遍历工作进程新建的对象
+		gc.collect()
+		gc.freeze()
+		logging.info(f"freeze {gc.get_freeze_count()} objects, start {self.workers} workers on {self.host}:{self.port}...")
+		for worker_no in range(self.workers):
+			self.__spawn(worker_no)
+
+		while self._workers:
+			try:
+				pid, status = os.wait()
+			except ChildProcessError:
+				break
+			worker_no = self._workers.pop(pid, None)
+			if worker_no is None or self._stopping:
+				continue
+			logging.error(f"worker {worker_no} (pid {pid}) exited with status {status}, restart it...")
+			time.sleep(self.RESTART_INTERVAL)
+			if not self._stopping:
+				self.__spawn(worker_no)
+		self._socket.close()
+		logging.info(f"all workers exited...")
+
+	def __spawn(self, worker_no):
+		"""
+		fork一个工作进程。
+		"""
+		pid = os.fork()
+		if pid:
+			self._workers[pid] = worker_no
+			return
+
+		# 工作进程
+		status = 0
+		try:
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			signal.signal(signal.SIGHUP, self.__reload if self.on_reload is not None else signal.SIG_IGN)
+			if self.after_fork is not None:
+				self.after_fork(worker_no)
+			from werkzeug.serving import make_server
+			server = make_server(self.host, self.port, self.app, threaded = True, fd = self._socket.fileno())
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		except BaseException:
+			logging.exception(f"worker {worker_no} failed...")
+			status = 1
+		finally:
+			os._exit(status)
+
+	def __relay_reload(self, signum, frame):
+		"""
+		主进程收到SIGHUP时通知所有工作进程重新加载。
+		"""
+		logging.info(f"reload {len(self._workers)} workers...")
+		for pid in list(self._workers):
+			try:
+				os.kill(pid, signal.SIGHUP)
+			except ProcessLookupError:
+				pass
+
+	def __reload(self, signum, frame):
+		"""
+		工作进程收到SIGHUP时在后台线程中调用on_reload，不阻塞处理请求的线程。
+		"""
+		threading.Thread(target = self.on_reload, name = 'prefork_reload', daemon = True).start()
+
+	def __stop(self, signum, frame):
+		"""
+		主进程收到SIGTERM或者SIGINT时停止所有工作进程。
+		"""
+		if self._stopping:
+			return
+		self._stopping = True
+		logging.info(f"stop {len(self._workers)} workers...")
+		for pid in list(self._workers):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+def notify_reload():
+	"""
+	在PreforkServer的工作进程中调用，通过主进程通知所有工作进程（包括自己）调用on_reload。
+	也可以在命令行中向主进程发送SIGHUP：kill -HUP <主进程pid>。
+	"""
+	os.kill(os.getppid(), signal.SIGHUP)
+
+def run_gunicorn(app, host, port, workers, threads = None, after_fork = None):
+	"""
+	用gunicorn运行WSGI应用，直到gunicorn退出。应用在主进程中已经加载好，gunicorn的工作进程由主进程fork，
+	和PreforkServer一样共享加载好的书籍。需要安装gunicorn。
+
+	:param app: WSGI应用，已经加载好书库。
+	:param host: 监听的地址。
+	:param port: 监听的端口。
+	:param workers: 工作进程数。
+	:param threads: 每个工作进程处理请求的线程数，缺省为GUNICORN_THREADS。
+	:param after_fork: 工作进程启动后、处理请求之前在工作进程中调用的函数，参数为工作进程序号（gunicorn的worker.age减一，
+		重新启动的工作进程的序号继续递增）。
+	"""
+	from gunicorn.app.base import BaseApplication
+
+	options = {
+		'bind': f"[{host}]:{port}" if ':' in host else f"{host}:{port}",
+		'workers': max(1, workers),
+		'worker_class': 'gthread',
+		'threads': threads or GUNICORN_THREADS,
+		'preload_app': True,
+	}
+	if after_fork is not None:
+		options['post_fork'] = lambda server, worker: after_fork(worker.age - 1)
+
+	class _Application(BaseApplication):
+		def load_config(self):
+			for key, value in options.items():
+				self.cfg.set(key, value)
+
+		def load(self):
+			return app
+
+	# 和PreforkServer一样，fork之前冻结所有对象
+	gc.collect()
+	gc.freeze()
+	logging.info(f"freeze {gc.get_freeze_count()} objects, start gunicorn with {options['workers']} workers on {options['bind']}...")
+	_Application().run()
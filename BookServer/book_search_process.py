@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+多进程搜索。
+每个搜索进程常驻，启动时从磁盘加载分配给它的一部分书籍（分片），之后只接收查询语句和要搜索的书籍路径，
+返回每本书的搜索结果，书籍内容不会在进程间传递。搜索是纯Python的字符串匹配，多进程可以绕过GIL，
+搜索速度随CPU核数增加。
+"""
+
+import os
+import logging
+import queue
+import threading
+import itertools
+import traceback
+import multiprocessing
+
+from book_manager import BookManager, QueryObject, QueryBatch, SearchControl, SearchStopped
+
+# 重新加载书籍的任务：(RELOAD_TASK, book_paths)
+RELOAD_TASK = 'reload'
+# 任务控制槽的个数，即同时执行的任务数的上限。每个任务执行期间独占一个槽，槽中为任务的task_id，
+# 任务被取消时主进程把槽改为-1，槽被释放后又分配给其它任务时槽中为新任务的task_id，
+# 搜索进程只在槽中仍然是自己的task_id时继续搜索，不会受到先后使用同一个槽的其它任务的影响
+CANCEL_SLOTS = 1024
+# 已经取消的槽
+CANCELLED = -1
+
+class _TaskControl(SearchControl):
+	"""
+	搜索进程中的SearchControl，取消标志在和主进程共享的内存中。
+	"""
+	def __init__(self, slots, slot, task_id, deadline):
+		super().__init__()
+		self.deadline = deadline
+		self._slots = slots
+		self._slot = slot
+		self._task_id = task_id
+
+	def cancelled(self):
+		return self._slots[self._slot] != self._task_id
+
+def _search_worker(books_path, book_files, index, snapshot_path, task_queue, result_queue, slots):
+	"""
+	搜索进程的入口。
+
+	:param books_path: 书库路径。
+	:param book_files: 本进程负责的书籍文件路径。
+	:param index: 是否为书籍建立BookTextIndex。
+	:param snapshot_path: 本进程的书籍索引快照文件路径，None表示不使用快照。
+	:param task_queue: 接收任务的队列，任务为(task_id, slot, query_string, book_paths, engine, count_only, facets, batch, deadline)，
+		或者(RELOAD_TASK, book_paths)，None表示退出。slot为任务的控制槽，见CANCEL_SLOTS，batch为True时query_string是查询语句列表，
+		deadline为time.monotonic()的截止时间，None表示不限制。
+	:param result_queue: 返回结果的队列，结果为(task_id, book_path, pieces, pieces_count)，
+		book_path为None表示任务完成，此时pieces_count为None时pieces为错误信息，否则pieces表示任务是否被取消或者超时。
+	:param slots: 和主进程共享的任务控制槽，见CANCEL_SLOTS。任务被取消或者超时后不再搜索剩下的书籍。
+	"""
+	# 书库是corpus时不加载书籍，各个搜索进程共享corpus的页缓存
+	manager = BookManager(books_path, load = not os.path.isfile(books_path), load_workers = 1, search_index = index, book_files = book_files, snapshot_path = snapshot_path)
+	books_path_map = {book_index['book_path']: book_index for book_index in manager.books_index}
+
+	while True:
+		task = task_queue.get()
+		if task is None:
+			break
+		if task[0] == RELOAD_TASK:
+			try:
+				manager.reload_books(task[1])
+			except Exception:
+				logging.error(f"reload books failed in search process:\n{traceback.format_exc()}")
+			books_path_map = {book_index['book_path']: book_index for book_index in manager.books_index}
+			continue
+		task_id, slot, query_string, book_paths, engine, count_only, facets, batch, deadline = task
+		control = _TaskControl(slots, slot, task_id, deadline)
+		stopped = False
+		try:
+			if batch:
+				query_batch = QueryBatch([QueryObject(query) for query in query_string])
+			else:
+				query_object = QueryObject(query_string)
+			for book_path in book_paths:
+				book_index = books_path_map.get(book_path)
+				if book_index is None:
+					continue
+				try:
+					if batch:
+						pieces, pieces_count = manager._search_book_many(book_index, query_batch, engine, count_only), None
+					elif count_only:
+						pieces, pieces_count = None, manager._count_book(book_index, query_object, engine, control)
+					elif facets:
+						pieces, pieces_count = manager._facet_book(book_index, query_object, engine)
+					else:
+						pieces, pieces_count = manager._search_book(book_index, query_object, engine, control)
+				except SearchStopped:
+					stopped = True
+					break
+				result_queue.put((task_id, book_path, pieces, pieces_count))
+		except Exception:
+			result_queue.put((task_id, None, traceback.format_exc(), None))
+			continue
+		result_queue.put((task_id, None, stopped, 0))
+
+class ProcessSearchEngine(object):
+	"""
+	常驻多进程的搜索引擎，每个进程负责一个书籍分片。
+	可以被多个线程同时调用。
+	"""
+	# 等待搜索结果时检查搜索进程是否存活的间隔，秒
+	POLL_INTERVAL = 1.0
+	# 有SearchControl时检查取消和超时的间隔，秒
+	CONTROL_POLL_INTERVAL = 0.05
+
+	def __init__(self, books_path, books_index, workers, index = False, snapshot_path = None):
+		"""
+		启动搜索进程，按书籍文件大小均衡地把书籍分配给各个进程。
+
+		:param books_path: 书库路径。
+		:param books_index: BookManager的书籍索引项。
+		:param workers: 搜索进程数。
+		:param index: 搜索进程是否为书籍建立BookTextIndex。
+		:param snapshot_path: 书籍索引快照文件路径，每个搜索进程使用以进程序号为后缀的快照文件。
+		"""
+		self.workers = max(1, workers)
+		self._context = multiprocessing.get_context()
+		self._result_queue = self._context.Queue()
+		self._task_queues = []
+		self._processes = []
+		# book_path -> 搜索进程序号
+		self._shard_map = {}
+		self._task_ids = itertools.count()
+		# task_id -> 接收该任务结果的queue.Queue
+		self._tasks = {}
+		self._tasks_lock = threading.Lock()
+		# 任务控制槽，搜索进程在每本书、每个章节之前检查，见CANCEL_SLOTS；只由持有槽的任务写入，不需要锁
+		self._slots = self._context.Array('q', [CANCELLED] * CANCEL_SLOTS, lock = False)
+		# 空闲的槽，由_tasks_lock保护，没有空闲的槽时新任务等待
+		self._free_slots = list(range(CANCEL_SLOTS))
+		self._slots_available = threading.Semaphore(CANCEL_SLOTS)
+		self._closed = False
+
+		shards = [[] for _ in range(self.workers)]
+		# 每个搜索进程负责的书籍文件大小之和
+		self._shard_sizes = [0] * self.workers
+		for book_index in sorted(books_index, key=lambda b: b.get('size', 0), reverse=True):
+			worker_no = self.__assign(book_index)
+			shards[worker_no].append(book_index['book_path'])
+
+		for worker_no, shard in enumerate(shards):
+			task_queue = self._context.Queue()
+			process = self._context.Process(
+				target = _search_worker,
+				args = (books_path, shard, index, f"{snapshot_path}.{worker_no}" if snapshot_path else None, task_queue, self._result_queue, self._slots),
+				name = f"s_process_{worker_no}",
+				daemon = True)
+			process.start()
+			self._task_queues.append(task_queue)
+			self._processes.append(process)
+
+		self._dispatcher = threading.Thread(target = self.__dispatch, name = 's_dispatcher', daemon = True)
+		self._dispatcher.start()
+		logging.info(f"start {self.workers} search processes for {len(self._shard_map)} books...")
+
+	def __assign(self, book_index):
+		"""
+		把书籍分配给书籍文件大小之和最小的搜索进程。
+
+		:return: int, 搜索进程序号。
+		"""
+		worker_no = self._shard_sizes.index(min(self._shard_sizes))
+		self._shard_sizes[worker_no] += book_index.get('size', 0)
+		self._shard_map[book_index['book_path']] = worker_no
+		return worker_no
+
+	def reload(self, books_index, removed):
+		"""
+		通知搜索进程重新加载新增或修改了的书籍，去掉删除了的书籍。新增的书籍分配给负担最小的搜索进程。
+		搜索进程按顺序处理任务，之后的搜索使用重新加载后的书籍。
+
+		:param books_index: 新增或修改了的书籍索引项。
+		:param removed: 删除了的书籍的book_path。
+		"""
+		if self._closed:
+			return
+		worker_books = {}
+		for book_path in removed:
+			worker_no = self._shard_map.pop(book_path, None)
+			if worker_no is not None:
+				worker_books.setdefault(worker_no, []).append(book_path)
+		for book_index in books_index:
+			worker_no = self._shard_map.get(book_index['book_path'])
+			if worker_no is None:
+				worker_no = self.__assign(book_index)
+			worker_books.setdefault(worker_no, []).append(book_index['book_path'])
+		for worker_no, book_paths in worker_books.items():
+			self._task_queues[worker_no].put((RELOAD_TASK, book_paths))
+
+	def __dispatch(self):
+		"""
+		把搜索进程返回的结果分发给对应任务的queue.Queue。
+		"""
+		while True:
+			result = self._result_queue.get()
+			if result is None:
+				break
+			with self._tasks_lock:
+				task_results = self._tasks.get(result[0])
+			if task_results is not None:
+				task_results.put(result)
+
+	def search(self, query_string, books_index, engine = None, count_only = False, facets = False, batch = False, control = None):
+		"""
+		在给定的书籍中搜索，按照完成的顺序依次返回每本书的搜索结果。
+
+		:param query_string: 查询语句，batch为True时为查询语句列表。
+		:param books_index: 要搜索的书籍索引项。
+		:param engine: 搜索方式，见BookManager.search_all。
+		:param count_only: 是否只统计段落数，为True时pieces为None。
+		:param facets: 是否只按卷、章节统计段落数，为True时pieces为BookManager._facet_book的统计结果。
+		:param batch: 是否同时执行多个查询，为True时pieces为BookManager._search_book_many的结果，pieces_count为None。
+		:param control: SearchControl对象，被取消或者超时后不再输出，并通知搜索进程不再搜索剩下的书籍。
+			调用者停止读取时同样通知搜索进程。
+		:return: generator, 依次输出(书籍索引项, pieces, pieces_count)。
+		"""
+		if self._closed:
+			raise RuntimeError("search processes are closed.")
+
+		books_path_map = {}
+		worker_books = {}
+		for book_index in books_index:
+			worker_no = self._shard_map.get(book_index['book_path'])
+			if worker_no is None:
+				logging.warning(f"《{book_index['title']}》is not in any search process...")
+				continue
+			books_path_map[book_index['book_path']] = book_index
+			worker_books.setdefault(worker_no, []).append(book_index['book_path'])
+
+		task_id = next(self._task_ids)
+		task_results = queue.Queue()
+		self._slots_available.acquire()
+		with self._tasks_lock:
+			self._tasks[task_id] = task_results
+			slot = self._free_slots.pop()
+		self._slots[slot] = task_id
+		deadline = control.deadline if control is not None else None
+		poll_interval = self.CONTROL_POLL_INTERVAL if control is not None else self.POLL_INTERVAL
+		pending = len(worker_books)
+		try:
+			for worker_no, book_paths in worker_books.items():
+				self._task_queues[worker_no].put((task_id, slot, query_string, book_paths, engine, count_only, facets, batch, deadline))
+
+			while pending:
+				if control is not None and control.stopped():
+					control.truncated = True
+					break
+				try:
+					_, book_path, pieces, pieces_count = task_results.get(timeout = poll_interval)
+				except queue.Empty:
+					if not all(process.is_alive() for process in self._processes):
+						raise RuntimeError("search process exited unexpectedly.")
+					continue
+				if book_path is None:
+					if pieces_count is None:
+						raise RuntimeError(f"search failed in search process:\n{pieces}")
+					if pieces and control is not None:
+						control.truncated = True
+					pending -= 1
+					continue
+				yield books_path_map[book_path], pieces, pieces_count
+		finally:
+			# 槽仍然属于本任务，取消后再释放，之后分配给其它任务时槽中的task_id也不再是本任务的
+			if pending:
+				self._slots[slot] = CANCELLED
+			with self._tasks_lock:
+				self._tasks.pop(task_id, None)
+				self._free_slots.append(slot)
+			self._slots_available.release()
+
+	def close(self):
+		"""
+		停止所有搜索进程。
+		"""
+		if self._closed:
+			return
+		self._closed = True
+		for task_queue in self._task_queues:
+			task_queue.put(None)
+		for process in self._processes:
+			process.join(timeout = 5)
+			if process.is_alive():
+				process.terminate()
+		self._result_queue.put(None)
+		self._dispatcher.join(timeout = 5)
@@ -1,14 +1,44 @@
 # 导入 Flask 类, render_template 模块
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
+import os
+import json
+import gzip
+import argparse
+import hashlib
 import logging
-from book_manager import BookManager, QueryObject, QueryResults
+import importlib.util
+from book_manager import BookManager, QueryObject, QueryResults, LRUCache, SearchControl
 
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
+# 启动信息（工作进程数、每个进程的搜索方式）不受上面的日志级别限制，总是记录
+startup_logger = logging.getLogger('book_server.startup')
+startup_logger.setLevel(logging.INFO)
 
 # 实例化并命名为 app 实例
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False  # 禁止中文转义
 
+# 章节、内容、目录的响应在书籍重新加载之前不变，浏览器缓存的秒数，过期后用If-None-Match重新验证
+READ_CACHE_MAX_AGE = 60
+# 响应内容不少于这个字节数时才压缩
+GZIP_MIN_BYTES = 1024
+# 压缩后的响应内容的缓存容量，按压缩后的字节数计算，key为未压缩的表示的ETag
+GZIP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# 压缩的表示与未压缩的是不同的表示，ETag也不同：未压缩的表示的ETag加上这个后缀
+GZIP_ETAG_SUFFIX = "-gz"
+app.gzip_cache = LRUCache(max_bytes = GZIP_CACHE_MAX_BYTES)
+# 搜索的缺省时限，秒，超时后返回已经搜索完的书籍中的结果，truncated为true。请求的timeout参数只能缩短时限
+app.config['SEARCH_TIMEOUT'] = 30.0
+
+def search_timeout(timeout):
+  """
+  由请求的timeout参数和SEARCH_TIMEOUT得到本次搜索的时限，秒，None表示不限制。
+  """
+  limit = app.config.get('SEARCH_TIMEOUT')
+  if timeout is None or timeout <= 0:
+    return limit
+  return timeout if limit is None else min(timeout, limit)
+
 # "基于关键字搜索书库中的书中的内容，给出"访问路由
 # port 6000之前能用，现在莫名其妙的不能用了，提示为：UNSAFE PORT。
 # http://127.0.0.1:6060/book/search?q=大人%20and%20小人
@@ -17,35 +47,151 @@ def search_book_library():
   if request.method == 'GET':
     q = request.args.get('q')
     book_list = request.args.get("book_list")
-    start = request.args.get("start")
-    count = request.args.get("count")
+    start = request.args.get("start", type=int)
+    count = request.args.get("count", type=int)
+    total = request.args.get("total", BookManager.COUNT_ESTIMATE)
     surround = request.args.get("surround", type=int)
+    timeout = request.args.get("timeout", type=float)
 
-    logging.info(f"/book/search, q: {q}, book_list: {book_list}, start: {start}, count: {count}, surround: {surround}.")
+    logging.info(f"/book/search, q: {q}, book_list: {book_list}, start: {start}, count: {count}, total: {total}, surround: {surround}, timeout: {timeout}.")
 
     if start is None:
       start = 0
     
     if q and len(q) > 0:
-      query_results = app.bookmanager.search_all(q, search_book_string=book_list, limit=None)
-      if query_results is not None:
-        to = None if count is None else count
-        query_results = query_results.sub(start, to)
-        for book in query_results.result_pieces:
-          for volume in book['volumes']:
-            for chapter in volume['chapters']:
-              for index, hit in enumerate(chapter['_hits']):
-                hit = query_results.highlights(hit, format=QueryResults.MARK_TEXT, strong = True, surround = surround)
-                chapter['_hits'][index] = hit
-
-      return jsonify({
-          "query_target_count": query_results.query_target_count,
-          "result_pieces_count": query_results.result_pieces_count, 
-          "result_pieces": query_results.result_pieces
-        })
+      # 只搜索到第start+count条结果为止，count为空时返回所有结果
+      control = SearchControl(search_timeout(timeout))
+      query_results = app.bookmanager.search_page(q, search_book_string=book_list, start=start, count=count, total=total, control=control)
+      return jsonify(search_response(query_results, surround))
+    else:
+      return jsonify(error="q parameter is missing."), 400  # 使用HTTP状态码400表示错误请求
+
+# "基于关键字搜索书库中的书中的内容，逐本书返回结果"访问路由
+# 每本书搜索完成后立即返回该书已经高亮的结果，最后返回结果总数。
+# 缺省按照NDJSON格式返回，每行一个json对象；请求头Accept为text/event-stream时按照Server-Sent Events格式返回。
+# 每本书的结果：{"order": 该书在最终结果中的顺序, "result_pieces_count": 该书的结果数, "result_piece": 该书的结果}
+# 最后的结果：{"done": true, "query_target_count": 搜索的书籍数, "result_pieces_count": 结果总数, "truncated": 是否超时}
+# 客户端断开连接后停止搜索。
+# http://127.0.0.1:6060/book/search/stream?q=大人%20and%20小人
+@app.route("/book/search/stream", methods=["GET"])
+def search_book_library_stream():
+  if request.method == 'GET':
+    q = request.args.get('q')
+    book_list = request.args.get("book_list")
+    surround = request.args.get("surround", type=int)
+    timeout = request.args.get("timeout", type=float)
+    event_stream = request.accept_mimetypes.best == 'text/event-stream'
+
+    logging.info(f"/book/search/stream, q: {q}, book_list: {book_list}, surround: {surround}, timeout: {timeout}.")
+
+    if not q or len(q) == 0:
+      return jsonify(error="q parameter is missing."), 400  # 使用HTTP状态码400表示错误请求
+
+    def message(data):
+      data = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+      return f"data: {data}\n\n" if event_stream else f"{data}\n"
+
+    control = SearchControl(search_timeout(timeout))
+
+    def generate():
+      query_results = QueryResults(QueryObject(q))
+      query_target_count = 0
+      result_pieces_count = 0
+      try:
+        for order, _, pieces, pieces_count in app.bookmanager.iter_search(q, search_book_string=book_list, ordered=False, control=control):
+          query_target_count += 1
+          if pieces is None:
+            continue
+          highlight_result_pieces(query_results, [pieces], surround)
+          result_pieces_count += pieces_count
+          yield message({"order": order, "result_pieces_count": pieces_count, "result_piece": pieces})
+        yield message({"done": True, "query_target_count": query_target_count, "result_pieces_count": result_pieces_count, "truncated": control.truncated})
+      finally:
+        # 客户端断开连接时生成器被关闭，正在搜索的书籍在下一个章节之前停止
+        control.cancel()
+
+    mimetype = 'text/event-stream' if event_stream else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# "统计书库中每本书、每卷、每个章节符合查询条件的段落数"访问路由
+# 只返回段落数，不返回段落内容：
+# {"query_target_count": 搜索的书籍数, "result_pieces_count": 段落总数,
+#  "result_facets": [{"title", "count", "volumes": [{"vno", "title", "count", "chapters": [{"cno", "title", "count"}]}]}]}
+# http://127.0.0.1:6060/book/search/facets?q=大人%20and%20小人
+@app.route("/book/search/facets", methods=["GET"])
+def search_book_library_facets():
+  if request.method == 'GET':
+    q = request.args.get('q')
+    book_list = request.args.get("book_list")
+
+    logging.info(f"/book/search/facets, q: {q}, book_list: {book_list}.")
+
+    if q and len(q) > 0:
+      return jsonify(app.bookmanager.search_facets(q, search_book_string=book_list))
     else:
       return jsonify(error="q parameter is missing."), 400  # 使用HTTP状态码400表示错误请求
 
+# "同时执行多个查询"访问路由
+# 每本书只扫描一次，所有查询共用一次扫描。查询语句用多个q参数给出，或者POST json：
+# {"queries": [查询语句...], "book_list": 要搜索的书籍, "count": 每个查询的结果数, "count_only": 是否只统计段落数, "surround": 上下文字数}
+# 按查询的顺序返回每个查询的结果：{"results": [/book/search或者/book/search/facets的结果...]}
+# http://127.0.0.1:6060/book/search/batch?q=大人&q=小人&count_only=true
+@app.route("/book/search/batch", methods=["GET", "POST"])
+def search_book_library_batch():
+  if request.method == 'POST':
+    params = request.get_json(silent=True) or {}
+    queries = params.get("queries")
+    book_list = params.get("book_list")
+    count = params.get("count")
+    count_only = bool(params.get("count_only"))
+    surround = params.get("surround")
+  else:
+    queries = request.args.getlist('q')
+    book_list = request.args.get("book_list")
+    count = request.args.get("count", type=int)
+    count_only = request.args.get("count_only", "false").lower() in ("1", "true")
+    surround = request.args.get("surround", type=int)
+
+  logging.info(f"/book/search/batch, {len(queries or [])} queries, book_list: {book_list}, count: {count}, count_only: {count_only}, surround: {surround}.")
+
+  if not queries or not isinstance(queries, list) or not all(isinstance(q, str) and len(q) > 0 for q in queries):
+    return jsonify(error="queries parameter is missing."), 400  # 使用HTTP状态码400表示错误请求
+
+  results = app.bookmanager.search_many(queries, search_book_string=book_list, limit=count, count_only=count_only)
+  if count_only:
+    return jsonify({"results": results})
+
+  for query_results in results:
+    highlight_result_pieces(query_results, query_results.result_pieces, surround)
+  return jsonify({"results": [{
+      "query_target_count": query_results.query_target_count,
+      "result_pieces_count": query_results.result_pieces_count,
+      "result_pieces": query_results.result_pieces
+    } for query_results in results]})
+
+def search_response(query_results, surround):
+  """
+  高亮search_page的结果，生成/book/search的响应内容。truncated为true时搜索被取消或者超时，只包含部分结果。
+  """
+  highlight_result_pieces(query_results, query_results.result_pieces, surround)
+  return {
+    "query_target_count": query_results.query_target_count,
+    "result_pieces_count": query_results.result_pieces_count,
+    "result_pieces_count_estimated": query_results.result_pieces_count_estimated,
+    "truncated": query_results.truncated,
+    "result_pieces": query_results.result_pieces
+  }
+
+def highlight_result_pieces(query_results, result_pieces, surround):
+  """
+  将搜索结果中的每个段落替换为高亮后的文本。
+  """
+  highlighter = query_results.highlighter(format=QueryResults.MARK_TEXT, strong = True, surround = surround)
+  for book in result_pieces:
+    for volume in book['volumes']:
+      for chapter in volume['chapters']:
+        chapter['_hits'] = [highlighter.highlight(hit) for hit in chapter['_hits']]
+
 @app.route("/book/list", methods=["GET"])
 def get_book_list():
   if request.method == 'GET':
@@ -61,6 +207,62 @@ def get_book_list():
       "result_pieces": query_results.result_pieces
     })
   
+def book_etag(q, *args):
+  """
+  由书籍的版本和请求参数生成ETag，书籍不存在时返回None。
+  """
+  version = app.bookmanager.get_book_version(q)
+  if version is None:
+    return None
+  key = json.dumps([version, request.path] + list(args), ensure_ascii=False)
+  return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+def read_response(etag, make_body, error):
+  """
+  返回书籍只读内容的响应。
+  压缩的和未压缩的响应内容是不同的表示，压缩的表示的ETag是etag加上GZIP_ETAG_SUFFIX。
+  If-None-Match包含将要发送的表示的ETag时返回304：接受gzip的客户端缓存了压缩的表示，或者不接受gzip的客户端缓存了未压缩的表示时，
+  不生成响应内容；接受gzip的客户端缓存了未压缩的表示（内容短于GZIP_MIN_BYTES，不压缩）时，生成响应内容才知道是否压缩。
+  客户端接受gzip时返回缓存的压缩内容，每个ETag只压缩一次。
+
+  :param etag: book_etag生成的未压缩的表示的ETag，None表示书籍不存在。
+  :param make_body: 生成响应内容的函数，返回json编码的bytes，找不到内容时返回None。
+  :param error: 找不到内容时的错误信息。
+  """
+  if etag is None:
+    return jsonify(error=error), 400  # 使用HTTP状态码400表示错误请求
+  headers = {"Cache-Control": f"public, max-age={READ_CACHE_MAX_AGE}", "Vary": "Accept-Encoding"}
+  gzip_accepted = request.accept_encodings['gzip'] > 0
+  gzip_etag = f"{etag}{GZIP_ETAG_SUFFIX}"
+  if request.if_none_match.contains(gzip_etag if gzip_accepted else etag):
+    return not_modified_response(gzip_etag if gzip_accepted else etag, headers)
+
+  body = app.gzip_cache.get(etag) if gzip_accepted else None
+  if body is None:
+    body = make_body()
+    if body is None:
+      return jsonify(error=error), 400  # 使用HTTP状态码400表示错误请求
+    if gzip_accepted and len(body) >= GZIP_MIN_BYTES:
+      body = gzip.compress(body, compresslevel=6, mtime=0)
+      app.gzip_cache.put(etag, body, size=len(body))
+    else:
+      gzip_etag = None
+  if gzip_etag is not None:
+    headers["Content-Encoding"] = "gzip"
+  elif gzip_accepted and request.if_none_match.contains(etag):
+    return not_modified_response(etag, headers)
+  response = Response(body, mimetype='application/json', headers=headers)
+  response.set_etag(gzip_etag or etag)
+  return response
+
+def not_modified_response(etag, headers):
+  """
+  返回304响应。
+  """
+  response = Response(status=304, headers=headers)
+  response.set_etag(etag)
+  return response
+
 @app.route("/book/catalogue", methods=["GET"])
 def get_book_catalogue():
   if request.method == 'GET':
@@ -68,12 +270,7 @@ def get_book_catalogue():
 
     logging.info(f"/book/catalogue, q: {q}.")
 
-    book_catalogue = app.bookmanager.get_book_catalogue(q)
-
-    if book_catalogue is not None:
-      return jsonify(book_catalogue)
-    else:
-      return jsonify(error="can't find book catalogue."), 400  # 使用HTTP状态码400表示错误请求
+    return read_response(book_etag(q), lambda: app.bookmanager.get_book_catalogue_json(q), "can't find book catalogue.")
 
 @app.route("/book/chapter", methods=["GET"])
 def get_book_chapter():
@@ -84,12 +281,32 @@ def get_book_chapter():
 
     logging.info(f"/book/chapter, q: {q}, vno: {vno}, cno: {cno}.")
 
-    book_chapter = app.bookmanager.get_book_chapter(q, vno, cno)
+    return read_response(book_etag(q, vno, cno), lambda: app.bookmanager.get_book_chapter_json(q, vno, cno), "can't find book chapter.")
 
-    if book_chapter is not None:
-      return jsonify(book_chapter)
-    else:
-      return jsonify(error="can't find book chapter."), 400  # 使用HTTP状态码400表示错误请求
+# "分页获取章节中的段落"访问路由
+# 按章节中的段落序号offset和段落数limit，或者按搜索结果_pids中的书籍段落编号pid获取段落，pid所在的一页包含该段落：
+# {"vno", "cno", "title", "offset": 第一个段落在章节中的序号, "pid": 第一个段落的书籍段落编号, "paragraphs_count": 章节的段落数, "paragraphs"}
+# http://127.0.0.1:6060/book/paragraphs?q=论语&cno=0&offset=0&limit=20
+# http://127.0.0.1:6060/book/paragraphs?q=论语&pid=120
+@app.route("/book/paragraphs", methods=["GET"])
+def get_book_paragraphs():
+  if request.method == 'GET':
+    q = request.args.get('q')
+    vno = request.args.get('vno', type=int)
+    cno = request.args.get('cno', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', BookManager.PARAGRAPH_PAGE_SIZE, type=int)
+    pid = request.args.get('pid', type=int)
+
+    logging.info(f"/book/paragraphs, q: {q}, vno: {vno}, cno: {cno}, offset: {offset}, limit: {limit}, pid: {pid}.")
+
+    def make_body():
+      paragraphs = app.bookmanager.get_book_paragraphs(q, vno, cno, offset=offset, limit=limit, pid=pid)
+      if paragraphs is None:
+        return None
+      return json.dumps(paragraphs, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    return read_response(book_etag(q, vno, cno, offset, limit, pid), make_body, "can't find book paragraphs.")
 
 @app.route("/book/content", methods=["GET"])
 def get_book_content():
@@ -100,16 +317,139 @@ def get_book_content():
 
     logging.info(f"/book/content, q: {q}, v: {v}, c: {c}.")
 
-    book_content = app.bookmanager.get_book_content(q, v, c)
+    return read_response(book_etag(q, v, c), lambda: app.bookmanager.get_book_content_json(q, v, c), "can't find book content.")
 
-    if book_content is not None:
-      return jsonify(book_content)
-    else:
-      return jsonify(error="can't find book content."), 400  # 使用HTTP状态码400表示错误请求
+@app.route("/book/stats", methods=["GET"])
+def get_book_stats():
+  if request.method == 'GET':
+    logging.info(f"/book/stats.")
+
+    return jsonify({
+      "books_count": len(app.bookmanager.books_index),
+      "caches": dict(app.bookmanager.get_cache_stats(), gzip=app.gzip_cache.stats())
+    })
+
+def env_flag(name):
+  return os.environ.get(name, "").lower() in ("1", "true", "yes")
 
 # 定义 main 入口
-if __name__ == "__main__":
+# 参数可以用命令行或者环境变量给出，命令行优先：
+#   python book_server.py --books ./books --port 6060 --workers 4
+#   BOOKMAN_BOOKS=./books.corpus BOOKMAN_WORKERS=4 python book_server.py
+# workers为0（缺省）时在一个进程中用Flask的开发服务器运行，--debug时打开调试模式，--search-processes大于0时用多进程搜索。
+# workers大于0时在多进程中运行（见book_prefork），安装了gunicorn时缺省用gunicorn，
+# 否则用werkzeug的多线程服务器，它是开发用的服务器，应该放在反向代理之后。
+# 多进程搜索的进程不能跨fork，workers大于0时每个工作进程在自己的进程中用多线程搜索，不能同时指定--search-processes。
+# 启动时记录每个进程实际使用的搜索方式。
+def parse_args(argv = None):
+  parser = argparse.ArgumentParser(description = "BookMan server.")
+  parser.add_argument('--books', dest = 'books_path', default = os.environ.get('BOOKMAN_BOOKS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'books')),
+    help = "the directory of the *.json books, or a compact corpus file, env BOOKMAN_BOOKS, default is ./books next to this file.")
+  parser.add_argument('--host', default = os.environ.get('BOOKMAN_HOST', "0.0.0.0"), help = "the address to listen on, env BOOKMAN_HOST.")
+  parser.add_argument('--port', type = int, default = int(os.environ.get('BOOKMAN_PORT', 6060)), help = "the port to listen on, env BOOKMAN_PORT.")
+  parser.add_argument('--workers', type = int, default = int(os.environ.get('BOOKMAN_WORKERS', 0)),
+    help = "the number of worker processes forked after the books are loaded, env BOOKMAN_WORKERS. "
+      "0 (default) runs the development server in one process. With workers > 0 (e.g. the number of CPUs) "
+      "each worker searches with threads in its own process, so --search-processes can't be used, and the server is chosen by --server.")
+  parser.add_argument('--search-processes', dest = 'search_processes', type = int, default = os.environ.get('BOOKMAN_SEARCH_PROCESSES') and int(os.environ['BOOKMAN_SEARCH_PROCESSES']),
+    help = "the number of long-lived search processes (see book_search_process) with --workers 0, env BOOKMAN_SEARCH_PROCESSES, "
+      f"default is {BookManager.SEARCH_PROCESS_NUM}, 0 searches with threads in the server process.")
+  parser.add_argument('--no-load', dest = 'load', action = 'store_false', default = not env_flag('BOOKMAN_NO_LOAD'),
+    help = "don't load the books to memory, env BOOKMAN_NO_LOAD.")
+  parser.add_argument('--index', action = 'store_true', default = env_flag('BOOKMAN_INDEX'), help = "build the search index of the books, env BOOKMAN_INDEX.")
+  parser.add_argument('--snapshot', dest = 'snapshot_path', default = os.environ.get('BOOKMAN_SNAPSHOT'), help = "the snapshot file to warm start, env BOOKMAN_SNAPSHOT.")
+  parser.add_argument('--watch', dest = 'watch_interval', type = float, default = os.environ.get('BOOKMAN_WATCH') and float(os.environ['BOOKMAN_WATCH']),
+    help = "reload the changed books every WATCH seconds, env BOOKMAN_WATCH. With --workers > 0 only worker 0 checks the books "
+      "and writes the snapshot, the other workers reload after it finds changes; kill -HUP <master pid> reloads all workers.")
+  parser.add_argument('--search-timeout', dest = 'search_timeout', type = float, default = float(os.environ.get('BOOKMAN_SEARCH_TIMEOUT', app.config['SEARCH_TIMEOUT'])),
+    help = "the time limit of a search in seconds, 0 for no limit, env BOOKMAN_SEARCH_TIMEOUT.")
+  parser.add_argument('--server', choices = ('auto', 'gunicorn', 'builtin'), default = os.environ.get('BOOKMAN_SERVER', 'auto'),
+    help = "the server of the worker processes when --workers > 0, env BOOKMAN_SERVER. "
+      "gunicorn: gunicorn's gthread workers, for production, needs the gunicorn package, can't be used with --watch. "
+      "builtin: werkzeug's threaded server in each forked worker, which is a development server "
+      "(a thread per request, no request timeout or connection limit), run it behind a reverse proxy such as nginx. "
+      "auto (default): gunicorn if it is installed and --watch is not given, otherwise builtin.")
+  parser.add_argument('--debug', action = 'store_true', default = env_flag('BOOKMAN_DEBUG'), help = "run the development server in debug mode, implies --workers 0, env BOOKMAN_DEBUG.")
+  args = parser.parse_args(argv)
+
+  if args.debug:
+    args.workers = 0
+  if args.server == 'auto':
+    args.server = 'gunicorn' if importlib.util.find_spec('gunicorn') is not None and not args.watch_interval else 'builtin'
+  elif args.server == 'gunicorn' and args.watch_interval and args.workers > 0:
+    parser.error("--watch can't be used with --server gunicorn, use --server builtin.")
+  if args.search_processes and args.workers > 0:
+    parser.error("--search-processes can't be used with --workers > 0, the search processes can't be shared by the forked workers.")
+  app.config['SEARCH_TIMEOUT'] = args.search_timeout or None
+  return args
+
+def create_bookmanager(args, **kwargs):
+  """
+  按parse_args的参数加载书库，kwargs覆盖BookManager的其它参数。
+  """
+  kwargs.setdefault('watch_interval', args.watch_interval)
+  kwargs.setdefault('search_processes', args.search_processes)
+  return BookManager(args.books_path, args.load, search_index = args.index, snapshot_path = args.snapshot_path, **kwargs)
+
+def search_engine_info(bookmanager, index):
+  """
+  描述书库实际使用的搜索方式，启动时记录。
+
+  :param index: 是否建立了搜索索引（有搜索进程时由搜索进程建立）。
+  """
+  if bookmanager.search_engine is not None:
+    engine = f"{bookmanager.search_processes} search processes"
+  else:
+    engine = f"threads in process {os.getpid()} ({bookmanager.QUERY_THREAD_NUM} books at a time)"
+  return f"{engine}, {'with' if index else 'without'} the search index"
+
+def main():
+  args = parse_args()
+
+  if args.workers == 0:
     # load all books from library path
-    app.bookmanager = BookManager('/Users/sunyafu/zebra/BookMan/BookServer/books', True)
+    app.bookmanager = create_bookmanager(args)
+    startup_logger.info(f"search with {search_engine_info(app.bookmanager, args.index)}.")
     # 调用 run 方法，设定端口号，启动服务
-    app.run(port = 6060, host = "0.0.0.0", debug = True)
\ No newline at end of file
+    app.run(port = args.port, host = args.host, debug = args.debug, use_reloader = False)
+    return
+
+  # 在主进程中加载书库，工作进程共享加载好的书籍；多进程搜索和热加载的线程不能跨fork，热加载在工作进程中启动
+  app.bookmanager = create_bookmanager(args, search_processes = 0, watch_interval = None)
+
+  def log_search_engine(worker_no):
+    startup_logger.info(f"worker {worker_no} searches with {search_engine_info(app.bookmanager, args.index)}.")
+
+  if args.server == 'gunicorn':
+    from book_prefork import run_gunicorn
+    run_gunicorn(app, args.host, args.port, args.workers, after_fork = log_search_engine)
+    return
+
+  from book_prefork import PreforkServer, notify_reload
+
+  def reload_books():
+    try:
+      app.bookmanager.reload_books()
+    except Exception:
+      logging.exception(f"reload books from {app.bookmanager.books_path} failed...")
+
+  def after_fork(worker_no):
+    log_search_engine(worker_no)
+    if not args.watch_interval:
+      return
+    # 重新启动的工作进程从主进程fork，主进程中的书库可能已经过时，处理请求之前先重新加载
+    if worker_no != 0:
+      # 快照只由0号工作进程写入
+      app.bookmanager.snapshot_path = None
+    reload_books()
+    if worker_no == 0:
+      # 只有0号工作进程检查书库的变化，重新加载后通过主进程通知其它工作进程重新加载
+      from book_watcher import BookWatcher
+      app.bookmanager.watcher = BookWatcher(app.bookmanager, args.watch_interval, on_reload = lambda changed, removed: notify_reload())
+      app.bookmanager.watcher.start()
+
+  PreforkServer(app, args.host, args.port, args.workers, after_fork = after_fork,
+    on_reload = reload_books if args.watch_interval else None).serve_forever()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+书库索引快照。
+把加载书库时生成的派生结构（查找表、目录、拼音排序key、BookTextIndex等，即书籍索引项中除书籍内容以外的部分）
+保存到快照文件，下次加载书库时，书籍文件的大小和修改时间都没有变化的书籍直接使用快照中的索引项，
+只有变化了的书籍才需要重新生成。
+快照文件用pickle保存，只能读取自己生成的快照文件。
+"""
+
+import os
+import time
+import pickle
+import logging
+import tempfile
+
+# 快照格式或者书籍索引项的结构变化时加一，旧版本的快照会被忽略
+SNAPSHOT_VERSION = 4
+# 不保存到快照中的书籍索引项的key
+SNAPSHOT_EXCLUDED_KEYS = ('content', 'load_time', 'corpus')
+
+def read_snapshot(snapshot_path):
+	"""
+	读取快照文件。
+
+	:param snapshot_path: 快照文件路径。
+	:return: dict, book_path -> 书籍索引项（不包含书籍内容）；快照文件不存在、版本不同或者读取失败时返回空的dict。
+	"""
+	begin = time.perf_counter()
+	try:
+		with open(snapshot_path, 'rb') as file:
+			snapshot = pickle.load(file)
+	except FileNotFoundError:
+		return {}
+	except Exception as e:
+		logging.warning(f"read snapshot {snapshot_path} failed: {e}")
+		return {}
+	if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+		logging.warning(f"ignore snapshot {snapshot_path} of another version...")
+		return {}
+	logging.info(f"read snapshot {snapshot_path}, {len(snapshot['books'])} books in {time.perf_counter() - begin:.1f}s...")
+	return snapshot['books']
+
+def write_snapshot(snapshot_path, books_index, snapshot = None):
+	"""
+	写入快照文件。先写入同一目录下的临时文件，完成后替换snapshot_path。
+
+	:param snapshot_path: 快照文件路径。
+	:param books_index: 书籍索引项。
+	:param snapshot: 之前读取的快照，书籍没有变化而本次加载没有建立BookTextIndex时，保留快照中的BookTextIndex。
+	:return: boolean, 是否写入成功。
+	"""
+	begin = time.perf_counter()
+	books = {}
+	for book_index in books_index:
+		entry = {key: value for key, value in book_index.items() if key not in SNAPSHOT_EXCLUDED_KEYS}
+		if entry.get('text_index') is None and snapshot:
+			previous = snapshot.get(entry['book_path'])
+			if previous is not None and previous.get('size') == entry['size'] and previous.get('mtime') == entry['mtime']:
+				entry['text_index'] = previous.get('text_index')
+		books[entry['book_path']] = entry
+
+	snapshot_dir = os.path.dirname(os.path.abspath(snapshot_path))
+	try:
+		fd, temp_path = tempfile.mkstemp(dir = snapshot_dir, prefix = '.snapshot_')
+	except OSError as e:
+		logging.warning(f"write snapshot {snapshot_path} failed: {e}")
+		return False
+	try:
+		with os.fdopen(fd, 'wb') as file:
+			pickle.dump({'version': SNAPSHOT_VERSION, 'books': books}, file, protocol = pickle.HIGHEST_PROTOCOL)
+		os.replace(temp_path, snapshot_path)
+	except Exception as e:
+		os.unlink(temp_path)
+		logging.warning(f"write snapshot {snapshot_path} failed: {e}")
+		return False
+	logging.info(f"write snapshot {snapshot_path}, {len(books)} books in {time.perf_counter() - begin:.1f}s...")
+	return True
+
+def snapshot_book_index(snapshot, book_path, size, mtime, index = False):
+	"""
+	获取书籍在快照中仍然有效的索引项。
+
+	:param snapshot: read_snapshot返回的dict。
+	:param book_path: 书籍文件路径。
+	:param size: 书籍文件当前的大小。
+	:param mtime: 书籍文件当前的修改时间。
+	:param index: 是否需要BookTextIndex。
+	:return: dict, 书籍索引项的副本，content为None，load_time为0，不需要BookTextIndex时text_index为None；
+		书籍不在快照中，书籍文件已经变化，或者需要BookTextIndex而快照中没有时返回None。
+	"""
+	entry = snapshot.get(book_path)
+	if entry is None or entry.get('size') != size or entry.get('mtime') != mtime:
+		return None
+	if index and entry.get('text_index') is None:
+		return None
+	book_index = dict(entry)
+	book_index['content'] = None
+	book_index['load_time'] = 0.0
+	if not index:
+		book_index['text_index'] = None
+	return book_index
@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+"""
+等价性检查。
+书库没有单独的测试目录，这里把优化过的实现和最初的实现放在同一个书库上对比，结果必须完全一致：
+	check_keyword_matcher，KeywordMatcher的Aho–Corasick自动机（关键字不少于AUTOMATON_MIN_KEYS）与逐个子串查找、re.finditer；
+	check_query_plan，编译后的QueryPlan与最初的逐段解释执行（QueryObject.excute_query(content, query_list)）；
+	check_search，search_all的各种搜索方式与逐段解释执行的结果；
+	check_corpus，compact corpus的往返：BookCorpus.load_book与书籍json相同，从corpus加载的search_all、get_book_chapter与从json加载的相同；
+	check_snapshot，快照失效：书籍文件变化后不使用快照中过时的索引项，search_all、get_book_chapter与不使用快照时相同；
+	check_reload，热加载：书籍文件修改、新增、删除后，reload_books和BookWatcher重新加载的结果与重新创建的BookManager相同，
+		重新加载之前开始的搜索仍然使用原来的书籍；
+	check_markdown，BMD编译：编译生成的书籍加载后，get_book_chapter与直接解析BMD得到的章节相同。
+每个检查返回不一致之处的描述列表，空列表表示一致。
+不指定书库（BMD文件）时，检查在临时目录中生成自己的小书库（见make_library、make_markdown），
+书库中有书名相同的书、没有段落的章节、没有章节的卷等容易出错的情况，test_book_verify.py用pytest运行这些检查：
+	python -m pytest test_book_verify.py
+
+也可以在命令行中对一个书库运行，逐段解释执行很慢，书库只需要几十本书：
+	python book_verify.py [书库路径] [--bmd <*.bmd文件>]
+"""
+
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import logging
+import threading
+import argparse
+import functools
+import tempfile
+
+from book_manager import BookManager, KeywordMatcher, QueryObject, title_sort_key
+
+# 固定的查询语句，覆盖AND, OR, NOT, 括号和正则表达式特殊字符
+QUERIES = [
+	"大人", "大人 or 小人 or 君子 or 圣人", "大人 and 小人", "(大人 or 小人) and not 君子", "not 君子",
+	"天下 and (子曰 or not 仁义)", "君子 not 小人", "h or (a and (b or c))", "仁义 and not (礼乐 or 天下) or 布衣", "b.",
+]
+# 由书库内容生成的随机查询语句数
+RANDOM_QUERY_NUM = 40
+# check_reload中BookWatcher的检查间隔和等待重新加载的最长时间，秒
+RELOAD_WATCH_INTERVAL = 0.05
+RELOAD_TIMEOUT = 10.0
+# 生成的检查用书库的书籍数，多于QUERY_THREAD_NUM，多线程搜索时分成几批
+FIXTURE_BOOKS_NUM = 14
+# 生成的检查用书库的书名，书名相同的书见make_library
+FIXTURE_TITLES = ["诗经", "周礼", "尚书", "左传", "国语", "论语", "孟子", "荀子", "墨子", "庄子", "老子", "韩非子", "周易", "易传"]
+# 生成段落内容用的字符，段落中再插入QUERIES中的词
+FIXTURE_CHARS = "天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜金生丽水玉出昆冈abch."
+FIXTURE_WORDS = ["大人", "小人", "君子", "圣人", "布衣", "天下", "子曰", "仁义", "礼乐", "b.", "h"]
+# 生成的检查用BMD文件：两本同名的书，有注释、文内注释、节和没有段落的章节
+FIXTURE_MARKDOWN = """# 前缀|书名
+[author] 汉,某甲,撰
+[category] 经部,诗类
+[description] 检查用的书
+
+## 卷一
+### 隐公
+大人者，不失其赤子之心者也。
+!!! 某乙,注
+::: 赤子，婴儿也。
+    !!! 某丙,音义
+    ::: 婴儿，初生之子。
+
+君子坦荡荡，小人长戚戚。
+
+### 空章
+
+#### 一节
+子曰：学而时习之。
+
+## 卷二
+### 隐公
+天下有道则见。
+
+# 前缀|书名
+[date] 唐
+## 卷一
+### 第一章
+仁义礼乐。
+"""
+
+def make_library(books_path, books_num = FIXTURE_BOOKS_NUM, seed = 1):
+	"""
+	在books_path中生成检查用的小书库，内容由seed确定。书库包含以下容易出错的情况：
+	书名相同的两本书（BookDefine.bmd生成的“前缀·书名”），后一本的卷更多；没有段落的章节，没有paragraphs的章节，没有章节的卷；
+	同一卷中同名的章节；空的段落，有annotations（corpus中的extras）的段落。
+
+	:param books_path: 书库目录，不存在时创建。
+	:param books_num: 书籍数，不少于4。
+	:return: list, 生成的书籍json文件路径。
+	"""
+	rand = random.Random(seed)
+	os.makedirs(books_path, exist_ok = True)
+
+	def _paragraph():
+		content = "".join(rand.choice(FIXTURE_CHARS) for _ in range(rand.randint(0, 40)))
+		for _ in range(rand.randint(0, 2)):
+			position = rand.randint(0, len(content))
+			content = content[:position] + rand.choice(FIXTURE_WORDS) + content[position:]
+		paragraph = {"content": content}
+		if rand.random() < 0.2:
+			paragraph["annotations"] = [{"annotator": "某乙", "type": "注", "start": 0, "end": len(content), "content": content[::-1]}]
+		return paragraph
+
+	book_paths = []
+	for book_no in range(books_num):
+		volumes = []
+		for vno in range(rand.randint(1, 3) + (2 if book_no == 2 else 0)):
+			chapters = [{"title": rand.choice(("隐公", "桓公", f"第{cno + 1}章")), "paragraphs": [_paragraph() for _ in range(rand.randint(1, 6))]}
+				for cno in range(rand.randint(1, 4))]
+			volumes.append({"title": f"卷{vno + 1}" if vno else "", "chapters": chapters})
+		if book_no == 3:
+			volumes[0]["chapters"] += [{"title": "空章", "paragraphs": []}, {"title": "无段落"}]
+			volumes.append({"title": "空卷", "chapters": []})
+		title = "前缀·书名" if book_no in (1, 2) else FIXTURE_TITLES[book_no % len(FIXTURE_TITLES)]
+		book = {"title": title, "description": f"描述{title}", "category": ("经部", "史部", "子部")[book_no % 3], "date": ("先秦", "汉")[book_no % 2],
+			"authors": [{"name": f"作者{book_no % 4}"}], "volumes": volumes}
+		book_path = os.path.join(books_path, f"{book_no:04d}.json")
+		with open(book_path, 'w', encoding='utf-8') as file:
+			json.dump(book, file, ensure_ascii=False)
+		book_paths.append(book_path)
+	return book_paths
+
+def make_markdown(bmd_path):
+	"""
+	生成检查用的BMD文件（FIXTURE_MARKDOWN）。
+	"""
+	with open(bmd_path, 'w', encoding='utf-8') as file:
+		file.write(FIXTURE_MARKDOWN)
+
+def _with_library(check):
+	"""
+	检查函数的装饰器：books_path为None时，在临时目录中生成检查用的小书库（见make_library）再检查。
+	"""
+	@functools.wraps(check)
+	def _check(books_path = None, *args, **kwargs):
+		if books_path is not None:
+			return check(books_path, *args, **kwargs)
+		with tempfile.TemporaryDirectory() as temp_dir:
+			books_path = os.path.join(temp_dir, 'books')
+			make_library(books_path)
+			return check(books_path, *args, **kwargs)
+	return _check
+
+def _book_paths(books_path):
+	return [os.path.join(books_path, filename) for filename in sorted(os.listdir(books_path)) if filename.endswith(".json")]
+
+def _load_json(book_path):
+	with open(book_path, 'r', encoding='utf-8') as file:
+		return json.load(file)
+
+def _iter_contents(books_path):
+	for book_path in _book_paths(books_path):
+		for volume in _load_json(book_path)["volumes"]:
+			for chapter in volume["chapters"]:
+				for paragraph in chapter.get("paragraphs") or []:
+					yield paragraph["content"]
+
+def _sample_words(books_path, count, seed = 1):
+	"""
+	从书库的段落中随机截取count个一到三个字的词，用于生成查询语句和关键字。
+	"""
+	rand = random.Random(seed)
+	contents = [content for content in _iter_contents(books_path) if content]
+	words = []
+	for _ in range(count if contents else 0):
+		content = rand.choice(contents)
+		start = rand.randrange(len(content))
+		words.append(content[start : start + rand.randint(1, 3)])
+	return words
+
+def make_queries(books_path, count = RANDOM_QUERY_NUM, seed = 1):
+	"""
+	生成检查用的查询语句：QUERIES，以及用书库中的词随机组合的查询语句。
+	"""
+	rand = random.Random(seed)
+	words = _sample_words(books_path, count * 3, seed) or ["大人"]
+	queries = list(QUERIES)
+	for _ in range(count):
+		terms = [rand.choice(words) for _ in range(rand.randint(1, 4))]
+		query = terms[0]
+		for term in terms[1:]:
+			query = f"{query} {rand.choice(('and', 'or', 'and not', 'or not'))} {term}"
+			if rand.random() < 0.3:
+				query = f"({query})"
+		queries.append(query)
+	return queries
+
+def baseline_hits(manager, query_string):
+	"""
+	最初的搜索方式：逐本书、逐个段落解释执行查询语句。
+
+	:return: list, 按_hit_key排序的(书名, 段落编号, 段落内容)。
+	"""
+	query_object = QueryObject(query_string)
+	hits = []
+	for book_index in sorted(manager.books_index, key=lambda book_index: book_index['sort_key']):
+		book = manager.load_book_byindex(book_index)
+		pid = 0
+		for volume in book["volumes"]:
+			for chapter in volume["chapters"]:
+				for paragraph in chapter.get("paragraphs") or []:
+					if query_object.excute_query(paragraph["content"], query_object.query_list) == True:
+						hits.append((book["title"], pid, paragraph["content"]))
+					pid += 1
+	hits.sort(key=_hit_key)
+	return hits
+
+def result_hits(query_results):
+	"""
+	把search_all的结果展开为(书名, 段落编号, 段落内容)，与baseline_hits比较。
+	"""
+	return pieces_hits(query_results.result_pieces)
+
+def pieces_hits(pieces):
+	"""
+	把每本书的搜索结果（search_all的result_pieces，iter_search输出的pieces）展开为(书名, 段落编号, 段落内容)。
+	"""
+	hits = []
+	for piece in pieces:
+		for volume in piece["volumes"]:
+			for chapter in volume["chapters"]:
+				hits.extend((piece["title"], pid, content) for pid, content in zip(chapter["_pids"], chapter["_hits"]))
+	hits.sort(key=_hit_key)
+	return hits
+
+def _hit_key(hit):
+	"""
+	结果的排序方式：书名的拼音顺序，书名相同的书（比如BookDefine.bmd中的“前缀·书名”）的结果再按段落编号和内容排序，
+	与这些书的搜索顺序无关。
+	"""
+	return (title_sort_key(hit[0]), ) + hit
+
+def _chapters(manager):
+	"""
+	依次输出书库中每个章节的(book_path, 卷序号, 章节序号, 章节)。
+	书名可能重复，get_book_chapter按书名只能找到第一本书，这里按书籍索引项获取章节，找不到章节时为None。
+	"""
+	for book_index in manager.books_index:
+		for vno, volume in enumerate(book_index['catalogue']["volumes"]):
+			for cno in range(len(volume["chapters"])):
+				position = manager._chapter_position(book_index, vno, cno)
+				yield book_index['book_path'], vno, cno, manager._load_chapter(book_index, *position) if position is not None else None
+
+def _normalized(book):
+	"""
+	没有paragraphs的章节补上空的paragraphs，compact corpus生成的章节总有paragraphs。
+	"""
+	for volume in book["volumes"]:
+		for chapter in volume["chapters"]:
+			chapter.setdefault("paragraphs", [])
+	return book
+
+def _compare_managers(name, manager, expected, queries):
+	"""
+	对比两个BookManager的search_all、目录和章节，目录和章节按book_path对应，书名可以重复。
+	"""
+	mismatches = []
+	catalogues = {book_index['book_path']: book_index['catalogue'] for book_index in manager.books_index}
+	for book_index in expected.books_index:
+		if catalogues.get(book_index['book_path']) != book_index['catalogue']:
+			mismatches.append(f"{name}: catalogue of {book_index['book_path']}")
+	# 书名重复时按书名查找的都是第一本书
+	for title in dict.fromkeys(book_index['title'] for book_index in expected.books_index):
+		if manager.get_book_catalogue(title) != expected.get_book_catalogue(title):
+			mismatches.append(f"{name}: get_book_catalogue({title!r})")
+	for query in queries:
+		if result_hits(manager.search_all(query, limit=None)) != result_hits(expected.search_all(query, limit=None)):
+			mismatches.append(f"{name}: search_all({query!r})")
+	expected_chapters = {(book_path, vno, cno): chapter for book_path, vno, cno, chapter in _chapters(expected)}
+	chapters = {(book_path, vno, cno): chapter for book_path, vno, cno, chapter in _chapters(manager)}
+	if chapters.keys() != expected_chapters.keys():
+		mismatches.append(f"{name}: chapters {sorted(chapters.keys() ^ expected_chapters.keys())[:5]}")
+	for key in sorted(chapters.keys() & expected_chapters.keys()):
+		if chapters[key] is None or expected_chapters[key] is None:
+			mismatches.append(f"{name}: chapter{key} not found")
+		elif _normalized({"volumes": [{"chapters": [dict(chapters[key])]}]}) != _normalized({"volumes": [{"chapters": [dict(expected_chapters[key])]}]}):
+			mismatches.append(f"{name}: chapter{key}")
+	return mismatches
+
+@_with_library
+def check_keyword_matcher(books_path = None, keys_num = KeywordMatcher.AUTOMATON_MIN_KEYS * 2):
+	"""
+	KeywordMatcher的自动机与逐个子串查找、re.finditer对比。
+
+	:param keys_num: 关键字数，不少于AUTOMATON_MIN_KEYS时使用自动机。
+	"""
+	keys = _sample_words(books_path, keys_num, seed = 2) + ["不在书库中的词"]
+	matcher = KeywordMatcher(keys)
+	if not matcher.automaton:
+		return [f"KeywordMatcher: {len(matcher.keys)} keys don't use the automaton"]
+	# 同样的关键字，逐个子串查找
+	substring_matcher = KeywordMatcher(keys)
+	substring_matcher.automaton = False
+	pattern = re.compile('|'.join(re.escape(key) for key in matcher.keys))
+	mismatches = []
+	for content in _iter_contents(books_path):
+		if matcher.present(content) != substring_matcher.present(content):
+			mismatches.append(f"KeywordMatcher.present({content[:20]!r}...)")
+		elif matcher.find_all(content) != substring_matcher.find_all(content):
+			mismatches.append(f"KeywordMatcher.find_all({content[:20]!r}...)")
+		elif matcher.matches(content) != [(m.start(), m.end(), m.group()) for m in pattern.finditer(content)]:
+			mismatches.append(f"KeywordMatcher.matches({content[:20]!r}...)")
+	return mismatches
+
+@_with_library
+def check_query_plan(books_path = None, queries = None):
+	"""
+	编译后的QueryPlan与最初的逐段解释执行对比，包括查询词不少于AUTOMATON_MIN_KEYS、使用自动机的查询。
+	"""
+	queries = list(queries or make_queries(books_path))
+	words = list(dict.fromkeys(_sample_words(books_path, KeywordMatcher.AUTOMATON_MIN_KEYS * 2, seed = 3)))
+	queries.append(" or ".join(words))
+	queries.append(f"({' or '.join(words[1:])}) and not {words[0]}" if len(words) > 1 else words[0] if words else "大人")
+	mismatches = []
+	contents = list(_iter_contents(books_path))
+	for query in queries:
+		query_object = QueryObject(query)
+		for content in contents:
+			if (query_object.excute_query(content) == True) != (query_object.excute_query(content, query_object.query_list) == True):
+				mismatches.append(f"QueryPlan({query[:40]!r}) on {content[:20]!r}...")
+				break
+	return mismatches
+
+@_with_library
+def check_search(books_path = None, queries = None):
+	"""
+	search_all的逐段扫描、索引搜索和缺省方式与逐段解释执行对比。
+	"""
+	queries = queries or make_queries(books_path)
+	manager = BookManager(books_path, True, load_workers = 1, search_index = True, result_cache_bytes = 0)
+	mismatches = []
+	try:
+		for query in queries:
+			expected = baseline_hits(manager, query)
+			for engine in (None, BookManager.SEARCH_SCAN, BookManager.SEARCH_INDEX):
+				if result_hits(manager.search_all(query, limit=None, engine=engine)) != expected:
+					mismatches.append(f"search_all({query!r}, engine={engine})")
+	finally:
+		manager.close()
+	return mismatches
+
+@_with_library
+def check_corpus(books_path = None, queries = None):
+	"""
+	由书库生成compact corpus，对比书籍对象以及加载和不加载书籍时的search_all、get_book_chapter。
+	"""
+	from book_corpus import BookCorpus, build_corpus
+
+	queries = queries or make_queries(books_path)
+	mismatches = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		corpus_path = os.path.join(temp_dir, 'books.corpus')
+		build_corpus(books_path, corpus_path)
+		corpus = BookCorpus(corpus_path)
+		try:
+			for book_no in range(len(corpus)):
+				if corpus.load_book(book_no) != _normalized(_load_json(corpus.book_path(book_no))):
+					mismatches.append(f"BookCorpus.load_book({corpus.book_path(book_no)})")
+		finally:
+			corpus.close()
+
+		expected = BookManager(books_path, True, load_workers = 1, result_cache_bytes = 0)
+		for load in (True, False):
+			manager = BookManager(corpus_path, load, result_cache_bytes = 0)
+			try:
+				mismatches.extend(_compare_managers(f"corpus(load={load})", manager, expected, queries))
+			finally:
+				manager.close()
+		expected.close()
+	return mismatches
+
+@_with_library
+def check_snapshot(books_path = None, queries = None):
+	"""
+	复制书库并生成快照，修改、删除、新增书籍以后，用快照加载和重新加载（reload_books）的结果都要与不用快照加载的结果相同。
+	"""
+	queries = queries or make_queries(books_path)
+	book_paths = _book_paths(books_path)
+	if len(book_paths) < 2:
+		return []
+	mismatches = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		library = os.path.join(temp_dir, 'books')
+		os.mkdir(library)
+		for book_path in book_paths[2:]:
+			shutil.copy2(book_path, library)
+		# 要修改的书用json.dump重新写入，修改后文件大小不变
+		changed_path = os.path.join(library, os.path.basename(book_paths[1]))
+		book = _load_json(book_paths[1])
+		with open(changed_path, 'w', encoding='utf-8') as file:
+			json.dump(book, file, ensure_ascii=False)
+		snapshot_path = os.path.join(temp_dir, 'books.snapshot')
+		reloaded = BookManager(library, True, load_workers = 1, search_index = True, snapshot_path = snapshot_path, result_cache_bytes = 0)
+
+		# 修改第一本书：章节名称和每个段落的内容倒过来，文件大小不变，只有修改时间和内容变化
+		for volume in book["volumes"]:
+			for chapter in volume["chapters"]:
+				chapter["title"] = chapter["title"][::-1]
+				for paragraph in chapter.get("paragraphs") or []:
+					paragraph["content"] = paragraph["content"][::-1]
+		stat = os.stat(changed_path)
+		with open(changed_path, 'w', encoding='utf-8') as file:
+			json.dump(book, file, ensure_ascii=False)
+		if os.path.getsize(changed_path) != stat.st_size:
+			mismatches.append(f"{changed_path}: the size changed")
+		os.utime(changed_path, (stat.st_atime, stat.st_mtime + 10))
+		# 删除最后一本书，加入书库中原来没有复制的第一本书
+		if len(book_paths) > 2:
+			os.unlink(os.path.join(library, os.path.basename(book_paths[-1])))
+		shutil.copy2(book_paths[0], library)
+
+		expected = BookManager(library, True, load_workers = 1, search_index = True, result_cache_bytes = 0)
+		# 加载时会重写快照，每个BookManager使用一份快照的副本
+		for name in ('load', 'no_load'):
+			shutil.copy(snapshot_path, f"{snapshot_path}.{name}")
+		managers = {
+			'snapshot': BookManager(library, True, load_workers = 1, search_index = True, snapshot_path = f"{snapshot_path}.load", result_cache_bytes = 0),
+			'snapshot(load=False)': BookManager(library, False, load_workers = 1, snapshot_path = f"{snapshot_path}.no_load", result_cache_bytes = 0),
+		}
+		reloaded.reload_books()
+		managers['reload_books'] = reloaded
+		for name, manager in managers.items():
+			try:
+				if manager.get_book_version(book["title"]) != expected.get_book_version(book["title"]):
+					mismatches.append(f"{name}: get_book_version({book['title']!r})")
+				mismatches.extend(_compare_managers(name, manager, expected, queries))
+				for query in queries:
+					if result_hits(manager.search_all(query, limit=None, engine=BookManager.SEARCH_INDEX)) != baseline_hits(expected, query):
+						mismatches.append(f"{name}: search_all({query!r}, engine=index)")
+			finally:
+				manager.close()
+		expected.close()
+	return mismatches
+
+def _json_responses(manager):
+	"""
+	按书名获取所有书籍的json目录和章节（get_book_catalogue_json、get_book_chapter_json），第一次获取时填充json_cache。
+
+	:return: dict, (书名, ) -> 目录，(书名, 卷序号, 章节序号) -> 章节。
+	"""
+	responses = {}
+	for title, book_index in list(manager.books_title_map.items()):
+		responses[(title, )] = manager.get_book_catalogue_json(title)
+		for vno, cno in book_index['lookup']['chapters_order']:
+			responses[(title, vno, cno)] = manager.get_book_chapter_json(title, vno, cno)
+	return responses
+
+@_with_library
+def check_reload(books_path = None, queries = None):
+	"""
+	复制书库，修改（包括书名）、删除、新增书籍文件以后，reload_books和BookWatcher重新加载的结果都要与重新创建的BookManager相同：
+	按书名查找的书籍，查询结果缓存和json缓存中不再有旧的内容，索引和快照重新生成。
+	书籍文件只写入了一半（解码失败）时继续使用原来的书籍；重新加载之前开始的搜索仍然搜索原来的书籍。
+	"""
+	from book_watcher import BookWatcher
+
+	queries = queries or make_queries(books_path)
+	book_paths = _book_paths(books_path)
+	if len(book_paths) < 3:
+		return []
+	mismatches = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		library = os.path.join(temp_dir, 'books')
+		os.mkdir(library)
+		for book_path in book_paths[:-1]:
+			shutil.copy2(book_path, library)
+		edited_path, removed_path, added_path = (os.path.join(library, os.path.basename(book_path)) for book_path in (book_paths[0], book_paths[1], book_paths[-1]))
+		snapshot_path = os.path.join(temp_dir, 'books.snapshot')
+		managers = {
+			'reload_books': BookManager(library, True, load_workers = 1, search_index = True, snapshot_path = snapshot_path),
+			'reload_books(load=False)': BookManager(library, False, load_workers = 1),
+			'BookWatcher': BookManager(library, True, load_workers = 1, search_index = True),
+		}
+		try:
+			# 填充查询结果缓存、json缓存和书籍缓存
+			for manager in managers.values():
+				for query in queries:
+					manager.search_all(query, limit=None)
+				_json_responses(manager)
+
+			# 开始一个搜索，每次只搜索两本书，读取第一批结果以后重新加载
+			searching = managers['reload_books']
+			searching.QUERY_THREAD_NUM = 2
+			in_flight_query = QUERIES[1]
+			in_flight_expected = result_hits(searching.search_all(in_flight_query, limit=None))
+			in_flight = searching.iter_search(in_flight_query)
+			in_flight_results = [next(in_flight)]
+
+			# 写入了一半的书籍文件
+			edited = _load_json(edited_path)
+			with open(edited_path, 'r', encoding='utf-8') as file:
+				data = file.read()
+			stat = os.stat(edited_path)
+			with open(edited_path, 'w', encoding='utf-8') as file:
+				file.write(data[:len(data) // 2])
+			os.utime(edited_path, (stat.st_atime, stat.st_mtime + 5))
+			for name in ('reload_books', 'reload_books(load=False)'):
+				version = managers[name].get_book_version(edited["title"])
+				if managers[name].reload_books() != ([], []) or managers[name].get_book_version(edited["title"]) != version:
+					mismatches.append(f"{name}: reload_books() after a partial write of {edited_path}")
+
+			# 修改书名和每个段落的内容，删除书名相同的两本书中的第一本，加入原来没有复制的最后一本
+			edited["title"] = f"改{edited['title']}"
+			for volume in edited["volumes"]:
+				for chapter in volume["chapters"]:
+					for paragraph in chapter.get("paragraphs") or []:
+						paragraph["content"] = paragraph["content"][::-1]
+			with open(edited_path, 'w', encoding='utf-8') as file:
+				json.dump(edited, file, ensure_ascii=False)
+			os.utime(edited_path, (stat.st_atime, stat.st_mtime + 10))
+			os.unlink(removed_path)
+			shutil.copy2(book_paths[-1], library)
+
+			for name in ('reload_books', 'reload_books(load=False)'):
+				changed, removed = managers[name].reload_books()
+				if sorted(changed) != sorted([edited_path, added_path]) or removed != [removed_path]:
+					mismatches.append(f"{name}: reload_books() returned {changed}, {removed}")
+
+			# 重新加载之前开始的搜索
+			in_flight_results.extend(in_flight)
+			if pieces_hits([pieces for _, _, pieces, _ in in_flight_results if pieces is not None]) != in_flight_expected:
+				mismatches.append(f"iter_search({in_flight_query!r}) started before reload_books() didn't search the old books")
+
+			reloaded = threading.Event()
+			watcher = BookWatcher(managers['BookWatcher'], RELOAD_WATCH_INTERVAL, on_reload = lambda changed, removed: reloaded.set())
+			watcher.start()
+			try:
+				if not reloaded.wait(RELOAD_TIMEOUT):
+					mismatches.append(f"BookWatcher: books not reloaded in {RELOAD_TIMEOUT}s")
+			finally:
+				watcher.stop()
+
+			# reload_books重写了快照
+			managers['snapshot'] = BookManager(library, True, load_workers = 1, search_index = True, snapshot_path = snapshot_path)
+
+			expected = BookManager(library, True, load_workers = 1, search_index = True, result_cache_bytes = 0, json_cache_bytes = 0)
+			try:
+				expected_responses = _json_responses(expected)
+				for name, manager in managers.items():
+					if manager.books_title_map.keys() != expected.books_title_map.keys():
+						mismatches.append(f"{name}: titles {sorted(manager.books_title_map.keys() ^ expected.books_title_map.keys())}")
+					if manager.get_book_version(edited["title"]) != expected.get_book_version(edited["title"]):
+						mismatches.append(f"{name}: get_book_version({edited['title']!r})")
+					mismatches.extend(_compare_managers(name, manager, expected, queries))
+					responses = _json_responses(manager)
+					for key in sorted(responses.keys() | expected_responses.keys()):
+						if responses.get(key) != expected_responses.get(key):
+							mismatches.append(f"{name}: json of {key}")
+					if manager.index:
+						for query in queries:
+							if result_hits(manager.search_all(query, limit=None, engine=BookManager.SEARCH_INDEX)) != baseline_hits(expected, query):
+								mismatches.append(f"{name}: search_all({query!r}, engine=index)")
+			finally:
+				expected.close()
+		finally:
+			for manager in managers.values():
+				manager.close()
+	return mismatches
+
+def check_markdown(bmd_path = None):
+	"""
+	编译BMD文件，对比加载编译结果（json和compact corpus）得到的章节与直接解析BMD得到的章节。
+
+	:param bmd_path: BMD文件，None时检查生成的BMD文件（见make_markdown）。
+	"""
+	if bmd_path is None:
+		with tempfile.TemporaryDirectory() as temp_dir:
+			bmd_path = os.path.join(temp_dir, 'fixture.bmd')
+			make_markdown(bmd_path)
+			return check_markdown(bmd_path)
+
+	from book_corpus import build_corpus
+	from book_markdown import compile_book, parse_books
+
+	name = os.path.splitext(os.path.basename(bmd_path))[0]
+	with open(bmd_path, 'r', encoding='utf-8-sig') as file:
+		# 经过一次json编码，与加载的书籍一致
+		books = [json.loads(json.dumps(book, ensure_ascii=False)) for book in parse_books(file, name)]
+	mismatches = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		book_files = compile_book(bmd_path, temp_dir)
+		if len(book_files) != len(books):
+			return [f"compile_book({bmd_path}): {len(book_files)} books, expected {len(books)}"]
+		# 一个BMD文件中的书可能同名，每本书单独加载，用书名获取章节
+		for book_file, book in zip(book_files, books):
+			corpus_path = f"{book_file}.corpus"
+			build_corpus(temp_dir, corpus_path, [book_file])
+			for manager_name, manager in (('json', BookManager(temp_dir, True, load_workers = 1, book_files = [book_file], result_cache_bytes = 0)),
+					('corpus', BookManager(corpus_path, True, result_cache_bytes = 0))):
+				try:
+					for vno, volume in enumerate(book["volumes"]):
+						for cno, chapter in enumerate(volume["chapters"]):
+							loaded = manager.get_book_chapter(book["title"], vno, cno)
+							if loaded is None or _normalized({"volumes": [{"chapters": [dict(loaded)]}]}) != _normalized({"volumes": [{"chapters": [dict(chapter)]}]}):
+								mismatches.append(f"{manager_name}: get_book_chapter({os.path.basename(book_file)}, {vno}, {cno})")
+				finally:
+					manager.close()
+	return mismatches
+
+def verify(books_path = None, bmd_paths = ()):
+	"""
+	运行所有检查。
+
+	:param books_path: 书籍json文件所在的目录，None时在临时目录中生成检查用的小书库（见make_library）。
+	:param bmd_paths: 要检查编译结果的BMD文件，没有时检查生成的BMD文件（见make_markdown）。
+	:return: dict, 检查名称 -> 不一致之处的描述列表。
+	"""
+	if books_path is None:
+		with tempfile.TemporaryDirectory() as temp_dir:
+			books_path = os.path.join(temp_dir, 'books')
+			make_library(books_path)
+			return verify(books_path, bmd_paths)
+
+	queries = make_queries(books_path)
+	results = {
+		'keyword_matcher': check_keyword_matcher(books_path),
+		'query_plan': check_query_plan(books_path, queries),
+		'search': check_search(books_path, queries),
+		'corpus': check_corpus(books_path, queries),
+		'snapshot': check_snapshot(books_path, queries),
+		'reload': check_reload(books_path, queries),
+	}
+	for bmd_path in bmd_paths or [None]:
+		results[f"markdown {bmd_path or 'fixture'}"] = check_markdown(bmd_path)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description = "check that the optimized search and storage paths give the same results as the original ones.")
+	parser.add_argument('books_path', nargs = '?', help = "the directory of the *.json books to check with, a small library is generated if it's not given.")
+	parser.add_argument('--bmd', dest = 'bmd_paths', nargs = '*', default = [], help = "the *.bmd files to check the compiler with, a small one is generated if none is given.")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', force=True)
+	failed = False
+	for name, mismatches in verify(args.books_path, args.bmd_paths).items():
+		print(f"{name}: {'ok' if not mismatches else f'{len(mismatches)} mismatches'}")
+		for mismatch in mismatches[:20]:
+			print(f"\t{mismatch}")
+		failed = failed or bool(mismatches)
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
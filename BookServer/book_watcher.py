@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+书库的热加载。
+后台线程定时检查书籍文件的大小和修改时间，发现变化后调用BookManager.reload_books只重新加载变化了的书籍。
+用轮询而不是文件系统通知，适用于任何本地文件系统。
+"""
+
+import logging
+import threading
+
+class BookWatcher(object):
+	"""
+	定时检查书库变化的后台线程。
+	"""
+	# 缺省的检查间隔，秒
+	WATCH_INTERVAL = 5.0
+
+	def __init__(self, manager, interval = None, on_reload = None):
+		"""
+		初始化BookWatcher对象。
+
+		:param manager: BookManager对象。
+		:param interval: 检查间隔，秒，缺省为WATCH_INTERVAL。
+		:param on_reload: 有书籍新增、修改或者删除时在后台线程中调用的函数，参数为reload_books返回的(changed, removed)。
+		"""
+		self.manager = manager
+		self.interval = interval if interval is not None else self.WATCH_INTERVAL
+		self.on_reload = on_reload
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def start(self):
+		"""
+		启动后台线程。
+		"""
+		if self._thread is not None:
+			return
+		self._stopped.clear()
+		self._thread = threading.Thread(target = self.__run, name = 'book_watcher', daemon = True)
+		self._thread.start()
+		logging.info(f"watch {self.manager.books_path} every {self.interval}s...")
+
+	def stop(self):
+		"""
+		停止后台线程，等待正在进行的检查完成。
+		"""
+		if self._thread is None:
+			return
+		self._stopped.set()
+		self._thread.join()
+		self._thread = None
+
+	def __run(self):
+		while not self._stopped.wait(self.interval):
+			try:
+				changed, removed = self.manager.reload_books()
+				if (changed or removed) and self.on_reload is not None:
+					self.on_reload(changed, removed)
+			except Exception:
+				logging.exception(f"reload books from {self.manager.books_path} failed...")
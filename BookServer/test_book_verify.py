@@ -0,0 +1,43 @@
+"""
+用pytest运行book_verify中的等价性检查，每个检查在临时目录中生成自己的小书库：
+	python -m pytest test_book_verify.py
+"""
+
+import logging
+
+import book_verify
+
+# 和book_verify的命令行一样只记录错误，book_manager缺省记录DEBUG日志，逐段解释执行时日志很多
+logging.getLogger().setLevel(logging.ERROR)
+
+def test_keyword_matcher():
+	assert book_verify.check_keyword_matcher() == []
+
+def test_query_plan():
+	assert book_verify.check_query_plan() == []
+
+def test_search():
+	assert book_verify.check_search() == []
+
+def test_corpus():
+	assert book_verify.check_corpus() == []
+
+def test_snapshot():
+	assert book_verify.check_snapshot() == []
+
+def test_reload():
+	assert book_verify.check_reload() == []
+
+def test_markdown():
+	assert book_verify.check_markdown() == []
+
+def test_fixture_library(tmp_path):
+	# 生成的书库包含容易出错的情况，检查不会因为书库的变化而失去这些情况
+	book_paths = book_verify.make_library(str(tmp_path))
+	books = [book_verify._load_json(book_path) for book_path in book_paths]
+	assert len(books) == book_verify.FIXTURE_BOOKS_NUM
+	assert books[1]["title"] == books[2]["title"] and len(books[2]["volumes"]) > len(books[1]["volumes"])
+	chapters = [chapter for book in books for volume in book["volumes"] for chapter in volume["chapters"]]
+	assert any(chapter.get("paragraphs") == [] for chapter in chapters)
+	assert any("paragraphs" not in chapter for chapter in chapters)
+	assert any(not volume["chapters"] for book in books for volume in book["volumes"])